@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""A local stand-in of the flickr API and image hosts for the benchmarks
+It answers flickr.photosets.getPhotos and flickr.photos.getSizes, and serves
+the images itself, with a configurable latency, bandwidth, error rate and
+photo size. Every request is counted by kind.
+"""
+
+import json
+import random
+import re
+import threading
+import time
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qsl
+except ImportError:  # Python 3
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl
+
+
+# The same suffixes as grabflickr.grabflickr.SIZE_SUFFIXES
+SIZE_SUFFIXES = (
+    'sq', 'q', 't', 's', 'n', 'w', 'm', 'z', 'c', 'l', 'h', 'k', '3k', '4k',
+    'f', '5k', '6k', 'o',
+)
+WRITE_SIZE = 16 * 1024
+IMAGE_PATH = re.compile(r'^/img/([\w-]+)_(\w+)\.jpg$')
+
+
+class MockFlickr(object):
+    """The server, the settings can be changed between runs
+
+    :param photos: The number of photos in every photoset
+    :type photos: int
+    :param photo_size: The size in bytes of the original size, the other
+            sizes are smaller in proportion
+    :type photo_size: int
+    :param latency: The seconds to wait before every response
+    :type latency: float
+    :param bandwidth: The bytes per second of every image transfer,
+            0 for no limit
+    :type bandwidth: int
+    :param error_rate: The rate of requests answered with 503
+    :type error_rate: float
+    :param extras: Whether the photo list has the `url_*` extras, otherwise
+            every url is resolved with flickr.photos.getSizes
+    :type extras: bool
+    """
+
+    def __init__(self, photos=100, photo_size=200 * 1024, latency=0.0,
+                 bandwidth=0, error_rate=0.0, extras=True):
+        self.photos = photos
+        self.photo_size = photo_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.extras = extras
+        self._server = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._bodies = {}
+
+    @property
+    def api_url(self):
+        """The url to be used as `GRABFLICKR_API_URL`
+
+        :rtype: str
+        """
+        return 'http://127.0.0.1:%d/services/rest/' % self._server.server_port
+
+    def start(self):
+        """Listen on a free port of localhost in a background thread
+        """
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.mock = self
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the server
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def count(self, kind, num=1):
+        """Count a request, or the bytes sent
+
+        :param kind: The kind of the request, ex: GET or an API method
+        :type kind: str
+        :param num: The number to be added
+        :type num: int
+        """
+        with self._lock:
+            self._counts[kind] = self._counts.get(kind, 0) + num
+
+    def reset(self):
+        """Reset the counts and return them
+
+        :return: The number of requests by kind, and `bytes` sent
+        :rtype: dict
+        """
+        with self._lock:
+            counts = self._counts
+            self._counts = {}
+        return counts
+
+    def get_size(self, suffix):
+        """Get the size in bytes of the images of a size suffix
+
+        :param suffix: The size suffix, ex: o
+        :type suffix: str
+        :rtype: int
+        """
+        index = SIZE_SUFFIXES.index(suffix) + 1
+        return max(1, self.photo_size * index // len(SIZE_SUFFIXES))
+
+    def get_body(self, suffix):
+        """Get the content of the images of a size suffix, all images of
+        the same size have the same content
+
+        :param suffix: The size suffix, ex: o
+        :type suffix: str
+        :rtype: bytes
+        """
+        size = self.get_size(suffix)
+        body = self._bodies.get(size)
+        if body is None:
+            body = (b'grabflickr' * (size // 10 + 1))[:size]
+            self._bodies[size] = body
+        return body
+
+    def get_image_url(self, photo_id, suffix):
+        """Get the url of an image served by this server
+
+        :rtype: str
+        """
+        return 'http://127.0.0.1:%d/img/%s_%s.jpg' % (
+            self._server.server_port, photo_id, suffix
+        )
+
+    def get_photos(self, photoset_id, page, per_page):
+        """Answer flickr.photosets.getPhotos
+
+        :rtype: dict
+        """
+        pages = max(1, (self.photos + per_page - 1) // per_page)
+        photos = []
+        for index in range((page - 1) * per_page,
+                           min(page * per_page, self.photos)):
+            photo_id = '%s-%d' % (photoset_id, index)
+            photo = {
+                'id': photo_id,
+                'title': photo_id,
+                'secret': 'secret',
+                'lastupdate': '1',
+            }
+            if self.extras:
+                for suffix in SIZE_SUFFIXES:
+                    photo['url_' + suffix] = self.get_image_url(
+                        photo_id, suffix
+                    )
+            photos.append(photo)
+        return {
+            'photoset': {
+                'id': photoset_id,
+                'photo': photos,
+                'page': page,
+                'pages': pages,
+                'per_page': per_page,
+                'total': self.photos,
+            },
+            'stat': 'ok',
+        }
+
+    def get_sizes(self, photo_id):
+        """Answer flickr.photos.getSizes
+
+        :rtype: dict
+        """
+        return {
+            'sizes': {
+                'size': [{
+                    'label': suffix,
+                    'source': self.get_image_url(photo_id, suffix),
+                } for suffix in SIZE_SUFFIXES],
+            },
+            'stat': 'ok',
+        }
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def mock(self):
+        return self.server.mock
+
+    def _fail(self):
+        """Wait for the latency, then answer 503 at the error rate
+
+        :return: Whether the request is answered with 503
+        :rtype: bool
+        """
+        if self.mock.latency:
+            time.sleep(self.mock.latency)
+        if random.random() >= self.mock.error_rate:
+            return False
+        self.mock.count('errors')
+        self.send_response(503)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return True
+
+    def _send_json(self, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.mock.count('bytes', len(body))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        args = dict(parse_qsl(self.rfile.read(length).decode('utf-8')))
+        method = args.get('method', '')
+        self.mock.count(method)
+        if self._fail():
+            return
+        if method == 'flickr.photosets.getPhotos':
+            self._send_json(self.mock.get_photos(
+                args.get('photoset_id', ''), int(args.get('page', 1)),
+                int(args.get('per_page', 500))
+            ))
+        elif method == 'flickr.photos.getSizes':
+            self._send_json(self.mock.get_sizes(args.get('photo_id', '')))
+        else:
+            self._send_json({
+                'stat': 'fail', 'code': 112,
+                'message': 'Method "%s" not found' % method,
+            })
+
+    def do_GET(self):
+        self.mock.count('GET')
+        self._send_image(True)
+
+    def do_HEAD(self):
+        self.mock.count('HEAD')
+        self._send_image(False)
+
+    def _send_image(self, send_body):
+        """Answer an image request, a Range request with the range
+
+        :param send_body: False to send the headers only, for HEAD
+        :type send_body: bool
+        """
+        match = IMAGE_PATH.match(self.path)
+        if match is None or match.group(2) not in SIZE_SUFFIXES:
+            self.send_error(404)
+            return
+        if self._fail():
+            return
+        body = self.mock.get_body(match.group(2))
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match is None:
+            self.send_response(200)
+            start, end = 0, len(body)
+        else:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or len(body) - 1) + 1, len(body))
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % len(body))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, end - 1, len(body)
+            ))
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start))
+        self.end_headers()
+        if send_body:
+            self._send_body(body[start:end])
+
+    def _send_body(self, body):
+        """Send the image at the bandwidth
+        """
+        bandwidth = self.mock.bandwidth
+        for offset in range(0, len(body), WRITE_SIZE):
+            chunk = body[offset:offset + WRITE_SIZE]
+            self.wfile.write(chunk)
+            self.mock.count('bytes', len(chunk))
+            if bandwidth:
+                time.sleep(float(len(chunk)) / bandwidth)
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""Run grabflickr against the local stand-in of flickr in
+:mod:`mock_flickr` and report the results as JSON
+
+Every combination of the comma separated values of the sweep options is run
+with every engine (`-O`) in a new process, ex::
+
+    python benchmarks/run.py --engines 0,1,2,3,4 --latency 0,0.05 \\
+        --photos 200 --output results.json
+
+`--commands` also measures `gf plan` and `gf fetch`, a fetch is run on a
+plan written by an unmeasured `gf plan` first::
+
+    python benchmarks/run.py --commands download,plan,fetch --engines 1,3
+
+Each result has the settings, the `wall_time` in seconds, the `throughput`
+in bytes per second, the `peak_rss` in bytes of the largest process, the
+`requests` counted by the server and the `stats` written by
+`--stats-json`. The arguments after `--` are passed to grabflickr.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_flickr import MockFlickr
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The same as the `gf` entry point, run from the checked out package
+COMMAND = 'import sys; from grabflickr import grabflickr; sys.exit(grabflickr.main())'
+# The settings swept by the benchmarks
+SWEEP = (
+    'command', 'engine', 'photos', 'photo_size', 'latency', 'bandwidth',
+    'error_rate', 'transfer_workers',
+)
+PHOTOSET_ID = 'bench'
+# The ways of running grabflickr, `download` is `gf` without a command
+COMMANDS = ('download', 'plan', 'fetch')
+
+
+def _parse_list(value_type):
+    """Create an argument type of comma separated values
+    """
+    def parse(text):
+        return [value_type(value) for value in text.split(',') if value]
+    return parse
+
+
+def _parse_cli_args():
+    """Parse the arguments from CLI using ArgumentParser
+
+    :return: The arguments parsed by ArgumentParser, and the arguments
+            passed to grabflickr
+    :rtype: tuple
+    """
+    argv = sys.argv[1:]
+    extra = []
+    if '--' in argv:
+        index = argv.index('--')
+        argv, extra = argv[:index], argv[index + 1:]
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--commands', default=['download'], type=_parse_list(str),
+        help='The commands, some of %s. Default: download' % ', '.join(
+            COMMANDS
+        ),
+        metavar='<command,...>'
+    )
+    parser.add_argument(
+        '--engines', default=[0, 1, 2], type=_parse_list(int),
+        help='The -O modes. Default: 0,1,2', metavar='<num,...>'
+    )
+    parser.add_argument(
+        '--photos', default=[100], type=_parse_list(int),
+        help='The number of photos. Default: 100', metavar='<num,...>'
+    )
+    parser.add_argument(
+        '--photo-size', default=[200 * 1024], type=_parse_list(int),
+        help='The size of the original images. Default: 204800',
+        metavar='<bytes,...>'
+    )
+    parser.add_argument(
+        '--latency', default=[0.0], type=_parse_list(float),
+        help='The seconds before every response. Default: 0',
+        metavar='<sec,...>'
+    )
+    parser.add_argument(
+        '--bandwidth', default=[0], type=_parse_list(int),
+        help='The bytes per second of every image, 0 for no limit. Default: 0',
+        metavar='<bytes,...>'
+    )
+    parser.add_argument(
+        '--error-rate', default=[0.0], type=_parse_list(float),
+        help='The rate of requests answered with 503. Default: 0',
+        metavar='<rate,...>'
+    )
+    parser.add_argument(
+        '--transfer-workers', default=[32], type=_parse_list(int),
+        help='The --transfer-workers of grabflickr. Default: 32',
+        metavar='<num,...>'
+    )
+    parser.add_argument(
+        '--without-extras',
+        help='Resolve every url with flickr.photos.getSizes',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--repeat', default=1, type=int,
+        help='The number of runs of each combination. Default: 1',
+        metavar='<num>'
+    )
+    parser.add_argument(
+        '--python', default=sys.executable,
+        help='The Python interpreter running grabflickr. Default: this one',
+        metavar='<path>'
+    )
+    parser.add_argument(
+        '--output',
+        help='Write the results to the file instead of stdout',
+        metavar='<path>'
+    )
+    args = parser.parse_args(argv)
+    unknown = sorted(set(args.commands) - set(COMMANDS))
+    if unknown:
+        parser.error('Unknown commands: %s' % ', '.join(unknown))
+    return args, extra
+
+
+def _get_peak_rss(rusage):
+    """Get the peak resident set size in bytes from the resource usage
+    """
+    if sys.platform == 'darwin':
+        return rusage.ru_maxrss
+    return rusage.ru_maxrss * 1024
+
+
+def _run_process(args, env, log_path):
+    """Run a process and wait for it
+
+    :return: `(status, rusage, wall time)`
+    :rtype: tuple
+    """
+    with open(log_path, 'a') as log:
+        start = time.time()
+        process = subprocess.Popen(args, env=env, stdout=log, stderr=log)
+        # wait4 gives the resource usage of the process and its children
+        _, status, rusage = os.wait4(process.pid, 0)
+        return status, rusage, time.time() - start
+
+
+def run_once(mock, settings, python, extra):
+    """Run grabflickr once in a new process and measure it
+
+    :param mock: The running server
+    :type mock: MockFlickr
+    :param settings: One value of each setting in `SWEEP`
+    :type settings: dict
+    :param python: The Python interpreter
+    :type python: str
+    :param extra: Other arguments of grabflickr
+    :type extra: list
+    :return: The result
+    :rtype: dict
+    """
+    mock.photos = settings['photos']
+    mock.photo_size = settings['photo_size']
+    mock.latency = settings['latency']
+    mock.bandwidth = settings['bandwidth']
+    mock.error_rate = settings['error_rate']
+    mock.reset()
+    work_dir = tempfile.mkdtemp(prefix='grabflickr-bench-')
+    try:
+        config_path = os.path.join(work_dir, 'grabflickr.conf')
+        with open(config_path, 'w') as f:
+            f.write('[flickr]\nAPI_KEY = bench\nAPI_SECRET = bench\n')
+        stats_path = os.path.join(work_dir, 'stats.json')
+        log_path = os.path.join(work_dir, 'grabflickr.log')
+        env = dict(os.environ)
+        env['GRABFLICKR_API_URL'] = mock.api_url
+        env['GRABFLICKR_CONFIG'] = config_path
+        env['PYTHONPATH'] = os.pathsep.join(
+            [ROOT] + [path for path in [env.get('PYTHONPATH')] if path]
+        )
+        plan_path = os.path.join(work_dir, 'plan.jsonl')
+        listing = [
+            '-g', PHOTOSET_ID,
+            '-d', os.path.join(work_dir, 'photos'),
+        ]
+        options = [
+            '-O', str(settings['engine']),
+            '--transfer-workers', str(settings['transfer_workers']),
+            # Measure the engines, not the rate limit of flickr
+            '--api-rate', '1000000',
+            '--progress-interval', '0',
+        ] + extra
+        command = settings['command']
+        if command == 'fetch':
+            _run_process(
+                [python, '-c', COMMAND, 'plan'] + listing +
+                ['--manifest', plan_path] + options, env, log_path
+            )
+            mock.reset()
+            args = ['fetch', '--manifest', plan_path]
+        elif command == 'plan':
+            args = ['plan'] + listing + ['--manifest', plan_path]
+        else:
+            args = listing
+        status, rusage, wall_time = _run_process(
+            [python, '-c', COMMAND] + args +
+            ['--stats-json', stats_path] + options, env, log_path
+        )
+        requests = mock.reset()
+        stats = None
+        if os.path.exists(stats_path):
+            with open(stats_path) as f:
+                stats = json.load(f)
+        result = dict(settings)
+        result.update({
+            'exit_code': os.WEXITSTATUS(status)
+            if os.WIFEXITED(status) else -os.WTERMSIG(status),
+            'wall_time': wall_time,
+            # The bytes sent by the server, the API responses included
+            'throughput': requests.get('bytes', 0) / wall_time,
+            'photos_per_sec': settings['photos'] / wall_time,
+            'peak_rss': _get_peak_rss(rusage),
+            'requests': requests,
+            'stats': stats,
+        })
+        if result['exit_code']:
+            with open(log_path) as f:
+                result['log_tail'] = f.read().splitlines()[-20:]
+        return result
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main():
+    """The main procedure
+    """
+    args, extra = _parse_cli_args()
+    mock = MockFlickr(extras=not args.without_extras)
+    mock.start()
+    results = []
+    try:
+        values = [
+            getattr(args, name + 's' if name in ('command', 'engine')
+                    else name)
+            for name in SWEEP
+        ]
+        for combination in itertools.product(*values):
+            settings = dict(zip(SWEEP, combination))
+            for repeat in range(args.repeat):
+                result = run_once(mock, settings, args.python, extra)
+                result['repeat'] = repeat
+                results.append(result)
+                sys.stderr.write(
+                    '%(command)s -O %(engine)s photos=%(photos)s '
+                    'latency=%(latency)s '
+                    'error_rate=%(error_rate)s: %(wall_time).2fs, '
+                    '%(throughput).0f B/s, %(peak_rss)d B RSS, '
+                    'exit %(exit_code)s\n' % result
+                )
+    finally:
+        mock.stop()
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return 1 if any(result['exit_code'] for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""Measure the startup of grabflickr and report the results as JSON
+
+Every measure is run `--repeat` times in a new interpreter, ex::
+
+    python benchmarks/startup.py --repeat 20 --output startup.json
+
+The results have the min and the median seconds of the bare interpreter
+(`interpreter`), of importing grabflickr (`import`, measured in the new
+interpreter) and of the whole `gf -h` process (`help`), and the `modules`
+which should be imported only when they are used but were imported by the
+import or by `gf -h`. It exits with 1 if there are such modules, or if the
+median of `gf -h` is over `--max-help-time`.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The modules only some modes or options of grabflickr need
+LAZY_MODULES = (
+    'requests', 'multiprocessing', 'sqlite3', 'tarfile', 'zipfile',
+    'tempfile', 'ConfigParser', 'configparser', 'gevent', 'grequests',
+    'aiohttp', 'PIL', 'grabflickr.post',
+)
+# Import grabflickr, run `gf <args>` if any, then write the seconds of the
+# import and the lazy modules loaded by them to stderr
+COMMAND = '''
+import json, sys, time
+loaded = set(sys.modules)
+start = time.time()
+from grabflickr import grabflickr
+imported = time.time()
+if len(sys.argv) > 1:
+    try:
+        grabflickr.main()
+    except SystemExit:
+        pass
+sys.stderr.write('\\n' + json.dumps({
+    'import_time': imported - start,
+    'modules': sorted(
+        name for name in %r if name in sys.modules and name not in loaded
+    ),
+}) + '\\n')
+''' % (LAZY_MODULES,)
+
+
+def _parse_cli_args():
+    """Parse the arguments from CLI using ArgumentParser
+
+    :return: The arguments parsed by ArgumentParser
+    :rtype: Namespace
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--repeat', default=10, type=int,
+        help='The number of runs of each measure. Default: 10',
+        metavar='<num>'
+    )
+    parser.add_argument(
+        '--max-help-time', type=float,
+        help='Fail if the median seconds of `gf -h` is over this',
+        metavar='<sec>'
+    )
+    parser.add_argument(
+        '--python', default=sys.executable,
+        help='The Python interpreter running grabflickr. Default: this one',
+        metavar='<path>'
+    )
+    parser.add_argument(
+        '--output',
+        help='Write the results to the file instead of stdout',
+        metavar='<path>'
+    )
+    return parser.parse_args()
+
+
+def run_once(args):
+    """Run a new interpreter with the arguments and measure it
+
+    :param args: The arguments of the interpreter
+    :type args: list
+    :return: The wall time in seconds, and the report written by `COMMAND`
+            if it is run
+    :rtype: tuple
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + [path for path in [env.get('PYTHONPATH')] if path]
+    )
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        process = subprocess.Popen(
+            args, env=env, stdout=devnull, stderr=subprocess.PIPE
+        )
+        _, err = process.communicate()
+        wall_time = time.time() - start
+    if process.returncode:
+        raise RuntimeError('%s exited with %s: %s' % (
+            ' '.join(args[:2]), process.returncode, err.decode('utf-8')
+        ))
+    lines = err.decode('utf-8').strip().splitlines()
+    report = json.loads(lines[-1]) if lines and lines[-1].startswith('{') \
+        else None
+    return wall_time, report
+
+
+def _summarize(times):
+    """Get the min and the median of the seconds
+    """
+    times = sorted(times)
+    return {'min': times[0], 'median': times[len(times) // 2]}
+
+
+def main():
+    """The main procedure
+    """
+    args = _parse_cli_args()
+    repeat = max(1, args.repeat)
+    runs = {
+        'interpreter': [args.python, '-c', 'pass'],
+        'import': [args.python, '-c', COMMAND],
+        'help': [args.python, '-c', COMMAND, '-h'],
+    }
+    times = dict((name, []) for name in runs)
+    modules = {}
+    import_times = []
+    # Interleave the measures, so a busy moment affects all of them
+    for _ in range(repeat):
+        for name, command in sorted(runs.items()):
+            wall_time, report = run_once(command)
+            times[name].append(wall_time)
+            if report is not None:
+                modules[name] = report['modules']
+                if name == 'import':
+                    import_times.append(report['import_time'])
+    result = {
+        'python': args.python,
+        'repeat': repeat,
+        'interpreter': _summarize(times['interpreter']),
+        'import': _summarize(import_times),
+        'help': _summarize(times['help']),
+        'modules': modules,
+    }
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    sys.stderr.write(
+        'interpreter %.3fs, import %.3fs, gf -h %.3fs (medians)\n' % (
+            result['interpreter']['median'], result['import']['median'],
+            result['help']['median']
+        )
+    )
+    failed = False
+    for name, names in sorted(modules.items()):
+        if names:
+            sys.stderr.write('%s imports %s\n' % (name, ', '.join(names)))
+            failed = True
+    if args.max_help_time is not None and \
+            result['help']['median'] > args.max_help_time:
+        sys.stderr.write('gf -h takes %.3fs, over %.3fs\n' % (
+            result['help']['median'], args.max_help_time
+        ))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1012 @@
+# -*- coding: utf-8 -*-
+"""The asyncio download engine (`-O 3`), it needs Python 3 and aiohttp.
+API calls and image downloads are both non-blocking, and their concurrency
+is bounded by semaphores. Nothing is monkey-patched.
+"""
+
+import asyncio
+import hashlib
+import os
+import time
+
+import aiohttp
+
+from grabflickr import grabflickr as gf
+
+
+# Connection errors and timeouts are regarded as transient
+TRANSIENT_ERRORS = (IOError, OSError, aiohttp.ClientError, asyncio.TimeoutError)
+# The seconds between two tries of a lock of the content store
+STORE_LOCK_POLL = 0.01
+
+
+def _trace_span(name, cat, **args):
+    """Create a span of the current task, the same as
+    :func:`grabflickr.grabflickr.trace_span`, every task has its own track
+
+    :param name: The span name
+    :type name: str
+    :param cat: The category, ex: api, http or disk
+    :type cat: str
+    :rtype: context manager
+    """
+    tracer = gf.get_job().tracer
+    if tracer is None:
+        return gf.NULL_SPAN
+    task = asyncio.current_task()
+    return tracer.span(
+        name, cat, tid=id(task), worker=task.get_name(), **args
+    )
+
+
+def _run_blocking(func, *args):
+    """Run a blocking call, ex: file I/O or SQLite, in the default executor
+    as a part of the current job, so it does not stall the other tasks
+
+    :param func: The function
+    :type func: function
+    :rtype: asyncio.Future
+    """
+    return asyncio.get_event_loop().run_in_executor(
+        None, gf.get_job().bind(func), *args
+    )
+
+
+async def with_retry(func, *args, **kwargs):
+    """Await the coroutine function, await it again after a backoff if it
+    raises a retryable error, the same as
+    :func:`grabflickr.grabflickr.with_retry`
+
+    :param func: The coroutine function to be awaited
+    :type func: function
+    :return: The result of the coroutine function
+    """
+    retries = gf.get_downloader().retries
+    attempt = 0
+    while True:
+        try:
+            return await func(*args, **kwargs)
+        except Exception as e:
+            if attempt >= retries or \
+                    not gf._is_retryable(e, TRANSIENT_ERRORS):
+                raise
+            delay = gf._get_backoff(attempt)
+            gf.logger.warning('%s, retry in %.1f seconds', e, delay)
+            gf.get_metrics().count('retries')
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+async def _call_api_once(http, api_semaphore, method, **kwargs):
+    """Send a signed flickr API request once, after taking a token
+    from the `api_limiter` of the downloader
+
+    :param http: The aiohttp session
+    :type http: aiohttp.ClientSession
+    :param api_semaphore: The semaphore bounding the concurrent API calls
+    :type api_semaphore: asyncio.Semaphore
+    :param method: The method provided by flickr,
+            ex: flickr.photosets.getPhotos
+    :type method: str
+    :param kwargs: Other settings
+    :type kwargs: dict
+    :return: The response
+    :rtype: dict
+    """
+    args = gf._get_request_args(method, **kwargs)
+    downloader = gf.get_downloader()
+    async with api_semaphore:
+        await asyncio.sleep(downloader.api_limiter.reserve())
+        gf.get_metrics().count('api_calls')
+        with _trace_span(
+                method, 'api', photo_id=kwargs.get('photo_id'),
+                photoset_id=kwargs.get('photoset_id'),
+                page=kwargs.get('page')) as span:
+            async with http.post(downloader.api_url, data=args) as resp:
+                span.set(status=resp.status)
+                resp.raise_for_status()
+                text = await resp.text()
+    return gf._parse_api_response(text)
+
+
+async def _call_api(http, api_semaphore, method, **kwargs):
+    """Send a signed flickr API request, retry it on rate limits and
+    server errors
+
+    :param http: The aiohttp session
+    :type http: aiohttp.ClientSession
+    :param api_semaphore: The semaphore bounding the concurrent API calls
+    :type api_semaphore: asyncio.Semaphore
+    :param method: The method provided by flickr,
+            ex: flickr.photosets.getPhotos
+    :type method: str
+    :param kwargs: Other settings
+    :type kwargs: dict
+    :return: The response
+    :rtype: dict
+    """
+    api_cache = gf.get_downloader().api_cache
+    if api_cache is not None:
+        resp_json = await _run_blocking(api_cache.get, method, kwargs)
+        if resp_json is not None:
+            return resp_json
+    resp_json = await with_retry(
+        _call_api_once, http, api_semaphore, method, **kwargs
+    )
+    if api_cache is not None:
+        await _run_blocking(api_cache.put, method, kwargs, resp_json)
+    return resp_json
+
+
+async def _get_photoset_page(http, api_semaphore, photoset_id, page):
+    """Request one page of the photos information with the photoset id
+
+    :param http: The aiohttp session
+    :type http: aiohttp.ClientSession
+    :param api_semaphore: The semaphore bounding the concurrent API calls
+    :type api_semaphore: asyncio.Semaphore
+    :param photoset_id: The photoset id of flickr
+    :type photoset_id: str
+    :param page: The page number, start from 1
+    :type page: int
+    :return: photoset information include `photo`, `page`, `pages` and `total`
+    :rtype: dict
+    """
+    with gf.get_metrics().timer('list'):
+        resp_json = await _call_api(
+            http, api_semaphore,
+            'flickr.photosets.getPhotos',
+            photoset_id=photoset_id,
+            extras=gf.PHOTO_EXTRAS,
+            per_page=str(gf.PHOTOS_PER_PAGE),
+            page=str(page)
+        )
+    return resp_json['photoset']
+
+
+async def iter_photos_info(http, api_semaphore, photoset_id):
+    """Walk through all pages of the photoset and yield the photos information
+    The next page is requested while the photos of the current page are
+    consumed. The total of the first page is counted to the metrics.
+
+    :param http: The aiohttp session
+    :type http: aiohttp.ClientSession
+    :param api_semaphore: The semaphore bounding the concurrent API calls
+    :type api_semaphore: asyncio.Semaphore
+    :param photoset_id: The photoset id of flickr
+    :type photoset_id: str
+    :return: photos information
+    :rtype: async generator of dicts
+    """
+    photoset = await _get_photoset_page(http, api_semaphore, photoset_id, 1)
+    gf._count_up(int(photoset['total']))
+    pages = int(photoset['pages'])
+    page = 1
+    while True:
+        next_page = None
+        if page < pages:
+            next_page = asyncio.ensure_future(_get_photoset_page(
+                http, api_semaphore, photoset_id, page + 1
+            ))
+        for photo in photoset['photo']:
+            yield photo
+        if next_page is None:
+            break
+        photoset = await next_page
+        page += 1
+
+
+async def _head_content_length(http, url):
+    """Send a HEAD request and get the length of the image from it
+    """
+    with _trace_span('HEAD', 'http', url=url) as span:
+        async with http.head(
+                url, allow_redirects=True, timeout=_get_timeout()) as resp:
+            span.set(status=resp.status)
+            if resp.status in gf.HEAD_NOT_ALLOWED:
+                return None
+            resp.raise_for_status()
+            return gf._get_content_length(resp)
+
+
+async def select_size(http, sizes):
+    """Select the size of the photo with the size policy, the same as
+    :meth:`grabflickr.grabflickr.SizePolicy.select`
+
+    :param http: The aiohttp session
+    :type http: aiohttp.ClientSession
+    :param sizes: The sizes of the photo
+    :type sizes: list of dicts
+    :return: The size, None if no size fits
+    :rtype: dict
+    """
+    policy = gf.get_size_policy()
+    for size in policy.get_candidates(sizes):
+        if policy.exhausted:
+            return None
+        length = None
+        if policy.needs_length:
+            length = await with_retry(_head_content_length, http, size['url'])
+        if policy.accept(size, length):
+            return size
+    return None
+
+
+async def get_photo_url(http, api_semaphore, photo_id):
+    """Request the photo download url with the photo id
+
+    :param http: The aiohttp session
+    :type http: aiohttp.ClientSession
+    :param api_semaphore: The semaphore bounding the concurrent API calls
+    :type api_semaphore: asyncio.Semaphore
+    :param photo_id: The photo id of flickr
+    :type photo_id: str
+    :return: Photo download url, None if no size fits the size policy
+    :rtype: str
+    """
+    resp_json = await _call_api(
+        http, api_semaphore,
+        'flickr.photos.getSizes',
+        photo_id=photo_id
+    )
+    size = await select_size(http, gf._get_sizes_from_response(resp_json))
+    return size['url'] if size is not None else None
+
+
+async def resolve_photo_url(http, api_semaphore, photo):
+    """Get the download url of the photo
+    Use the url extras if exist, otherwise request the sizes with
+    flickr.photos.getSizes
+
+    :param http: The aiohttp session
+    :type http: aiohttp.ClientSession
+    :param api_semaphore: The semaphore bounding the concurrent API calls
+    :type api_semaphore: asyncio.Semaphore
+    :param photo: The photo information include id and title
+    :type photo: dict
+    :return: Photo download url, None if no size fits the size policy
+    :rtype: str
+    """
+    if gf.get_size_policy().exhausted:
+        return None
+    sizes = gf._get_sizes_from_extras(photo)
+    if not sizes:
+        return await get_photo_url(http, api_semaphore, photo['id'])
+    size = await select_size(http, sizes)
+    return size['url'] if size is not None else None
+
+
+def _get_timeout():
+    """Get the timeout of the image requests
+
+    :rtype: aiohttp.ClientTimeout
+    """
+    return aiohttp.ClientTimeout(
+        sock_connect=gf.REQUEST_TIMEOUT, sock_read=gf.REQUEST_TIMEOUT
+    )
+
+
+async def download_file(http, download_url, file_path, hasher=None,
+                        segmented=True):
+    """Download the url to `file_path` through a `.part` file,
+    the same as :func:`grabflickr.grabflickr.download_file`
+
+    :param http: The aiohttp session
+    :type http: aiohttp.ClientSession
+    :param download_url: The url of the photo
+    :type download_url: str
+    :param file_path: The path of the photo file
+    :type file_path: str
+    :param hasher: The hash object updated with the whole content of
+            `file_path` if it is downloaded
+    :type hasher: hashlib hash object
+    :param segmented: Whether a large photo may be downloaded in segments
+    :type segmented: bool
+    :return: False if `file_path` already exists, otherwise True
+    :rtype: bool
+    """
+    if os.path.exists(file_path):
+        return False
+    job = gf.get_job()
+    part_path = file_path + gf.PART_SUFFIX
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {}
+    if offset:
+        headers['Range'] = 'bytes=%d-' % offset
+    elif segmented and job.segments > 1:
+        headers['Range'] = 'bytes=0-%d' % (job.segment_threshold - 1)
+    with _trace_span('GET', 'http', url=download_url, offset=offset) as span:
+        async with http.get(
+                download_url, headers=headers, timeout=_get_timeout()) as resp:
+            span.set(status=resp.status)
+            if resp.status == 416:
+                expected = gf._get_range_total(resp)
+            else:
+                resp.raise_for_status()
+                if resp.status == 206:
+                    if gf._get_range_start(resp) != offset:
+                        raise IOError('Unexpected Content-Range of %s: %s' % (
+                            download_url, resp.headers.get('Content-Range')
+                        ))
+                    if gf._is_first_segment(resp, offset):
+                        return await download_segments(
+                            http, resp, download_url, file_path, hasher
+                        )
+                    expected = gf._get_range_total(resp)
+                    if offset and hasher is not None:
+                        await _run_blocking(gf.hash_file, part_path, hasher)
+                    mode = 'ab' if offset else 'wb'
+                else:
+                    expected = gf._get_content_length(resp)
+                    mode = 'wb'
+                nbytes = await _save_content(resp, part_path, mode, hasher)
+                span.set(bytes=nbytes)
+    if resp.status == 416:
+        if expected != offset:
+            # The part file is larger than the photo, start over, or the
+            # first segment is refused, then the photo is asked in one stream
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            return await download_file(
+                http, download_url, file_path, hasher, segmented and offset > 0
+            )
+        if not os.path.exists(part_path):
+            # An empty photo has no byte to be asked for
+            open(part_path, 'wb').close()
+        if hasher is not None:
+            await _run_blocking(gf.hash_file, part_path, hasher)
+    size = os.path.getsize(part_path)
+    if expected is not None and size != expected:
+        raise IOError('Incomplete download of %s: %s of %s bytes' % (
+            download_url, size, expected
+        ))
+    with _trace_span('rename', 'disk'):
+        os.rename(part_path, file_path)
+    return True
+
+
+async def _save_content(resp, part_path, mode, hasher=None, offset=None):
+    """Stream the response body to `part_path` chunk by chunk, the same as
+    :func:`grabflickr.grabflickr.save_response`
+
+    :param resp: The response
+    :type resp: aiohttp.ClientResponse
+    :param part_path: The path of the partial photo file
+    :type part_path: str
+    :param mode: 'wb' to write from the start, 'ab' to append to a partial file
+    :type mode: str
+    :param hasher: The hash object updated with the written chunks
+    :type hasher: hashlib hash object
+    :param offset: Write from this position of the existing file instead,
+            used by the segments of a photo
+    :type offset: int
+    :return: The number of bytes written
+    :rtype: int
+    """
+    job = gf.get_job()
+    nbytes = 0
+    write_time = 0.0
+    # The file is written in the executor, a slow disk does not stall the
+    # other transfers
+    f = await _run_blocking(open, part_path, mode if offset is None else 'r+b')
+    try:
+        if offset is not None:
+            f.seek(offset)
+        async for chunk in resp.content.iter_chunked(job.chunk_size):
+            start = time.time()
+            if job.tracer is None:
+                await _run_blocking(f.write, chunk)
+            else:
+                with _trace_span('write', 'disk', bytes=len(chunk)):
+                    await _run_blocking(f.write, chunk)
+            write_time += time.time() - start
+            nbytes += len(chunk)
+            if hasher is not None:
+                hasher.update(chunk)
+        start = time.time()
+        if job.fsync:
+            with _trace_span('fsync', 'disk'):
+                await _run_blocking(_fsync, f)
+        write_time += time.time() - start
+    finally:
+        await _run_blocking(f.close)
+        gf.get_metrics().count('bytes', nbytes)
+        gf.get_metrics().observe('write', write_time)
+    return nbytes
+
+
+def _fsync(f):
+    """Flush the file and fsync it
+    """
+    f.flush()
+    os.fsync(f.fileno())
+
+
+async def _download_segment(http, download_url, segments_path, start, end):
+    """Download the bytes from `start` to `end` (exclusive) of the photo
+    into their place in `segments_path`, the same as
+    :func:`grabflickr.grabflickr._download_segment`
+
+    :param http: The aiohttp session
+    :type http: aiohttp.ClientSession
+    :param download_url: The url of the photo
+    :type download_url: str
+    :param segments_path: The path of the preallocated segments file
+    :type segments_path: str
+    :param start: The first byte position
+    :type start: int
+    :param end: The position after the last byte
+    :type end: int
+    :raise RangeNotSupported: The response is not the range
+    :return: The number of bytes written
+    :rtype: int
+    """
+    headers = {'Range': 'bytes=%d-%d' % (start, end - 1)}
+    with _trace_span('GET', 'http', url=download_url, offset=start) as span:
+        async with http.get(
+                download_url, headers=headers, timeout=_get_timeout()) as resp:
+            span.set(status=resp.status)
+            resp.raise_for_status()
+            if resp.status != 206 or gf._get_range_start(resp) != start or \
+                    gf._get_range_end(resp) != end - 1:
+                raise gf.RangeNotSupported('Unexpected range of %s: %s %s' % (
+                    download_url, resp.status,
+                    resp.headers.get('Content-Range')
+                ))
+            nbytes = await _save_content(
+                resp, segments_path, 'r+b', offset=start
+            )
+            span.set(bytes=nbytes)
+    if nbytes != end - start:
+        raise IOError('Incomplete segment of %s: %s of %s bytes' % (
+            download_url, nbytes, end - start
+        ))
+    return nbytes
+
+
+async def download_segments(http, resp, download_url, file_path, hasher=None):
+    """Download a large photo in concurrent Range segments, `resp` is the
+    response of the first request, the same as
+    :func:`grabflickr.grabflickr.download_segments` with a task for each
+    segment
+
+    :param http: The aiohttp session
+    :type http: aiohttp.ClientSession
+    :param resp: The response of the first request
+    :type resp: aiohttp.ClientResponse
+    :param download_url: The url of the photo
+    :type download_url: str
+    :param file_path: The path of the photo file
+    :type file_path: str
+    :param hasher: The hash object updated with the whole content of
+            `file_path`
+    :type hasher: hashlib hash object
+    :return: True
+    :rtype: bool
+    """
+    job = gf.get_job()
+    total = gf._get_range_total(resp)
+    resp.close()
+    segments_path = file_path + gf.SEGMENTS_SUFFIX
+    await _run_blocking(_create_file, segments_path, total)
+    results = await asyncio.gather(*[
+        with_retry(
+            _download_segment, http, download_url, segments_path, start, end
+        )
+        for start, end in gf._split_range(0, total, job.segments)
+    ], return_exceptions=True)
+    errors = [result for result in results if isinstance(result, Exception)]
+    if any(isinstance(error, gf.RangeNotSupported) for error in errors):
+        gf.logger.warning(
+            'Range requests of %s are not supported, '
+            'download it in one stream', download_url
+        )
+        os.remove(segments_path)
+        return await download_file(
+            http, download_url, file_path, hasher, segmented=False
+        )
+    try:
+        if errors:
+            raise errors[0]
+        size = os.path.getsize(segments_path)
+        if size != total:
+            raise IOError('Incomplete download of %s: %s of %s bytes' % (
+                download_url, size, total
+            ))
+        if hasher is not None:
+            await _run_blocking(gf.hash_file, segments_path, hasher)
+        with _trace_span('rename', 'disk'):
+            os.rename(segments_path, file_path)
+    except Exception:
+        # A segments file has holes, it is not resumed
+        if os.path.isfile(segments_path):
+            os.remove(segments_path)
+        raise
+    return True
+
+
+def _create_file(path, size):
+    """Create the file of `size` bytes with holes
+    """
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+
+async def resolve_photo(http, api_semaphore, photo):
+    """The first stage of downloading a photo: skip it if it is not changed
+    since the last sync or the job is cancelled, otherwise resolve its
+    download url and file name, a planned photo has them already
+
+    :param http: The aiohttp session
+    :type http: aiohttp.ClientSession
+    :param api_semaphore: The semaphore bounding the concurrent API calls
+    :type api_semaphore: asyncio.Semaphore
+    :param photo: The photo information include id and title
+    :type photo: dict
+    :return: (download url, file name), None if the photo is skipped
+    :rtype: tuple
+    """
+    if gf.get_job().cancelled:
+        return None
+    if gf.PLAN_KEY in photo:
+        return photo[gf.PLAN_KEY]
+    photoset = gf._get_photoset(photo)
+    with gf.get_metrics().timer('resolve'), \
+            _trace_span('resolve', 'photo', photo_id=photo['id']):
+        if photoset.manifest is not None and await _run_blocking(
+                photoset.manifest.is_synced, photo, photoset.directory):
+            gf.logger.info('Skip %s, not changed', photo['title'])
+            gf.get_metrics().count('skipped')
+            return None
+        download_url = await resolve_photo_url(http, api_semaphore, photo)
+    if download_url is None:
+        gf.logger.info(
+            'Skip %s, no size fits the size policy', photo['title']
+        )
+        gf.get_metrics().count('skipped')
+        return None
+    return download_url, gf._get_photo_file_name(photo, download_url)
+
+
+async def _download_file_with_md5(http, download_url, file_path):
+    """Download the url to `file_path` with :func:`download_file` and compute
+    the md5 of the file, a new md5 is used by every retry
+
+    :param http: The aiohttp session
+    :type http: aiohttp.ClientSession
+    :param download_url: The url of the photo
+    :type download_url: str
+    :param file_path: The path of the photo file
+    :type file_path: str
+    :return: (whether it is downloaded, md5 of the file)
+    :rtype: tuple
+    """
+    hasher = hashlib.md5()
+    downloaded = await download_file(http, download_url, file_path, hasher)
+    return downloaded, hasher
+
+
+async def _fetch_photo(http, photo, download_url, file_path):
+    """Download the photo to `file_path`, or link it from the content store
+    if the store has it, the same as :func:`grabflickr.grabflickr._fetch_photo`
+
+    :param http: The aiohttp session
+    :type http: aiohttp.ClientSession
+    :param photo: The photo information include id and secret
+    :type photo: dict
+    :param download_url: Photo download url
+    :type download_url: str
+    :param file_path: The path of the photo file
+    :type file_path: str
+    :return: (whether it is downloaded or linked, the md5 of the file if
+            known, whether it is linked)
+    :rtype: tuple
+    """
+    store = gf.get_downloader().content_store
+    if store is None:
+        if gf._get_photoset(photo).manifest is None:
+            downloaded = await with_retry(
+                download_file, http, download_url, file_path
+            )
+            return downloaded, None, False
+        downloaded, hasher = await with_retry(
+            _download_file_with_md5, http, download_url, file_path
+        )
+        return downloaded, hasher.hexdigest() if downloaded else None, False
+    if os.path.exists(file_path):
+        return False, None, False
+    key = store.get_key(photo, download_url)
+    async with _KeyLock(store, key):
+        checksum = await _run_blocking(store.link, key, file_path)
+        if checksum is not None:
+            gf.get_metrics().count('linked')
+            return True, checksum, True
+        downloaded, hasher = await with_retry(
+            _download_file_with_md5, http, download_url, file_path
+        )
+        if not downloaded:
+            return False, None, False
+        await _run_blocking(store.add, key, file_path, hasher.hexdigest())
+        return True, hasher.hexdigest(), False
+
+
+class _KeyLock(object):
+    """Async context manager holding the lock of a key of the content store,
+    see :meth:`grabflickr.grabflickr.ContentStore.lock`. The lock is shared
+    by every job of the store, ex: the jobs of `gf serve`, whatever their
+    event loop, so it is tried again after STORE_LOCK_POLL seconds instead
+    of waited for.
+
+    :param store: The content store
+    :type store: grabflickr.grabflickr.ContentStore
+    :param key: The key
+    :type key: str
+    """
+
+    def __init__(self, store, key):
+        self._lock = store.lock(key)
+
+    async def __aenter__(self):
+        while not self._lock.acquire(False):
+            await asyncio.sleep(STORE_LOCK_POLL)
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self._lock.release()
+        return False
+
+
+async def plan_photo(http, photo, download_url, photo_title):
+    """The second stage of `gf plan`: request the length of the image and
+    add the photo to the plan of the job, the same as
+    :func:`grabflickr.grabflickr.plan_photo`
+
+    :param http: The aiohttp session
+    :type http: aiohttp.ClientSession
+    :param photo: The photo information include id and title
+    :type photo: dict
+    :param download_url: Photo download url
+    :type download_url: str
+    :param photo_title: The file name of the photo
+    :type photo_title: str
+    """
+    file_path = gf._get_photoset(photo).directory + os.sep + photo_title
+    with gf.get_metrics().timer('transfer'), \
+            _trace_span('plan', 'photo', photo_id=photo['id']):
+        try:
+            size = await with_retry(_head_content_length, http, download_url)
+        except Exception as e:
+            if not gf._is_client_error(e):
+                raise
+            gf.logger.warning('Plan %s without a size: %s', gf._log_text(
+                photo['title']
+            ), e)
+            size = None
+    gf.get_job().plan.add(
+        gf._get_plan_entry(photo, download_url, file_path, size)
+    )
+
+
+async def transfer_photo(http, photo, download_url, photo_title):
+    """The second stage of downloading a photo: download the image to the
+    directory of its photoset, record it to the manifest if any, hand it
+    over to the sink of the job and to its post-processing if any, or add
+    it to the plan of `gf plan`
+
+    :param http: The aiohttp session
+    :type http: aiohttp.ClientSession
+    :param photo: The photo information include id and title
+    :type photo: dict
+    :param download_url: Photo download url
+    :type download_url: str
+    :param photo_title: The file name of the photo
+    :type photo_title: str
+    :return: The size of the downloaded file, 0 if it is already downloaded,
+            linked from the content store, planned or the job is cancelled
+    :rtype: int
+    """
+    if gf.get_job().cancelled:
+        gf.get_metrics().count('skipped')
+        return 0
+    if gf.get_job().plan is not None:
+        await plan_photo(http, photo, download_url, photo_title)
+        return 0
+    if gf.get_job().dry_run:
+        gf.logger.info('Would download %s from %s', photo_title, download_url)
+        return 0
+    photoset = gf._get_photoset(photo)
+    sink = gf.get_job().sink
+    file_path = photoset.directory + os.sep + photo_title
+    gf.logger.info('Download %s...', photo_title)
+    with gf.get_metrics().timer('transfer'), \
+            _trace_span('transfer', 'photo', photo_id=photo['id']) as span:
+        if photoset.manifest is not None:
+            await _run_blocking(gf._remove_stale_photo, photo, file_path)
+        written = await _run_blocking(sink.contains, file_path)
+        downloaded, checksum, linked = False, None, False
+        if not written:
+            downloaded, checksum, linked = await _fetch_photo(
+                http, photo, download_url, file_path
+            )
+        if photoset.manifest is not None:
+            await _run_blocking(
+                gf._record_photo, photo, download_url, photo_title, checksum
+            )
+        size = os.path.getsize(file_path) if downloaded else 0
+        if not written:
+            # It waits while the writer of an archive falls behind
+            await asyncio.get_event_loop().run_in_executor(
+                None, sink.add, file_path
+            )
+        span.set(linked=linked)
+        if downloaded and not linked:
+            span.set(bytes=size)
+    post = gf.get_job().post
+    if post is not None:
+        from grabflickr.post import create_task
+        # It waits while the post-processing falls behind
+        await asyncio.get_event_loop().run_in_executor(
+            None, post.submit,
+            create_task(photo, download_url, file_path, checksum),
+            gf.get_metrics()
+        )
+    if linked:
+        gf.logger.info('Link %s from the store', photo_title)
+        return 0
+    if not downloaded:
+        if photoset.manifest is None:
+            gf.logger.info('Skip %s, already downloaded', photo_title)
+        gf.get_metrics().count('skipped')
+        return 0
+    return size
+
+
+class ConcurrencyController(gf.ConcurrencyController):
+    """Adaptive limit of the in-flight transfers, the same as
+    :class:`grabflickr.grabflickr.ConcurrencyController` but waiting on an
+    asyncio condition. It must be created in the running event loop.
+
+    :param min_limit: The min number of in-flight transfers
+    :type min_limit: int
+    :param max_limit: The max number of in-flight transfers
+    :type max_limit: int
+    """
+
+    def __init__(self, min_limit, max_limit):
+        super(ConcurrencyController, self).__init__(min_limit, max_limit)
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        """Wait until the number of in-flight transfers is under the limit,
+        then count one more in flight
+
+        :return: The start time of the transfer
+        :rtype: float
+        """
+        async with self._condition:
+            while self._in_flight >= self.limit:
+                await self._condition.wait()
+            self._in_flight += 1
+        return time.time()
+
+    async def release(self, start, nbytes, error=None):
+        """Count a transfer as finished and adjust the limit
+
+        :param start: The start time returned by :meth:`acquire`
+        :type start: float
+        :param nbytes: The number of bytes transferred
+        :type nbytes: int
+        :param error: The error raised by the transfer if any
+        :type error: Exception
+        """
+        async with self._condition:
+            self._in_flight -= 1
+            self._record(time.time(), start, nbytes, error)
+            self._condition.notify_all()
+
+
+class Pipeline(object):
+    """Download photos in two stages with separate worker pools, the same as
+    :class:`grabflickr.grabflickr.Pipeline` but with asyncio tasks and queues
+
+    :param http: The aiohttp session
+    :type http: aiohttp.ClientSession
+    :param api_semaphore: The semaphore bounding the concurrent API calls
+    :type api_semaphore: asyncio.Semaphore
+    :param resolve_num: The number of resolve workers
+    :type resolve_num: int
+    :param controller: The controller of the in-flight transfers, there are
+            as many transfer workers as its max limit
+    :type controller: ConcurrencyController
+    :param size: The max number of photos waiting in each queue
+    :type size: int
+    """
+
+    def __init__(self, http, api_semaphore, resolve_num, controller, size):
+        self._http = http
+        self._api_semaphore = api_semaphore
+        self._resolve_num = resolve_num
+        self._controller = controller
+        self._resolve_queue = asyncio.Queue(maxsize=size)
+        self._resolve_stops = 0
+        self._transfer_stops = 0
+        self._transfer_queue = asyncio.Queue(maxsize=size)
+
+    def stats(self):
+        """Get the number of photos waiting in each stage
+
+        :return: `resolve_queue` and `transfer_queue` depths
+        :rtype: dict
+        """
+        # The stop signals put after the last photo are not counted
+        return {
+            'resolve_queue': max(
+                0, self._resolve_queue.qsize() - self._resolve_stops
+            ),
+            'transfer_queue': max(
+                0, self._transfer_queue.qsize() - self._transfer_stops
+            ),
+        }
+
+    async def run(self, photos):
+        """Download the photos and wait for all workers to finish
+
+        :param photos: The photos to be downloaded
+        :type photos: async iterable of dicts
+        """
+        resolvers = [
+            asyncio.ensure_future(self._resolve_worker())
+            for _ in range(self._resolve_num)
+        ]
+        transferrers = [
+            asyncio.ensure_future(self._transfer_worker())
+            for _ in range(self._controller.max_limit)
+        ]
+        try:
+            async for photo in photos:
+                await self._resolve_queue.put(photo)
+        finally:
+            for _ in resolvers:
+                self._resolve_stops += 1
+                await self._resolve_queue.put(None)
+            await asyncio.gather(*resolvers)
+            for _ in transferrers:
+                self._transfer_stops += 1
+                await self._transfer_queue.put(None)
+            await asyncio.gather(*transferrers)
+
+    def _done(self):
+        """Count a photo as done and log the progress
+        """
+        stats = self.stats()
+        gf.logger.info(
+            'The number of pictures remaining: %s '
+            '(waiting for url: %s, waiting for transfer: %s)',
+            gf._count_down(), stats['resolve_queue'], stats['transfer_queue']
+        )
+
+    async def _resolve_worker(self):
+        """Resolve the photos from the resolve queue until it gets None
+        """
+        while True:
+            photo = await self._resolve_queue.get()
+            if photo is None:
+                return
+            try:
+                resolved = await resolve_photo(
+                    self._http, self._api_semaphore, photo
+                )
+            except Exception as e:
+                gf.record_failure(photo, e)
+                resolved = None
+            if resolved is None:
+                self._done()
+            else:
+                await self._transfer_queue.put((photo, resolved))
+
+    async def _transfer_worker(self):
+        """Download the photos from the transfer queue until it gets None
+        """
+        while True:
+            item = await self._transfer_queue.get()
+            if item is None:
+                return
+            photo, (download_url, photo_title) = item
+            start = await self._controller.acquire()
+            nbytes = 0
+            error = None
+            try:
+                nbytes = await transfer_photo(
+                    self._http, photo, download_url, photo_title
+                )
+            except Exception as e:
+                gf.record_failure(photo, e)
+                error = e
+            await self._controller.release(start, nbytes, error)
+            self._done()
+
+
+async def iter_photosets_photos(http, api_semaphore, photosets):
+    """Walk through the photosets one after another and yield their photos,
+    the same as :func:`grabflickr.grabflickr.iter_photosets_photos`
+
+    :param http: The aiohttp session
+    :type http: aiohttp.ClientSession
+    :param api_semaphore: The semaphore bounding the concurrent API calls
+    :type api_semaphore: asyncio.Semaphore
+    :param photosets: The photosets to be downloaded
+    :type photosets: list of grabflickr.grabflickr.Photoset
+    :return: photos information
+    :rtype: async generator of dicts
+    """
+    job = gf.get_job()
+    for photoset in photosets:
+        async for photo in iter_photos_info(http, api_semaphore, photoset.id):
+            if job.cancelled:
+                return
+            photo[gf.PHOTOSET_KEY] = photoset
+            photoset.photo_ids.add(photo['id'])
+            yield photo
+        photoset.listed = True
+
+
+async def _iter_photos(photos):
+    """Yield the photos of a list, as an async iterable for
+    :meth:`Pipeline.run`
+    """
+    for photo in photos:
+        yield photo
+
+
+async def download_photos(photosets, photos=None):
+    """List the photosets and download their photos through one
+    :class:`Pipeline` sized by the `resolve_workers`,
+    `min_transfer_workers`, `transfer_workers` and `queue_size` of the
+    current job.
+    Downloading starts after the first page arrives and memory does not
+    grow with the photoset size.
+
+    :param photosets: The photosets to be downloaded
+    :type photosets: list of grabflickr.grabflickr.Photoset
+    :param photos: The photos of `gf fetch` to be downloaded instead of
+            listing the photosets
+    :type photos: list of dicts
+    """
+    job = gf.get_job()
+    # One more API call for the photoset listing prefetch
+    api_semaphore = asyncio.Semaphore(job.resolve_workers + 1)
+    # A connection for every segment of every transfer
+    connector = aiohttp.TCPConnector(
+        limit=job.resolve_workers +
+        job.transfer_workers * max(1, job.segments) + 1
+    )
+    async with aiohttp.ClientSession(connector=connector) as http:
+        pipeline = Pipeline(
+            http, api_semaphore, job.resolve_workers,
+            ConcurrencyController(
+                job.min_transfer_workers, job.transfer_workers
+            ),
+            gf._get_queue_size()
+        )
+        if photos is None:
+            await pipeline.run(
+                iter_photosets_photos(http, api_semaphore, photosets)
+            )
+        else:
+            gf._init_counter(photos)
+            await pipeline.run(_iter_photos(photos))
+
+
+def download_photosets(photosets, photos=None):
+    """Use asyncio to download the photos of the photosets
+
+    :param photosets: The photosets to be downloaded
+    :type photosets: list of grabflickr.grabflickr.Photoset
+    :param photos: The photos of `gf fetch` to be downloaded instead of
+            listing the photosets
+    :type photos: list of dicts
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(download_photos(photosets, photos))
+    finally:
+        loop.close()
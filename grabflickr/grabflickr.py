@@ -1,53 +1,186 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-try:
-    import gevent
-    import grequests
-except ImportError:
-    pass
-else:
-    from gevent import monkey
+from __future__ import absolute_import
+
 import sys
 import os
 import hashlib
+import errno
 import json
 import logging
+import random
+import shutil
 import argparse
-import multiprocessing
-from ConfigParser import SafeConfigParser
-import requests
+import abc
+import bisect
+import threading
+import time
+import zlib
+try:
+    from Queue import Queue, Empty
+except ImportError:  # Python 3
+    from queue import Queue, Empty
+# requests, multiprocessing, sqlite3, the config parser and the archive
+# modules are imported where they are used, so `gf -h`, `gf -u` and the
+# modes which do not need them start fast. See benchmarks/startup.py
+
+try:
+    input = raw_input
+except NameError:  # Python 3
+    pass
+try:
+    range = xrange
+except NameError:  # Python 3
+    pass
 
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
-API_URL = 'https://flickr.com/services/rest/'
+# The API url and the config path can be changed by the environment,
+# ex: to run against the local server of the benchmarks
+API_URL = os.environ.get(
+    'GRABFLICKR_API_URL', 'https://flickr.com/services/rest/'
+)
 
-directory = ''
-image_size_mode = 1
-counter = 0
-CONFIG_PATH = os.path.expanduser('~/.grabflickr.conf')
-api_key = ''
-api_secret = ''
+# See API_URL
+CONFIG_PATH = os.environ.get(
+    'GRABFLICKR_CONFIG', os.path.expanduser('~/.grabflickr.conf')
+)
+# The job run by the current thread, see Job.activate
+_local = threading.local()
+# The job of the code run outside any job, see get_job
+default_job = None
+# Imported by _gevent_patch, only when the event driven mode is chosen
+gevent = None
+grequests = None
 
 SINGLE_PROCESS = 0
 MULTITHREAD = 1
 GEVENT = 2
+ASYNCIO = 3
+MULTIPROCESS = 4
+
+# Size suffixes of the `url_*` extras, ordered from smallest to largest
+# like the size list returned by flickr.photos.getSizes
+SIZE_SUFFIXES = (
+    'sq', 'q', 't', 's', 'n', 'w', 'm', 'z', 'c', 'l', 'h', 'k', '3k', '4k',
+    'f', '5k', '6k', 'o',
+)
+PHOTO_EXTRAS = ','.join(
+    ['last_update'] + ['url_' + suffix for suffix in SIZE_SUFFIXES]
+)
+PHOTOS_PER_PAGE = 500
+# The number of hosts (API host and image hosts) to keep connection pools for
+POOL_HOSTS = 16
+# The adaptive concurrency controller adjusts its limit after each window of
+# at least ADAPT_WINDOW seconds. A throughput change smaller than ADAPT_GAIN
+# is regarded as no change.
+ADAPT_WINDOW = 1.0
+ADAPT_GAIN = 0.05
+THROTTLE_STATUS = (429, 503)
+# Flickr allows 3600 API calls per hour for a key
+API_RATE = 1.0
+API_BURST = 60
+# Backoff before the n-th retry is random between 0 and
+# min(RETRY_CAP, RETRY_BASE * 2 ** n) seconds
+RETRY_BASE = 1.0
+RETRY_CAP = 60.0
+REQUEST_TIMEOUT = 60
+# A server which does not allow HEAD requests, the length of its images is
+# unknown
+HEAD_NOT_ALLOWED = (405, 501)
+PART_SUFFIX = '.part'
+# The file a photo downloaded in segments is written into, unlike a `.part`
+# file it has holes until every segment is written, so it is not resumed
+SEGMENTS_SUFFIX = '.segments'
+# A photo larger than SEGMENT_THRESHOLD MB is downloaded in SEGMENTS
+# concurrent Range requests
+SEGMENTS = 4
+SEGMENT_THRESHOLD = 32
+MANIFEST_NAME = '.grabflickr.db'
+# The key of the Photoset in the photo information
+PHOTOSET_KEY = '_photoset'
+MANIFEST_COLUMNS = ('id', 'lastupdate', 'url', 'file_name', 'size', 'checksum')
+# The key of the task id in the photo information sent to a worker process
+TASK_KEY = '_task'
+# The key of the download url and the file name of a photo planned by
+# `gf plan`, in the photo information of `gf fetch`
+PLAN_KEY = '_plan'
+# A photo is given up after TASK_ATTEMPTS worker processes died with it
+TASK_ATTEMPTS = 3
+# The seconds to wait for a result before checking the worker processes
+PROCESS_POLL = 0.5
+METRIC_COUNTERS = (
+    'listed', 'done', 'skipped', 'failed', 'bytes', 'api_calls', 'retries',
+    'cache_hits', 'linked'
+)
+METRIC_STAGES = ('list', 'resolve', 'transfer', 'write', 'post')
+# The upper bounds in seconds of the latency histogram buckets, the last
+# bucket counts the rest
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+)
+PROGRESS_INTERVAL = 5.0
+# The max number of memoized signed API arguments
+SIGNED_ARGS_SIZE = 4096
+# The seconds the responses of each API method are cached for by
+# --api-cache, the other methods are not cached. The photo list is cached
+# shortly to see the new and changed photos soon.
+CACHE_TTLS = {
+    'flickr.photosets.getList': 3600,
+    'flickr.photosets.getPhotos': 3600,
+    'flickr.photos.getSizes': 7 * 24 * 3600,
+}
+API_CACHE_SIZE = 64
+# The directory of the contents and the index in the --store directory
+STORE_OBJECTS = 'objects'
+STORE_INDEX = 'index.db'
+# The max number of downloaded photos waiting for the writer of an archive
+ARCHIVE_QUEUE_SIZE = 16
+# The hooks of --post, see grabflickr.post
+POST_HOOKS = ('thumbnail', 'exif', 'checksum')
+THUMBNAIL_SIZE = 256
+
+
+def _log_text(text):
+    """Convert the text to be logged to the native string type
+
+    :param text: The text, ex: photo title
+    :type text: unicode
+    :return: utf-8 encoded bytes in Python 2, the text itself in Python 3
+    :rtype: str
+    """
+    if sys.version_info[0] == 2:
+        return text.encode('utf-8')
+    return text
+
+
+def _create_config_parser():
+    """Create the parser of the config file
+
+    :rtype: SafeConfigParser
+    """
+    try:
+        from ConfigParser import SafeConfigParser
+    except ImportError:  # Python 3
+        from configparser import ConfigParser as SafeConfigParser
+    return SafeConfigParser()
 
 
 def read_config():
     """Read the config from CONFIG_PATH(Default: ~/.grabflickr.conf)
     This will prompt for API key and secret if it not exists.
-    After, it sets the global variable `api_key` and `api_secret`.
+
+    :return: (API key, API secret)
+    :rtype: tuple
     """
-    parser = SafeConfigParser()
+    parser = _create_config_parser()
     parser.read(CONFIG_PATH)
     if not parser.has_section('flickr'):
         logger.info('Seems you don\'t set API key, please enter the following informations: ')
-        enter_api_key(parser)
-    global api_key, api_secret
-    api_key = parser.get('flickr', 'API_KEY')
-    api_secret = parser.get('flickr', 'API_SECRET')
+        return enter_api_key(parser)
+    return parser.get('flickr', 'API_KEY'), parser.get('flickr', 'API_SECRET')
 
 
 def enter_api_key(parser=None):
@@ -56,17 +189,19 @@ def enter_api_key(parser=None):
 
     :param parser: Config parser
     :type parser: SafeConfigParser
+    :return: (API key, API secret)
+    :rtype: tuple
     """
     if parser is None:
-        parser = SafeConfigParser()
+        parser = _create_config_parser()
     parser.add_section('flickr')
-    global api_key, api_secret
-    api_key = raw_input('Enter your API key: ')
-    api_secret = raw_input('Enter your API secret: ')
+    api_key = input('Enter your API key: ')
+    api_secret = input('Enter your API secret: ')
     parser.set('flickr', 'API_KEY', api_key)
     parser.set('flickr', 'API_SECRET', api_secret)
-    with open(CONFIG_PATH, 'wb') as f:
+    with open(CONFIG_PATH, 'w') as f:
         parser.write(f)
+    return api_key, api_secret
 
 
 def _get_request_args(method, **kwargs):
@@ -81,26 +216,37 @@ def _get_request_args(method, **kwargs):
     :return: An argument list used for post request
     :rtype: list of sets
     """
-    args = [
-        ('api_key', api_key),
-        ('format', 'json'),
-        ('method', method),
-        ('nojsoncallback', '1'),
-    ]
-    if kwargs:
-        for key, value in kwargs.iteritems():
-            args.append((key, value))
-    args.sort(key=lambda tup: tup[0])
-    api_sig = _get_api_sig(args)
-    args.append(api_sig)
-    return args
+    downloader = get_downloader()
+    signed_args = downloader.signed_args
+    # The signed arguments are memoized, so retries are not signed again
+    memo_key = (method, tuple(sorted(kwargs.items())))
+    args = signed_args.get(memo_key)
+    if args is None:
+        args = [
+            ('api_key', downloader.api_key),
+            ('format', 'json'),
+            ('method', method),
+            ('nojsoncallback', '1'),
+        ]
+        if kwargs:
+            for key, value in kwargs.items():
+                args.append((key, value))
+        args.sort(key=lambda tup: tup[0])
+        api_sig = _get_api_sig(args, downloader.api_secret)
+        args.append(api_sig)
+        if len(signed_args) >= SIGNED_ARGS_SIZE:
+            signed_args.clear()
+        signed_args[memo_key] = args
+    return list(args)
 
 
-def _get_api_sig(args):
+def _get_api_sig(args, api_secret):
     """Flickr API need a hash string which made using post arguments
 
     :param args: Arguments of the flickr request
     :type args: list of sets
+    :param api_secret: The API secret
+    :type api_secret: str
     :return: api_sig, ex: ('api_sig', 'abcdefg')
     :rtype: tuple
     """
@@ -111,290 +257,4724 @@ def _get_api_sig(args):
     return 'api_sig', api_sig
 
 
-def create_dir(path):
-    """Create dir with the path
+def create_session(pool_size):
+    """Create a session to be shared by all requests. Each host gets
+    a connection pool that keeps up to `pool_size` connections alive, so API
+    calls and image downloads reuse connections instead of doing a new TLS
+    handshake every time.
 
-    :param path: The path to be created
-    :type path: str
+    :param pool_size: The max number of connections kept per host,
+            should be the number of workers
+    :type pool_size: int
+    :return: The session
+    :rtype: requests.Session
     """
-    if os.path.exists(path):
-        if not os.path.isdir(path):
-            logger.error('%s is not a directory', path)
-            sys.exit(1)
-        else:  # ignore
-            pass
-    else:
-        os.makedirs(path)
-        logger.info('Create dir: %s', path)
+    import requests
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=POOL_HOSTS,
+        pool_maxsize=pool_size
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
 
 
-def get_photos_info(photoset_id):
-    """Request the photos information with the photoset id
+def get_session():
+    """Get the session of the current downloader
 
-    :param photoset_id: The photoset id of flickr
-    :type photoset_id: str
-    :return: photos information
-    :rtype: list
+    :return: The shared session
+    :rtype: requests.Session
     """
-    args = _get_request_args(
-        'flickr.photosets.getPhotos',
-        photoset_id=photoset_id
-    )
-    resp = requests.post(API_URL, data=args)
-    resp_json = json.loads(resp.text.encode('utf-8'))
-    logger.debug(resp_json)
-    photos = resp_json['photoset']['photo']
-    return photos
+    return get_downloader().session
 
 
-def get_photo_url(photo_id):
-    """Request the photo download url with the photo id
-    :param photo_id: The photo id of flickr
-    :type photo_id: str
-    :return: Photo download url
-    :rtype: str
+class _StageTimer(object):
+    """Context manager recording the time spent in a stage to the metrics,
+    the stage is counted as failed if the block raises
+
+    :param metrics: The metrics to record to
+    :type metrics: Metrics
+    :param stage: The stage name, one of `METRIC_STAGES`
+    :type stage: str
     """
-    args = _get_request_args(
-        'flickr.photos.getSizes',
-        photo_id=photo_id
-    )
-    resp = requests.post(API_URL, data=args)
-    resp_json = json.loads(resp.text.encode('utf-8'))
-    logger.debug(json.dumps(resp_json, indent=2))
-    size_list = resp_json['sizes']['size']
-    size_list_len = len(size_list)
-    global image_size_mode
-    image_size_mode = size_list_len if size_list_len < image_size_mode \
-        else image_size_mode
-    download_url = resp_json['sizes']['size'][-image_size_mode]['source']
-    return download_url
 
+    def __init__(self, metrics, stage):
+        self._metrics = metrics
+        self._stage = stage
+        self._start = None
 
-def download_photo_async(photo):
-    """Download a photo to the the path(global varialbe `directory`)
+    def __enter__(self):
+        self._start = time.time()
+        return self
 
-    :param photo: The photo information include id and title
-    :type photo: dict
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._metrics.observe(
+            self._stage, time.time() - self._start, exc_type is not None
+        )
+        return False
+
+
+class Metrics(object):
+    """Counters and latency histograms of a run, shared by all engines
+    Every update is made under a lock, so the workers of any engine can
+    update it at the same time. The counters are named by `METRIC_COUNTERS`
+    and the stages by `METRIC_STAGES`, the latency of each stage is counted
+    in the buckets of `LATENCY_BUCKETS` seconds.
     """
-    photo_id = photo['id']
-    photo_title = photo['title']
-    download_url = get_photo_url(photo_id)
-    photo_format = download_url.split('.')[-1]
-    photo_title = photo_title + '.' + photo_format
-    file_path = directory + os.sep + photo_title
-    logger.info('Download %s...', photo_title.encode('utf-8'))
-    req = [grequests.get(download_url)]
-    counter_lock = multiprocessing.Lock()
-    for resp in grequests.map(req):
-        with open(file_path, 'w') as f:
-            f.write(resp.content)
-            with counter_lock:
-                global counter
-                counter -= 1
-        logger.info(
-            'The number of pictures remaining: %s', counter
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.start = time.time()
+        self._counters = dict((name, 0) for name in METRIC_COUNTERS)
+        self._stages = dict((stage, {
+            'count': 0,
+            'errors': 0,
+            'total': 0.0,
+            'max': 0.0,
+            'buckets': [0] * (len(LATENCY_BUCKETS) + 1),
+        }) for stage in METRIC_STAGES)
+
+    def count(self, name, num=1):
+        """Increase the counter
+
+        :param name: The counter name
+        :type name: str
+        :param num: The number to be added
+        :type num: int
+        :return: The new value of the counter
+        :rtype: int
+        """
+        with self._lock:
+            self._counters[name] += num
+            return self._counters[name]
+
+    def set(self, name, value):
+        """Set the counter, used for the counters kept by other processes
+
+        :param name: The counter name
+        :type name: str
+        :param value: The value
+        :type value: int
+        """
+        with self._lock:
+            self._counters[name] = value
+
+    def get(self, name):
+        """Get the counter
+
+        :param name: The counter name
+        :type name: str
+        :rtype: int
+        """
+        return self._counters[name]
+
+    def remaining(self):
+        """Get the number of photos listed but not done yet
+
+        :rtype: int
+        """
+        with self._lock:
+            return self._counters['listed'] - self._counters['done']
+
+    def observe(self, stage, seconds, failed=False):
+        """Record the time spent in a stage
+
+        :param stage: The stage name
+        :type stage: str
+        :param seconds: The time spent
+        :type seconds: float
+        :param failed: Whether the stage failed
+        :type failed: bool
+        """
+        index = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            record = self._stages[stage]
+            record['count'] += 1
+            record['total'] += seconds
+            record['max'] = max(record['max'], seconds)
+            record['buckets'][index] += 1
+            if failed:
+                record['errors'] += 1
+
+    def timer(self, stage):
+        """Time a block of code as a stage::
+
+            with metrics.timer('resolve'):
+                ...
+
+        :param stage: The stage name
+        :type stage: str
+        :rtype: context manager
+        """
+        return _StageTimer(self, stage)
+
+    def snapshot(self):
+        """Get a copy of the metrics, which can be dumped as JSON
+
+        :return: `elapsed` seconds, `bytes_per_sec`, `photos_per_sec`,
+                `counters`, `latency_buckets` and `stages`. Each stage has
+                `count`, `errors`, `total`, `mean`, `max`, the `p50`, `p90`
+                and `p99` estimated from the buckets, and the `buckets`
+        :rtype: dict
+        """
+        with self._lock:
+            elapsed = time.time() - self.start
+            counters = dict(self._counters)
+            stages = {}
+            for stage, record in self._stages.items():
+                stages[stage] = dict(record, buckets=list(record['buckets']))
+        for record in stages.values():
+            count = record['count']
+            record['mean'] = record['total'] / count if count else 0.0
+            for percent in (50, 90, 99):
+                record['p%d' % percent] = self._get_percentile(
+                    record, percent
+                )
+        return {
+            'elapsed': elapsed,
+            'bytes_per_sec': counters['bytes'] / elapsed if elapsed else 0.0,
+            'photos_per_sec': counters['done'] / elapsed if elapsed else 0.0,
+            'counters': counters,
+            'latency_buckets': list(LATENCY_BUCKETS),
+            'stages': stages,
+        }
+
+    @staticmethod
+    def _get_percentile(record, percent):
+        """Estimate the percentile of a stage by the upper bound of
+        the bucket it falls in, the max for the last bucket
+        """
+        rank = record['count'] * percent / 100.0
+        seen = 0
+        for index, num in enumerate(record['buckets']):
+            seen += num
+            if num and seen >= rank:
+                if index < len(LATENCY_BUCKETS):
+                    return min(LATENCY_BUCKETS[index], record['max'])
+                return record['max']
+        return 0.0
+
+    def merge(self, snapshot, exclude=()):
+        """Add the metrics of another process
+
+        :param snapshot: The snapshot of the other metrics
+        :type snapshot: dict
+        :param exclude: The counters not to be added
+        :type exclude: tuple
+        """
+        with self._lock:
+            for name, value in snapshot['counters'].items():
+                if name not in exclude:
+                    self._counters[name] += value
+            for stage, other in snapshot['stages'].items():
+                record = self._stages[stage]
+                for key in ('count', 'errors', 'total'):
+                    record[key] += other[key]
+                record['max'] = max(record['max'], other['max'])
+                record['buckets'] = [
+                    num + other_num for num, other_num in
+                    zip(record['buckets'], other['buckets'])
+                ]
+
+    def format_progress(self):
+        """Format the progress as one line
+
+        :rtype: str
+        """
+        snapshot = self.snapshot()
+        counters = snapshot['counters']
+        return (
+            '%s/%s photos (%s skipped, %s failed), %.1f MB at %.2f MB/s, '
+            '%s retries' % (
+                counters['done'], counters['listed'], counters['skipped'],
+                counters['failed'], counters['bytes'] / 1048576.0,
+                snapshot['bytes_per_sec'] / 1048576.0, counters['retries']
+            )
         )
 
 
-def download_photo(photo):
-    """Download a photo to the the path(global varialbe `directory`)
+def get_metrics():
+    """Get the metrics of the current job
 
-    :param photo: The photo information include id and title
-    :type photo: dict
+    :return: The metrics
+    :rtype: Metrics
     """
-    counter_lock = multiprocessing.Lock()
-    photo_id = photo['id']
-    photo_title = photo['title']
-    download_url = get_photo_url(photo_id)
-    photo_format = download_url.split('.')[-1]
-    photo_title = photo_title + '.' + photo_format
-    file_path = directory + os.sep + photo_title
-    logger.info('Download %s...', photo_title.encode('utf-8'))
-    resp = requests.get(download_url)
-    with open(file_path, 'w') as f:
-        f.write(resp.content)
-        with counter_lock:
-            global counter
-            counter -= 1
-        logger.info(
-            'The number of pictures remaining: %s', counter
-        )
+    return get_job().metrics
 
 
-def single_download_photos(photos):
-    """Use single process to download photos
+class ProgressReporter(object):
+    """Log the progress line of the metrics every `interval` seconds in
+    a background thread, or a greenlet in the event driven mode
 
-    :param photos: The photos to be downloaded
-    :type photos: list of dicts
+    :param interval: The seconds between two lines
+    :type interval: float
+    :param metrics: The metrics of the job
+    :type metrics: Metrics
     """
-    global counter
-    counter = len(photos)
-    for photo in photos:
-        download_photo(photo)
 
+    def __init__(self, interval, metrics):
+        self._interval = interval
+        self._metrics = metrics
+        self._stopped = threading.Event()
+        self._thread = None
 
-def event_download_photos(photos):
-    """Use asynchronous I/O to download photos
+    def start(self):
+        """Start logging the progress
+        """
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
 
-    :param photos: The photos to be downloaded
-    :type photos: list of dicts
+    def stop(self):
+        """Stop logging the progress and log the last line
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        logger.info('Progress: %s', self._metrics.format_progress())
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            logger.info('Progress: %s', self._metrics.format_progress())
+
+
+class _NullSpan(object):
+    """The span returned by :func:`trace_span` when tracing is off,
+    it records nothing
     """
-    try:
-        assert gevent
-        assert grequests
-    except NameError:
-        logger.error('You need install gevent module. Aborting...')
-        sys.exit(1)
-    global counter
-    counter = len(photos)
-    from gevent.pool import Pool
-    pool = Pool(multiprocessing.cpu_count())
-    jobs = [pool.spawn(download_photo_async, photo) for photo in photos]
-    pool.join()
 
+    def __enter__(self):
+        return self
 
-def multithread_download_photos(photos):
-    """Use multiple threads to download photos
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
 
-    :param photos: The photos to be downloaded
-    :type photos: list of dicts
+    def set(self, **args):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    """A span recorded to the tracer when the block ends
+
+    :param tracer: The tracer to record to
+    :type tracer: Tracer
+    :param name: The span name
+    :type name: str
+    :param cat: The category, ex: api, http or disk
+    :type cat: str
+    :param tid: The id of the track, ex: thread id
+    :type tid: int
+    :param worker: The name of the worker
+    :type worker: str
+    :param args: The tags of the span
+    :type args: dict
     """
-    from concurrent import futures
-    global counter
-    counter = len(photos)
-    cpu_num = multiprocessing.cpu_count()
-    with futures.ThreadPoolExecutor(max_workers=cpu_num) as executor:
-        for photo in photos:
-            executor.submit(download_photo, photo)
 
+    def __init__(self, tracer, name, cat, tid, worker, args):
+        self._tracer = tracer
+        self._name = name
+        self._cat = cat
+        self._tid = tid
+        self._worker = worker
+        self._args = args
+        self._start = None
 
-def init_logger():
-    """Initialize the logger and set its format
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self._args['error'] = str(exc_value)
+        self._tracer.add(
+            self._name, self._cat, self._start, time.time(), self._tid,
+            self._worker, self._args
+        )
+        return False
+
+    def set(self, **args):
+        """Add tags known only at the end, ex: the byte count
+        """
+        self._args.update(args)
+
+
+class Tracer(object):
+    """Record spans as Chrome trace events, which can be opened in
+    chrome://tracing or Perfetto. Every worker thread or greenlet has its
+    own track.
     """
-    formatter = logging.Formatter('%(levelname)s: %(message)s')
-    console = logging.StreamHandler(stream=sys.stdout)
-    console.setLevel(logging.INFO)
-    console.setFormatter(formatter)
-    logger.addHandler(console)
 
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._events = []
+        self._workers = {}
 
-def _parse_cli_args():
-    """Parse the arguments from CLI using ArgumentParser
-    :return: The arguments parsed by ArgumentParser
-    :rtype: Namespace
+    def span(self, name, cat, tid=None, worker=None, **args):
+        """Create a span to be used in a `with` block, tagged with `args`
+
+        :param name: The span name
+        :type name: str
+        :param cat: The category, ex: api, http or disk
+        :type cat: str
+        :param tid: The id of the track, default is the current thread id
+        :type tid: int
+        :param worker: The name of the worker, default is the current thread
+                name
+        :type worker: str
+        :rtype: context manager
+        """
+        if tid is None:
+            thread = threading.current_thread()
+            tid = thread.ident
+            worker = thread.name
+        return _Span(self, name, cat, tid, worker, args)
+
+    def add(self, name, cat, start, end, tid, worker, args):
+        """Record a finished span
+
+        :param start: The start time in seconds since the epoch
+        :type start: float
+        :param end: The end time in seconds since the epoch
+        :type end: float
+        """
+        event = {
+            'name': name,
+            'cat': cat,
+            'ph': 'X',
+            'ts': start * 1000000,
+            'dur': (end - start) * 1000000,
+            'pid': self._pid,
+            'tid': tid,
+            'args': args,
+        }
+        with self._lock:
+            self._events.append(event)
+            if tid not in self._workers:
+                self._workers[tid] = worker
+                self._events.append({
+                    'name': 'thread_name',
+                    'ph': 'M',
+                    'pid': self._pid,
+                    'tid': tid,
+                    'args': {'name': worker},
+                })
+
+    def events(self):
+        """Get a copy of the recorded events
+
+        :rtype: list of dicts
+        """
+        with self._lock:
+            return list(self._events)
+
+    def extend(self, events):
+        """Add the events recorded by another process
+
+        :param events: The events
+        :type events: list of dicts
+        """
+        with self._lock:
+            self._events.extend(events)
+
+    def dump(self, path):
+        """Write the events to a JSON file in the Chrome trace format
+
+        :param path: The path of the JSON file
+        :type path: str
+        """
+        with open(path, 'w') as f:
+            json.dump({
+                'traceEvents': self.events(),
+                'displayTimeUnit': 'ms',
+            }, f)
+        logger.info('Write the trace to %s', path)
+
+
+def trace_span(name, cat, **args):
+    """Create a span of the current thread to be used in a `with` block::
+
+        with trace_span('GET', 'http', url=url) as span:
+            ...
+            span.set(bytes=nbytes)
+
+    :param name: The span name
+    :type name: str
+    :param cat: The category, ex: api, http or disk
+    :type cat: str
+    :return: A span recorded by the tracer of the current job, or a span
+            recording nothing if tracing is off
+    :rtype: context manager
     """
-    parser = argparse.ArgumentParser()
-    parser.add_argument(
-        '-g',
-        help='The photoset id to be downloaded',
-        metavar='<photoset_id>'
-    )
-    parser.add_argument(
-        '-s',
-        default=1,
-        help=(
-            'Image size. 12 is smallest, 1 is original size. '
-            'Default: 1'
-        ),
-        type=int,
-        choices=xrange(0, 10),
-        metavar='<num>'
-    )
-    parser.add_argument(
-        '-d',
-        default=None,
-        help=(
-            'The path to store the downloaded images. '
-            'Automatically create it if not exist. '
-            'Default use the photoset id as folder name under current path'
-        ),
-        metavar='<path>'
-    )
-    parser.add_argument(
-        '-O',
-        default=1,
-        help=(
-            '0 for single process, '
-            '1 for multithread. '
-            '2 for event driven. '
-            'Default: 1'
-        ),
-        type=int,
-        choices=xrange(0, 3),
-        metavar='<num>'
-    )
-    parser.add_argument(
-        '-u',
-        help=(
-            'Set your API key'
-        ),
-        action='store_true'
-    )
-    args = parser.parse_args()
-    logger.debug(args)
-    return args
+    tracer = get_job().tracer
+    if tracer is None:
+        return NULL_SPAN
+    return tracer.span(name, cat, **args)
 
 
-def set_image_size_mode(s):
-    """Set the quality of the images to be downloaded
-    This set the global variable `image_size_mode`
+class FlickrError(Exception):
+    """Error returned by the flickr API in a `"stat": "fail"` payload
 
-    :param s: quality level, 1 is original size, 12 is smallest
-    :type s: str
+    :param code: The error code
+    :type code: int
+    :param message: The error message
+    :type message: str
     """
-    global image_size_mode
-    image_size_mode = s
 
+    # Service currently unavailable, Write operation failed
+    RETRYABLE_CODES = (105, 106)
 
-def _gevent_patch():
-    """Patch the modules with gevent
+    def __init__(self, code, message):
+        super(FlickrError, self).__init__('%s (code %s)' % (message, code))
+        self.code = code
+        self.message = message
 
-    :return: Default is GEVENT. If it not supports gevent then return MULTITHREAD
+    @property
+    def retryable(self):
+        """Whether the request may succeed when it is sent again
+
+        :rtype: bool
+        """
+        message = self.message.lower()
+        return self.code in self.RETRYABLE_CODES or \
+            'rate limit' in message or 'quota' in message
+
+
+class TokenBucket(object):
+    """Limit the rate of calls to `rate` per second with bursts of `burst`
+    calls. It is shared by all workers.
+
+    :param rate: The number of tokens added per second
+    :type rate: float
+    :param burst: The max number of tokens
+    :type burst: int
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token, which may be borrowed from the future
+
+        :return: The seconds to wait before the token can be used
+        :rtype: float
+        """
+        with self._lock:
+            now = time.time()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._last) * self.rate
+            )
+            self._last = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        """Wait until a token is available and take it
+        """
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _get_error_status(error):
+    """Get the HTTP status of the response which caused the error
+
+    :param error: The error raised by a request
+    :type error: Exception
+    :return: The status, None if the error is not caused by a response
     :rtype: int
     """
-    try:
-        assert gevent
-        assert grequests
-    except NameError:
-        logger.warn('gevent not exist, fallback to multiprocess...')
-        return MULTITHREAD
-    else:
-        monkey.patch_all()  # Must patch before get_photos_info
-        return GEVENT
+    resp = getattr(error, 'response', None)
+    # requests errors keep the response, aiohttp errors keep the status
+    return getattr(resp, 'status_code', getattr(error, 'status', None))
 
 
-def main():
-    """The main procedure
+def _is_retryable(error, transient=(IOError, OSError)):
+    """Check whether the request may succeed when it is sent again:
+    429 and 5xx responses, flickr rate limit errors, connection errors,
+    timeouts and incomplete downloads
+
+    :param error: The error raised by a request
+    :type error: Exception
+    :param transient: The error types regarded as transient
+            if they are not caused by a response
+    :type transient: tuple
+    :rtype: bool
     """
+    if isinstance(error, FlickrError):
+        return error.retryable
+    status = _get_error_status(error)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(error, transient)
 
-    init_logger()
-    args = _parse_cli_args()
 
-    if args.u:
-        enter_api_key()
-        return
+def _is_client_error(error):
+    """Check whether the request is refused for good: 4xx responses which
+    are not retryable
 
-    if args.O == GEVENT:
-        args.O = _gevent_patch()
+    :param error: The error raised by a request
+    :type error: Exception
+    :rtype: bool
+    """
+    status = _get_error_status(error)
+    return status is not None and 400 <= status < 500 and \
+        not _is_retryable(error)
 
-    set_image_size_mode(args.s)
-    photoset_id = args.g
-    global directory
-    directory = args.d if args.d else photoset_id
-
-    read_config()
-    photos = get_photos_info(photoset_id)
-    create_dir(directory)
-
-    if args.O == SINGLE_PROCESS:
-        single_download_photos(photos)
-    elif args.O == GEVENT:
-        event_download_photos(photos)
-    elif args.O == MULTITHREAD:
-        multithread_download_photos(photos)
-    else:
-        logger.error('Unknown Error')
+
+def _get_backoff(attempt):
+    """Get the jittered exponential backoff before a retry
+
+    :param attempt: The number of retries done
+    :type attempt: int
+    :return: The seconds to wait
+    :rtype: float
+    """
+    return random.uniform(0, min(RETRY_CAP, RETRY_BASE * 2 ** attempt))
+
+
+def with_retry(func, *args, **kwargs):
+    """Call the function, call it again after a backoff if it raises
+    a retryable error, at most `retries` of the downloader times
+
+    :param func: The function to be called
+    :type func: function
+    :return: The result of the function
+    """
+    retries = get_downloader().retries
+    attempt = 0
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt >= retries or not _is_retryable(e):
+                raise
+            delay = _get_backoff(attempt)
+            logger.warn('%s, retry in %.1f seconds', e, delay)
+            get_metrics().count('retries')
+            time.sleep(delay)
+            attempt += 1
+
+
+def _parse_api_response(text):
+    """Parse the JSON response of the flickr API
+
+    :param text: The response body
+    :type text: str
+    :return: The response
+    :rtype: dict
+    """
+    resp_json = json.loads(text)
+    logger.debug(resp_json)
+    if resp_json.get('stat') == 'fail':
+        raise FlickrError(resp_json.get('code'), resp_json.get('message', ''))
+    return resp_json
+
+
+def _call_api_once(method, **kwargs):
+    """Send a signed flickr API request once, after taking a token
+    from the `api_limiter` of the downloader
+
+    :param method: The method provided by flickr,
+            ex: flickr.photosets.getPhotos
+    :type method: str
+    :param kwargs: Other settings
+    :type kwargs: dict
+    :return: The response
+    :rtype: dict
+    """
+    args = _get_request_args(method, **kwargs)
+    downloader = get_downloader()
+    downloader.api_limiter.acquire()
+    get_metrics().count('api_calls')
+    with trace_span(
+            method, 'api', photo_id=kwargs.get('photo_id'),
+            photoset_id=kwargs.get('photoset_id'),
+            page=kwargs.get('page')) as span:
+        resp = downloader.session.post(
+            downloader.api_url, data=args, timeout=REQUEST_TIMEOUT
+        )
+        span.set(status=resp.status_code, bytes=len(resp.content))
+        resp.raise_for_status()
+    return _parse_api_response(resp.text.encode('utf-8'))
+
+
+def call_api(method, **kwargs):
+    """Send a signed flickr API request, retry it on rate limits and
+    server errors
+
+    :param method: The method provided by flickr,
+            ex: flickr.photosets.getPhotos
+    :type method: str
+    :param kwargs: Other settings
+    :type kwargs: dict
+    :return: The response
+    :rtype: dict
+    """
+    api_cache = get_downloader().api_cache
+    if api_cache is not None:
+        resp_json = api_cache.get(method, kwargs)
+        if resp_json is not None:
+            return resp_json
+    resp_json = with_retry(_call_api_once, method, **kwargs)
+    if api_cache is not None:
+        api_cache.put(method, kwargs, resp_json)
+    return resp_json
+
+
+class ApiCache(object):
+    """The responses of the flickr API stored in a SQLite database, keyed by
+    the method and its arguments without the signature. The responses of
+    each method expire after its TTL in `CACHE_TTLS`, and the least recently
+    used responses are evicted when the total size exceeds `max_size`.
+
+    :param path: The path of the SQLite database
+    :type path: str
+    :param max_size: The max total size in bytes of the responses
+    :type max_size: int
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        import sqlite3
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # A lost update of a cache is harmless, do not wait for the disk
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, method TEXT, response TEXT, '
+            'created REAL, accessed REAL, size INTEGER)'
+        )
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS responses_accessed '
+            'ON responses (accessed)'
+        )
+        self._conn.commit()
+        # Other processes may change it, it is counted again before eviction
+        self._size = self._get_total_size()
+
+    @staticmethod
+    def get_key(method, kwargs):
+        """Get the key of the response
+
+        :param method: The method provided by flickr
+        :type method: str
+        :param kwargs: The arguments of the method
+        :type kwargs: dict
+        :rtype: str
+        """
+        text = json.dumps([
+            get_downloader().api_key, method, sorted(kwargs.items())
+        ])
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def get(self, method, kwargs):
+        """Get the cached response
+
+        :param method: The method provided by flickr
+        :type method: str
+        :param kwargs: The arguments of the method
+        :type kwargs: dict
+        :return: The response, None if it is not cached or expired
+        :rtype: dict
+        """
+        ttl = CACHE_TTLS.get(method)
+        if ttl is None:
+            return None
+        key = self.get_key(method, kwargs)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT response, created FROM responses WHERE key = ?',
+                (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] + ttl < now:
+                self._conn.execute(
+                    'DELETE FROM responses WHERE key = ?', (key,)
+                )
+                self._conn.commit()
+                return None
+            self._conn.execute(
+                'UPDATE responses SET accessed = ? WHERE key = ?', (now, key)
+            )
+            self._conn.commit()
+        get_metrics().count('cache_hits')
+        logger.debug('Cache hit %s %s', method, kwargs)
+        return json.loads(row[0])
+
+    def put(self, method, kwargs, resp_json):
+        """Cache the response if the method is cacheable
+
+        :param method: The method provided by flickr
+        :type method: str
+        :param kwargs: The arguments of the method
+        :type kwargs: dict
+        :param resp_json: The response
+        :type resp_json: dict
+        """
+        if method not in CACHE_TTLS:
+            return
+        key = self.get_key(method, kwargs)
+        response = json.dumps(resp_json)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT size FROM responses WHERE key = ?', (key,)
+            ).fetchone()
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses '
+                '(key, method, response, created, accessed, size) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (key, method, response, now, now, len(response))
+            )
+            self._size += len(response) - (row[0] if row else 0)
+            if self._size > self.max_size:
+                self._evict()
+            self._conn.commit()
+
+    def _get_total_size(self):
+        """Get the total size of the responses in the database
+        """
+        return self._conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses'
+        ).fetchone()[0]
+
+    def _evict(self):
+        """Remove the least recently used responses until the total size
+        is not over the max size
+        """
+        self._size = self._get_total_size()
+        if self._size <= self.max_size:
+            return
+        cursor = self._conn.execute(
+            'SELECT key, size FROM responses ORDER BY accessed'
+        )
+        removed = []
+        for key, size in cursor:
+            if self._size <= self.max_size:
+                break
+            removed.append((key,))
+            self._size -= size
+        cursor.close()
+        self._conn.executemany('DELETE FROM responses WHERE key = ?', removed)
+        logger.debug('Evict %s responses from the API cache', len(removed))
+
+    def close(self):
+        """Close the database
+        """
+        self._conn.close()
+
+
+def create_dir(path):
+    """Create dir with the path
+
+    :param path: The path to be created
+    :type path: str
+    """
+    if os.path.exists(path):
+        if not os.path.isdir(path):
+            logger.error('%s is not a directory', path)
+            sys.exit(1)
+        else:  # ignore
+            pass
+    else:
+        os.makedirs(path)
+        logger.info('Create dir: %s', path)
+
+
+def _get_photoset_page(photoset_id, page):
+    """Request one page of the photos information with the photoset id
+
+    :param photoset_id: The photoset id of flickr
+    :type photoset_id: str
+    :param page: The page number, start from 1
+    :type page: int
+    :return: photoset information include `photo`, `page`, `pages` and `total`
+    :rtype: dict
+    """
+    with get_metrics().timer('list'):
+        resp_json = call_api(
+            'flickr.photosets.getPhotos',
+            photoset_id=photoset_id,
+            extras=PHOTO_EXTRAS,
+            per_page=str(PHOTOS_PER_PAGE),
+            page=str(page)
+        )
+    return resp_json['photoset']
+
+
+def iter_photos_info(photoset_id):
+    """Walk through all pages of the photoset and yield the photos information
+    The next page is requested in background while the photos of the current
+    page are consumed, so downloading can start after the first page arrived.
+    The total of the first page is counted to the metrics.
+
+    :param photoset_id: The photoset id of flickr
+    :type photoset_id: str
+    :return: photos information
+    :rtype: generator of dicts
+    """
+    from concurrent import futures
+    executor = futures.ThreadPoolExecutor(max_workers=1)
+    try:
+        photoset = _get_photoset_page(photoset_id, 1)
+        _count_up(int(photoset['total']))
+        pages = int(photoset['pages'])
+        page = 1
+        while True:
+            next_page = None
+            if page < pages:
+                next_page = executor.submit(
+                    get_job().bind(_get_photoset_page), photoset_id, page + 1
+                )
+            for photo in photoset['photo']:
+                yield photo
+            if next_page is None:
+                break
+            photoset = next_page.result()
+            page += 1
+    finally:
+        executor.shutdown(wait=False)
+
+
+def iter_user_photosets(user_id):
+    """Walk through all pages of the photosets of the user
+
+    :param user_id: The user id of flickr, ex: 12345678@N00
+    :type user_id: str
+    :return: photoset ids
+    :rtype: generator of strs
+    """
+    page = 1
+    while True:
+        resp_json = call_api(
+            'flickr.photosets.getList',
+            user_id=user_id,
+            per_page=str(PHOTOS_PER_PAGE),
+            page=str(page)
+        )
+        photosets = resp_json['photosets']
+        for photoset in photosets['photoset']:
+            yield photoset['id']
+        if page >= int(photosets['pages']):
+            break
+        page += 1
+
+
+def read_photoset_ids(path):
+    """Read the photoset ids from a file, one id per line.
+    Empty lines and lines start with # are ignored.
+
+    :param path: The path of the file
+    :type path: str
+    :return: photoset ids
+    :rtype: list of strs
+    """
+    photoset_ids = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                photoset_ids.append(line)
+    return photoset_ids
+
+
+def get_photos_info(photoset_id):
+    """Request the photos information with the photoset id
+
+    :param photoset_id: The photoset id of flickr
+    :type photoset_id: str
+    :return: photos information
+    :rtype: list
+    """
+    return list(iter_photos_info(photoset_id))
+
+
+class ByteBudget(object):
+    """The number of image bytes a run may still download, shared by
+    all workers
+
+    :param total: The number of bytes
+    :type total: int
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.used = 0
+        # The length of the smallest image seen
+        self.smallest = None
+        self._lock = threading.Lock()
+
+    @property
+    def remaining(self):
+        """The number of bytes not reserved yet
+
+        :rtype: int
+        """
+        with self._lock:
+            return self.total - self.used
+
+    def reserve(self, num):
+        """Take `num` bytes from the budget if it has enough
+
+        :param num: The number of bytes
+        :type num: int
+        :return: Whether the bytes are reserved
+        :rtype: bool
+        """
+        with self._lock:
+            if self.used + num > self.total:
+                return False
+            self.used += num
+            return True
+
+    def observe(self, num):
+        """Record the length of an image seen, accepted or not
+
+        :param num: The number of bytes
+        :type num: int
+        """
+        with self._lock:
+            if self.smallest is None or num < self.smallest:
+                self.smallest = num
+
+    @property
+    def exhausted(self):
+        """Whether the remaining bytes are fewer than the smallest image seen,
+        then the other images are not likely to fit and their lengths are
+        not requested any more
+
+        :rtype: bool
+        """
+        with self._lock:
+            return self.smallest is not None and \
+                self.total - self.used < self.smallest
+
+
+class _WorkerBudget(ByteBudget):
+    """The budget share of a worker process of `-O 4`, the reserved bytes are
+    also counted in a value shared with the main process, so the worker
+    started in place of a dead one only gets what is left of its share
+
+    :param total: The number of bytes of the share
+    :type total: int
+    :param spent: The number of bytes reserved by the worker
+    :type spent: multiprocessing.Value
+    """
+
+    def __init__(self, total, spent):
+        super(_WorkerBudget, self).__init__(total)
+        self._spent = spent
+
+    def reserve(self, num):
+        if not super(_WorkerBudget, self).reserve(num):
+            return False
+        with self._spent.get_lock():
+            self._spent.value += num
+        return True
+
+
+class SizePolicy(object):
+    """Select the size of each photo to be downloaded
+    The sizes of a photo are dicts of `url`, `width` and `height`, ordered
+    from smallest to largest like flickr.photos.getSizes. The selection only
+    depends on the sizes of the photo, so a photo with few sizes does not
+    change the size of other photos.
+
+    :param size_mode: The rank of the largest size allowed, 1 is the largest
+            size of the photo, 2 the second largest and so on
+    :type size_mode: int
+    :param max_pixels: The max width and height of the image, None for no limit
+    :type max_pixels: int
+    :param max_bytes: The max size in bytes of the image, None for no limit
+    :type max_bytes: int
+    :param budget: The bytes the run may download, None for no limit
+    :type budget: ByteBudget
+    """
+
+    def __init__(self, size_mode=1, max_pixels=None, max_bytes=None,
+                 budget=None):
+        self.size_mode = size_mode
+        self.max_pixels = max_pixels
+        self.max_bytes = max_bytes
+        self.budget = budget
+
+    @property
+    def needs_length(self):
+        """Whether the length of the images is needed to select a size,
+        it is requested with a HEAD request
+
+        :rtype: bool
+        """
+        return self.max_bytes is not None or self.budget is not None
+
+    @property
+    def exhausted(self):
+        """Whether the budget is exhausted, see :attr:`ByteBudget.exhausted`,
+        then the photos are skipped without any request
+
+        :rtype: bool
+        """
+        return self.budget is not None and self.budget.exhausted
+
+    def _fits_pixels(self, size):
+        """Check the dimensions of a size against `max_pixels`
+        """
+        if self.max_pixels is None:
+            return True
+        # The size is allowed when flickr does not tell its dimensions
+        return all(
+            size[name] is None or size[name] <= self.max_pixels
+            for name in ('width', 'height')
+        )
+
+    def get_candidates(self, sizes):
+        """Get the sizes allowed by `size_mode` and `max_pixels`,
+        the largest first
+
+        :param sizes: The sizes of the photo
+        :type sizes: list of dicts
+        :rtype: list of dicts
+        """
+        if not sizes:
+            return []
+        index = -min(self.size_mode, len(sizes)) % len(sizes)
+        candidates = [
+            size for size in sizes[:index + 1] if self._fits_pixels(size)
+        ]
+        # Even the smallest size is larger than max_pixels, take it anyway
+        return candidates[::-1] or sizes[:1]
+
+    def accept(self, size, length):
+        """Check the length of a candidate size against `max_bytes`, and
+        reserve it from the budget if it is accepted
+
+        :param size: A candidate size
+        :type size: dict
+        :param length: The length of the image, None if it is unknown
+        :type length: int
+        :return: Whether the size is selected
+        :rtype: bool
+        """
+        if not self.needs_length:
+            return True
+        # An image of unknown length cannot be checked
+        if length is None:
+            return False
+        if self.budget is not None:
+            self.budget.observe(length)
+        if self.max_bytes is not None and length > self.max_bytes:
+            return False
+        return self.budget is None or self.budget.reserve(length)
+
+    def select(self, sizes, get_length=None):
+        """Select the largest candidate size accepted by :meth:`accept`
+
+        :param sizes: The sizes of the photo
+        :type sizes: list of dicts
+        :param get_length: The function returning the length of an image url,
+                only called when :attr:`needs_length`
+        :type get_length: function
+        :return: The size, None if no size fits
+        :rtype: dict
+        """
+        for size in self.get_candidates(sizes):
+            if self.exhausted:
+                return None
+            length = None
+            if self.needs_length:
+                length = get_length(size['url'])
+            if self.accept(size, length):
+                return size
+        return None
+
+    def is_selected(self, sizes, url):
+        """Check whether `url` is still the size the policy would select,
+        used by `--sync` to find the photos to download again
+
+        :param sizes: The sizes of the photo
+        :type sizes: list of dicts
+        :param url: The url of the downloaded size
+        :type url: str
+        :rtype: bool
+        """
+        candidates = self.get_candidates(sizes)
+        if not self.needs_length:
+            return candidates[0]['url'] == url
+        # The lengths are not requested again, any allowed size is kept
+        return any(size['url'] == url for size in candidates)
+
+
+def get_size_policy():
+    """Get the size policy of the current job
+
+    :return: The size policy
+    :rtype: SizePolicy
+    """
+    return get_job().size_policy
+
+
+def _get_dimension(value):
+    """Convert a width or height returned by flickr to int
+
+    :return: The dimension, None if it is missing
+    :rtype: int
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _get_sizes_from_response(resp_json):
+    """Get the sizes from the response of flickr.photos.getSizes
+
+    :param resp_json: The response
+    :type resp_json: dict
+    :return: The sizes, the smallest first
+    :rtype: list of dicts
+    """
+    return [{
+        'url': size['source'],
+        'width': _get_dimension(size.get('width')),
+        'height': _get_dimension(size.get('height')),
+    } for size in resp_json['sizes']['size']]
+
+
+def _get_sizes_from_extras(photo):
+    """Get the sizes from the `url_*`, `width_*` and `height_*` extras of the
+    photo information, in the same order as flickr.photos.getSizes
+
+    :param photo: The photo information returned by flickr.photosets.getPhotos
+    :type photo: dict
+    :return: The sizes, empty if the photo has no url extras
+    :rtype: list of dicts
+    """
+    return [{
+        'url': photo['url_' + suffix],
+        'width': _get_dimension(photo.get('width_' + suffix)),
+        'height': _get_dimension(photo.get('height_' + suffix)),
+    } for suffix in SIZE_SUFFIXES if photo.get('url_' + suffix)]
+
+
+def get_photo_sizes(photo_id):
+    """Request the sizes of the photo with the photo id
+
+    :param photo_id: The photo id of flickr
+    :type photo_id: str
+    :return: The sizes, the smallest first
+    :rtype: list of dicts
+    """
+    resp_json = call_api(
+        'flickr.photos.getSizes',
+        photo_id=photo_id
+    )
+    return _get_sizes_from_response(resp_json)
+
+
+def _head_content_length(url):
+    """Send a HEAD request and get the length of the image from it
+    """
+    with trace_span('HEAD', 'http', url=url) as span:
+        resp = get_session().head(
+            url, allow_redirects=True, timeout=REQUEST_TIMEOUT
+        )
+        span.set(status=resp.status_code)
+    if resp.status_code in HEAD_NOT_ALLOWED:
+        return None
+    resp.raise_for_status()
+    return _get_content_length(resp)
+
+
+def get_image_length(url):
+    """Request the length of the image with a HEAD request
+
+    :param url: The url of the image
+    :type url: str
+    :return: The number of bytes, None if the server does not tell it
+    :rtype: int
+    """
+    return with_retry(_head_content_length, url)
+
+
+def get_photo_url(photo_id):
+    """Request the photo download url with the photo id
+
+    :param photo_id: The photo id of flickr
+    :type photo_id: str
+    :return: Photo download url, None if no size fits the size policy
+    :rtype: str
+    """
+    size = get_size_policy().select(
+        get_photo_sizes(photo_id), get_image_length
+    )
+    return size['url'] if size is not None else None
+
+
+def resolve_photo_url(photo):
+    """Get the download url of the photo
+    Use the url extras if exist, otherwise request the sizes with
+    flickr.photos.getSizes
+
+    :param photo: The photo information include id and title
+    :type photo: dict
+    :return: Photo download url, None if no size fits the size policy
+    :rtype: str
+    """
+    if get_size_policy().exhausted:
+        return None
+    sizes = _get_sizes_from_extras(photo)
+    if not sizes:
+        return get_photo_url(photo['id'])
+    size = get_size_policy().select(sizes, get_image_length)
+    return size['url'] if size is not None else None
+
+
+def save_response(resp, part_path, mode='wb', hasher=None, offset=None):
+    """Stream the response body to `part_path` chunk by chunk
+
+    :param resp: The response requested with `stream=True`
+    :type resp: requests.Response
+    :param part_path: The path of the partial photo file
+    :type part_path: str
+    :param mode: 'wb' to write from the start, 'ab' to append to a partial file
+    :type mode: str
+    :param hasher: The hash object updated with the written chunks
+    :type hasher: hashlib hash object
+    :param offset: Write from this position of the existing file instead,
+            used by the segments of a photo
+    :type offset: int
+    :return: The number of bytes written
+    :rtype: int
+    """
+    job = get_job()
+    tracer = job.tracer
+    nbytes = 0
+    write_time = 0.0
+    try:
+        with open(part_path, mode if offset is None else 'r+b') as f:
+            if offset is not None:
+                f.seek(offset)
+            for chunk in resp.iter_content(job.chunk_size):
+                start = time.time()
+                if tracer is None:
+                    f.write(chunk)
+                else:
+                    with tracer.span('write', 'disk', bytes=len(chunk)):
+                        f.write(chunk)
+                write_time += time.time() - start
+                nbytes += len(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+            start = time.time()
+            if job.fsync:
+                with trace_span('fsync', 'disk'):
+                    f.flush()
+                    os.fsync(f.fileno())
+            write_time += time.time() - start
+    finally:
+        resp.close()
+        job.metrics.count('bytes', nbytes)
+        job.metrics.observe('write', write_time)
+    return nbytes
+
+
+def hash_file(file_path, hasher=None):
+    """Hash the content of the file
+
+    :param file_path: The path of the file
+    :type file_path: str
+    :param hasher: The hash object to be updated, default is a new md5
+    :type hasher: hashlib hash object
+    :return: The updated hash object
+    :rtype: hashlib hash object
+    """
+    if hasher is None:
+        hasher = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(get_job().chunk_size), b''):
+            hasher.update(chunk)
+    return hasher
+
+
+def _get_range_total(resp):
+    """Get the complete length from the Content-Range header of the response
+
+    :param resp: The response of a range request
+    :type resp: requests.Response
+    :return: The complete length, None if it is unknown
+    :rtype: int
+    """
+    total = resp.headers.get('Content-Range', '').rpartition('/')[2]
+    return int(total) if total.isdigit() else None
+
+
+def _get_range_start(resp):
+    """Get the first byte position from the Content-Range header of the response
+
+    :param resp: The response of a range request
+    :type resp: requests.Response
+    :return: The first byte position, None if it is unknown
+    :rtype: int
+    """
+    content_range = resp.headers.get('Content-Range', '')
+    start = content_range.partition(' ')[2].partition('-')[0]
+    return int(start) if start.isdigit() else None
+
+
+def _get_range_end(resp):
+    """Get the last byte position from the Content-Range header of the response
+
+    :param resp: The response of a range request
+    :type resp: requests.Response
+    :return: The last byte position, None if it is unknown
+    :rtype: int
+    """
+    content_range = resp.headers.get('Content-Range', '')
+    end = content_range.partition('-')[2].partition('/')[0]
+    return int(end) if end.isdigit() else None
+
+
+def _is_first_segment(resp, offset):
+    """Check whether the response of a download from the start has only the
+    start of the photo, so the photo is to be downloaded in segments
+
+    :param resp: The response of a range request
+    :type resp: requests.Response
+    :param offset: The position the download starts from
+    :type offset: int
+    :rtype: bool
+    """
+    total = _get_range_total(resp)
+    end = _get_range_end(resp)
+    return not offset and total is not None and end is not None and \
+        end + 1 < total
+
+
+def _split_range(start, end, num):
+    """Split the bytes from `start` to `end` (exclusive) into `num` ranges
+
+    :return: `(start, end)` of each range, `end` is exclusive
+    :rtype: list of tuples
+    """
+    num = max(1, min(num, end - start))
+    bounds = [start + (end - start) * index // num for index in range(num + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class RangeNotSupported(ValueError):
+    """A Range request is not answered with the range, the photo is
+    downloaded in one stream instead. It is not retried.
+    """
+
+
+def _get_content_length(resp):
+    """Get the number of body bytes to be written from the response
+
+    :param resp: The response requested with `stream=True`
+    :type resp: requests.Response
+    :return: The length, None if it is unknown or the body is encoded
+    :rtype: int
+    """
+    length = resp.headers.get('Content-Length', '')
+    if 'Content-Encoding' in resp.headers or not length.isdigit():
+        return None
+    return int(length)
+
+
+def download_file(download_url, file_path, get=None, hasher=None,
+                  segmented=True):
+    """Download the url to `file_path` through a `.part` file
+    An existing `.part` file is completed with a Range request. The `.part`
+    file is renamed to `file_path` only after its size matches the length
+    reported by the server, so an existing `file_path` is always complete
+    and costs no request at all.
+    A new download asks for at most `job.segment_threshold` bytes if the job
+    has many segments, a larger photo is downloaded by
+    :func:`download_segments` instead.
+
+    :param download_url: The url of the photo
+    :type download_url: str
+    :param file_path: The path of the photo file
+    :type file_path: str
+    :param get: The function used to send the GET request,
+            default is the `get` of the shared session
+    :type get: function
+    :param hasher: The hash object updated with the whole content of
+            `file_path` if it is downloaded
+    :type hasher: hashlib hash object
+    :param segmented: Whether a large photo may be downloaded in segments
+    :type segmented: bool
+    :return: False if `file_path` already exists, otherwise True
+    :rtype: bool
+    """
+    if os.path.exists(file_path):
+        return False
+    if get is None:
+        get = get_session().get
+    job = get_job()
+    part_path = file_path + PART_SUFFIX
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {}
+    if offset:
+        headers['Range'] = 'bytes=%d-' % offset
+    elif segmented and job.segments > 1:
+        headers['Range'] = 'bytes=0-%d' % (job.segment_threshold - 1)
+    with trace_span('GET', 'http', url=download_url, offset=offset) as span:
+        resp = get(
+            download_url, headers=headers, stream=True,
+            timeout=REQUEST_TIMEOUT
+        )
+        span.set(status=resp.status_code)
+    if resp.status_code == 416:
+        resp.close()
+        if _get_range_total(resp) != offset:
+            # The part file is larger than the photo, start over, or the
+            # first segment is refused, then the photo is asked in one stream
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            return download_file(
+                download_url, file_path, get, hasher, segmented and offset > 0
+            )
+        if not os.path.exists(part_path):
+            # An empty photo has no byte to be asked for
+            open(part_path, 'wb').close()
+        expected = offset
+        if hasher is not None:
+            hash_file(part_path, hasher)
+    else:
+        resp.raise_for_status()
+        if resp.status_code == 206:
+            if _get_range_start(resp) != offset:
+                resp.close()
+                raise IOError('Unexpected Content-Range of %s: %s' % (
+                    download_url, resp.headers.get('Content-Range')
+                ))
+            if _is_first_segment(resp, offset):
+                return download_segments(
+                    resp, download_url, file_path, get, hasher
+                )
+            expected = _get_range_total(resp)
+            if offset and hasher is not None:
+                hash_file(part_path, hasher)
+            mode = 'ab' if offset else 'wb'
+        else:
+            expected = _get_content_length(resp)
+            mode = 'wb'
+        with trace_span('body', 'http', url=download_url) as span:
+            span.set(bytes=save_response(resp, part_path, mode, hasher))
+    size = os.path.getsize(part_path)
+    if expected is not None and size != expected:
+        raise IOError('Incomplete download of %s: %s of %s bytes' % (
+            download_url, size, expected
+        ))
+    with trace_span('rename', 'disk'):
+        os.rename(part_path, file_path)
+    return True
+
+
+def _download_segment(download_url, segments_path, start, end, get):
+    """Download the bytes from `start` to `end` (exclusive) of the photo
+    into their place in `segments_path`
+
+    :param download_url: The url of the photo
+    :type download_url: str
+    :param segments_path: The path of the preallocated segments file
+    :type segments_path: str
+    :param start: The first byte position
+    :type start: int
+    :param end: The position after the last byte
+    :type end: int
+    :param get: The function used to send the GET request
+    :type get: function
+    :raise RangeNotSupported: The response is not the range
+    :return: The number of bytes written
+    :rtype: int
+    """
+    with trace_span('GET', 'http', url=download_url, offset=start) as span:
+        resp = get(
+            download_url, headers={'Range': 'bytes=%d-%d' % (start, end - 1)},
+            stream=True, timeout=REQUEST_TIMEOUT
+        )
+        span.set(status=resp.status_code)
+    resp.raise_for_status()
+    if resp.status_code != 206 or _get_range_start(resp) != start or \
+            _get_range_end(resp) != end - 1:
+        resp.close()
+        raise RangeNotSupported('Unexpected range of %s: %s %s' % (
+            download_url, resp.status_code, resp.headers.get('Content-Range')
+        ))
+    with trace_span('body', 'http', url=download_url) as span:
+        nbytes = save_response(resp, segments_path, offset=start)
+        span.set(bytes=nbytes)
+    if nbytes != end - start:
+        raise IOError('Incomplete segment of %s: %s of %s bytes' % (
+            download_url, nbytes, end - start
+        ))
+    return nbytes
+
+
+def download_segments(resp, download_url, file_path, get=None, hasher=None):
+    """Download a large photo in concurrent Range segments, `resp` is the
+    response of the first request, which tells the length of the photo. It
+    is closed and the whole photo is split into `job.segments` equal
+    segments, so no stream carries more than its share. The first segment
+    is downloaded by this thread and the others by their own threads, each
+    retried on its own and written into its place in a preallocated
+    `.segments` file. The file is renamed to `file_path` only after every
+    segment is complete and its size is the length reported by the server,
+    and is removed if the download fails. The photo is downloaded in one
+    stream instead if a segment is not answered with its range.
+
+    :param resp: The response of the first request
+    :type resp: requests.Response
+    :param download_url: The url of the photo
+    :type download_url: str
+    :param file_path: The path of the photo file
+    :type file_path: str
+    :param get: The function used to send the GET requests
+    :type get: function
+    :param hasher: The hash object updated with the whole content of
+            `file_path`
+    :type hasher: hashlib hash object
+    :return: True
+    :rtype: bool
+    """
+    job = get_job()
+    if get is None:
+        get = get_session().get
+    total = _get_range_total(resp)
+    resp.close()
+    segments_path = file_path + SEGMENTS_SUFFIX
+    with open(segments_path, 'wb') as f:
+        f.truncate(total)
+    errors = []
+
+    def fetch(start, end):
+        try:
+            with_retry(
+                _download_segment, download_url, segments_path, start, end,
+                get
+            )
+        except Exception as e:
+            errors.append(e)
+
+    ranges = _split_range(0, total, job.segments)
+    workers = []
+    try:
+        for start, end in ranges[1:]:
+            worker = threading.Thread(
+                target=job.bind(fetch), args=(start, end)
+            )
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        fetch(*ranges[0])
+    finally:
+        for worker in workers:
+            worker.join()
+    if any(isinstance(error, RangeNotSupported) for error in errors):
+        logger.warning(
+            'Range requests of %s are not supported, '
+            'download it in one stream', download_url
+        )
+        os.remove(segments_path)
+        return download_file(
+            download_url, file_path, get, hasher, segmented=False
+        )
+    try:
+        if errors:
+            raise errors[0]
+        size = os.path.getsize(segments_path)
+        if size != total:
+            raise IOError('Incomplete download of %s: %s of %s bytes' % (
+                download_url, size, total
+            ))
+        if hasher is not None:
+            hash_file(segments_path, hasher)
+        with trace_span('rename', 'disk'):
+            os.rename(segments_path, file_path)
+    except Exception:
+        # A segments file has holes, it is not resumed
+        if os.path.isfile(segments_path):
+            os.remove(segments_path)
+        raise
+    return True
+
+
+def _grequests_get(url, **kwargs):
+    """Send a GET request with grequests through the shared session
+
+    :param url: The url to be requested
+    :type url: str
+    :param kwargs: Other arguments of the request
+    :type kwargs: dict
+    :return: The response
+    :rtype: requests.Response
+    """
+    req = grequests.get(url, session=get_session(), **kwargs)
+    resp = grequests.map([req])[0]
+    if resp is None:
+        raise IOError('Failed to request %s' % url)
+    return resp
+
+
+def _remove_file(file_path):
+    """Remove the file if it exists
+
+    :param file_path: The path of the file
+    :type file_path: str
+    """
+    if os.path.isfile(file_path):
+        os.remove(file_path)
+        logger.info('Remove %s', file_path)
+
+
+class Photoset(object):
+    """A photoset to be downloaded into a directory
+    Every photo listed by :func:`iter_photosets_photos` refers to its
+    photoset, so photos of many photosets can share one pipeline.
+
+    :param photoset_id: The photoset id of flickr
+    :type photoset_id: str
+    :param directory: The directory of the photo files
+    :type directory: str
+    :param manifest: The manifest of the directory in the `--sync` mode
+    :type manifest: Manifest
+    """
+
+    def __init__(self, photoset_id, directory, manifest=None):
+        self.id = photoset_id
+        self.directory = directory
+        self.manifest = manifest
+        self.photo_ids = set()
+        self.listed = False
+
+
+def _get_photoset(photo):
+    """Get the photoset of the photo
+
+    :param photo: The photo information
+    :type photo: dict
+    :return: The photoset the photo is listed from, default is the first
+            photoset of the current job, or the current directory
+    :rtype: Photoset
+    """
+    photoset = photo.get(PHOTOSET_KEY)
+    if photoset is None:
+        photosets = get_job().photosets
+        photoset = photosets[0] if photosets else Photoset(None, os.curdir)
+    return photoset
+
+
+def _get_photo_file_name(photo, download_url):
+    """Get the file name of the photo, its title with the format of the url
+
+    :param photo: The photo information include title
+    :type photo: dict
+    :param download_url: Photo download url
+    :type download_url: str
+    :return: The file name
+    :rtype: str
+    """
+    photo_format = download_url.split('.')[-1]
+    return photo['title'] + '.' + photo_format
+
+
+def _remove_stale_photo(photo, file_path):
+    """Remove the files of a photo recorded in the manifest, it has changed
+    since the last sync
+
+    :param photo: The photo information include id
+    :type photo: dict
+    :param file_path: The path of the photo file to be downloaded
+    :type file_path: str
+    """
+    photoset = _get_photoset(photo)
+    row = photoset.manifest.get(photo['id'])
+    if row is not None:
+        _remove_file(photoset.directory + os.sep + row['file_name'])
+        _remove_file(file_path)
+
+
+def _record_photo(photo, download_url, photo_title, checksum=None):
+    """Record a downloaded photo to the manifest
+
+    :param photo: The photo information include id and lastupdate
+    :type photo: dict
+    :param download_url: Photo download url
+    :type download_url: str
+    :param photo_title: The file name of the photo
+    :type photo_title: str
+    :param checksum: The md5 of the file computed while downloading,
+            the file is read back to compute it if it is None
+    :type checksum: str
+    """
+    photoset = _get_photoset(photo)
+    file_path = photoset.directory + os.sep + photo_title
+    if checksum is None:
+        checksum = hash_file(file_path).hexdigest()
+    photoset.manifest.update(
+        photo, download_url, photo_title,
+        os.path.getsize(file_path), checksum
+    )
+
+
+def resolve_photo(photo):
+    """The first stage of downloading a photo: skip it if it is not changed
+    since the last sync or the job is cancelled, otherwise resolve its
+    download url and file name, a planned photo has them already
+
+    :param photo: The photo information include id and title
+    :type photo: dict
+    :return: (download url, file name), None if the photo is skipped
+    :rtype: tuple
+    """
+    if get_job().cancelled:
+        return None
+    if PLAN_KEY in photo:
+        return photo[PLAN_KEY]
+    photoset = _get_photoset(photo)
+    with get_metrics().timer('resolve'), \
+            trace_span('resolve', 'photo', photo_id=photo['id']):
+        if photoset.manifest is not None and \
+                photoset.manifest.is_synced(photo, photoset.directory):
+            logger.info('Skip %s, not changed', _log_text(photo['title']))
+            get_metrics().count('skipped')
+            return None
+        download_url = resolve_photo_url(photo)
+    if download_url is None:
+        logger.info('Skip %s, no size fits the size policy',
+                    _log_text(photo['title']))
+        get_metrics().count('skipped')
+        return None
+    return download_url, _get_photo_file_name(photo, download_url)
+
+
+def _download_file_with_md5(download_url, file_path, get=None):
+    """Download the url to `file_path` with :func:`download_file` and compute
+    the md5 of the file, a new md5 is used by every retry
+
+    :param download_url: The url of the photo
+    :type download_url: str
+    :param file_path: The path of the photo file
+    :type file_path: str
+    :param get: The function used to send the GET request
+    :type get: function
+    :return: (whether it is downloaded, md5 of the file)
+    :rtype: tuple
+    """
+    hasher = hashlib.md5()
+    downloaded = download_file(download_url, file_path, get, hasher)
+    return downloaded, hasher
+
+
+def _fetch_photo(photo, download_url, file_path, get=None):
+    """Download the photo to `file_path`, or link it from the content store
+    if the store has it
+
+    :param photo: The photo information include id and secret
+    :type photo: dict
+    :param download_url: Photo download url
+    :type download_url: str
+    :param file_path: The path of the photo file
+    :type file_path: str
+    :param get: The function used to send the GET request of the image
+    :type get: function
+    :return: (whether it is downloaded or linked, the md5 of the file if
+            known, whether it is linked)
+    :rtype: tuple
+    """
+    content_store = get_downloader().content_store
+    if content_store is None:
+        if _get_photoset(photo).manifest is None:
+            downloaded = with_retry(download_file, download_url, file_path, get)
+            return downloaded, None, False
+        downloaded, hasher = with_retry(
+            _download_file_with_md5, download_url, file_path, get
+        )
+        return downloaded, hasher.hexdigest() if downloaded else None, False
+    if os.path.exists(file_path):
+        return False, None, False
+    key = content_store.get_key(photo, download_url)
+    with content_store.lock(key):
+        checksum = content_store.link(key, file_path)
+        if checksum is not None:
+            get_metrics().count('linked')
+            return True, checksum, True
+        downloaded, hasher = with_retry(
+            _download_file_with_md5, download_url, file_path, get
+        )
+        if not downloaded:
+            return False, None, False
+        content_store.add(key, file_path, hasher.hexdigest())
+        return True, hasher.hexdigest(), False
+
+
+def plan_photo(photo, download_url, photo_title):
+    """The second stage of `gf plan`: request the length of the image and
+    add the photo to the plan of the job instead of downloading it
+
+    :param photo: The photo information include id and title
+    :type photo: dict
+    :param download_url: Photo download url
+    :type download_url: str
+    :param photo_title: The file name of the photo
+    :type photo_title: str
+    """
+    file_path = _get_photoset(photo).directory + os.sep + photo_title
+    with get_metrics().timer('transfer'), \
+            trace_span('plan', 'photo', photo_id=photo['id']):
+        try:
+            size = get_image_length(download_url)
+        except Exception as e:
+            # Planned without a size, fetch finds whether the url works
+            if not _is_client_error(e):
+                raise
+            logger.warning('Plan %s without a size: %s', _log_text(
+                photo['title']
+            ), e)
+            size = None
+    get_job().plan.add(_get_plan_entry(photo, download_url, file_path, size))
+
+
+def transfer_photo(photo, download_url, photo_title, get=None):
+    """The second stage of downloading a photo: download the image to the
+    directory of its photoset, record it to the manifest if any, hand it
+    over to the sink of the job and to its post-processing if any, or add
+    it to the plan of `gf plan`
+
+    :param photo: The photo information include id and title
+    :type photo: dict
+    :param download_url: Photo download url
+    :type download_url: str
+    :param photo_title: The file name of the photo
+    :type photo_title: str
+    :param get: The function used to send the GET request of the image
+    :type get: function
+    :return: The size of the downloaded file, 0 if it is already downloaded,
+            linked from the content store, planned or the job is cancelled
+    :rtype: int
+    """
+    if get_job().cancelled:
+        get_metrics().count('skipped')
+        return 0
+    if get_job().plan is not None:
+        plan_photo(photo, download_url, photo_title)
+        return 0
+    if get_job().dry_run:
+        logger.info(
+            'Would download %s from %s', _log_text(photo_title), download_url
+        )
+        return 0
+    photoset = _get_photoset(photo)
+    sink = get_job().sink
+    file_path = photoset.directory + os.sep + photo_title
+    logger.info('Download %s...', _log_text(photo_title))
+    with get_metrics().timer('transfer'), \
+            trace_span('transfer', 'photo', photo_id=photo['id']) as span:
+        if photoset.manifest is not None:
+            _remove_stale_photo(photo, file_path)
+        written = sink.contains(file_path)
+        downloaded, checksum, linked = False, None, False
+        if not written:
+            downloaded, checksum, linked = _fetch_photo(
+                photo, download_url, file_path, get
+            )
+        if photoset.manifest is not None:
+            _record_photo(photo, download_url, photo_title, checksum)
+        size = os.path.getsize(file_path) if downloaded else 0
+        if not written:
+            sink.add(file_path)
+        span.set(linked=linked)
+        if downloaded and not linked:
+            span.set(bytes=size)
+    if get_job().post is not None:
+        from grabflickr import post
+        # It waits while the post-processing falls behind
+        get_job().post.submit(
+            post.create_task(photo, download_url, file_path, checksum)
+        )
+    if linked:
+        logger.info('Link %s from the store', _log_text(photo_title))
+        return 0
+    if not downloaded:
+        if photoset.manifest is None:
+            logger.info('Skip %s, already downloaded', _log_text(photo_title))
+        get_metrics().count('skipped')
+        return 0
+    return size
+
+
+def record_failure(photo, error):
+    """Record a photo failed to download after all retries,
+    they are reported at the end of the run
+
+    :param photo: The photo information include id and title
+    :type photo: dict
+    :param error: The error
+    :type error: Exception
+    """
+    logger.error('Failed to download %s: %s', _log_text(photo['title']), error)
+    get_metrics().count('failed')
+    get_job().add_failure(photo, error)
+
+
+def report_failures():
+    """Log the photos failed to download
+
+    :return: The number of failed photos
+    :rtype: int
+    """
+    failures = get_job().failures
+    for photo, error in failures:
+        logger.error(
+            'Not downloaded: %s (id %s): %s',
+            _log_text(photo['title']), photo['id'], error
+        )
+    if failures:
+        logger.error('%s photos failed to download', len(failures))
+    return len(failures)
+
+
+def _count_up(num):
+    """Count the photos listed to the metrics
+
+    :param num: The number of photos
+    :type num: int
+    """
+    get_metrics().count('listed', num)
+
+
+def _count_down():
+    """Count one photo as done to the metrics
+
+    :return: The number of photos remaining
+    :rtype: int
+    """
+    get_metrics().count('done')
+    return get_metrics().remaining()
+
+
+def _download_photo(photo, get=None):
+    """Download a photo to the directory of its photoset
+    With a manifest (the `--sync` mode) unchanged photos are skipped before
+    their url is resolved, and downloaded photos are recorded to it.
+
+    :param photo: The photo information include id and title
+    :type photo: dict
+    :param get: The function used to send the GET request of the image
+    :type get: function
+    """
+    try:
+        resolved = resolve_photo(photo)
+        if resolved is not None:
+            transfer_photo(photo, resolved[0], resolved[1], get)
+    except Exception as e:
+        record_failure(photo, e)
+    logger.info(
+        'The number of pictures remaining: %s', _count_down()
+    )
+
+
+def download_photo_async(photo):
+    """Download a photo to the directory of its photoset
+    with grequests
+
+    :param photo: The photo information include id and title
+    :type photo: dict
+    """
+    _download_photo(photo, _grequests_get)
+
+
+def download_photo(photo):
+    """Download a photo to the directory of its photoset
+
+    :param photo: The photo information include id and title
+    :type photo: dict
+    """
+    _download_photo(photo)
+
+
+class Manifest(object):
+    """The index of the photos downloaded into a directory, used by `--sync`
+    It is stored in a SQLite database keyed by photo id, with the last update
+    time, the chosen url, the file name, the size and the md5 of each photo.
+
+    :param path: The path of the SQLite database
+    :type path: str
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        import sqlite3
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS photos ('
+            'id TEXT PRIMARY KEY, lastupdate TEXT, url TEXT, '
+            'file_name TEXT, size INTEGER, checksum TEXT)'
+        )
+        self._conn.commit()
+        self._rows = {}
+        cursor = self._conn.execute(
+            'SELECT %s FROM photos' % ', '.join(MANIFEST_COLUMNS)
+        )
+        for row in cursor:
+            self._rows[row[0]] = dict(zip(MANIFEST_COLUMNS, row))
+
+    def get(self, photo_id):
+        """Get the record of the photo
+
+        :param photo_id: The photo id of flickr
+        :type photo_id: str
+        :return: The record, None if the photo is not recorded
+        :rtype: dict
+        """
+        return self._rows.get(photo_id)
+
+    def is_synced(self, photo, directory):
+        """Check whether the photo is downloaded and not changed since then
+
+        :param photo: The photo information include id and lastupdate
+        :type photo: dict
+        :param directory: The directory of the photo files
+        :type directory: str
+        :rtype: bool
+        """
+        row = self._rows.get(photo['id'])
+        if row is None or row['lastupdate'] != photo.get('lastupdate'):
+            return False
+        sizes = _get_sizes_from_extras(photo)
+        if sizes and not get_size_policy().is_selected(sizes, row['url']):
+            return False
+        file_path = directory + os.sep + row['file_name']
+        return os.path.isfile(file_path) and \
+            os.path.getsize(file_path) == row['size']
+
+    def update(self, photo, url, file_name, size, checksum):
+        """Record a downloaded photo
+
+        :param photo: The photo information include id and lastupdate
+        :type photo: dict
+        :param url: The download url of the photo
+        :type url: str
+        :param file_name: The file name of the photo in the directory
+        :type file_name: str
+        :param size: The file size
+        :type size: int
+        :param checksum: The md5 of the file
+        :type checksum: str
+        """
+        row = dict(zip(MANIFEST_COLUMNS, (
+            photo['id'], photo.get('lastupdate'), url, file_name, size,
+            checksum
+        )))
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO photos (%s) VALUES (?, ?, ?, ?, ?, ?)'
+                % ', '.join(MANIFEST_COLUMNS),
+                [row[column] for column in MANIFEST_COLUMNS]
+            )
+            self._conn.commit()
+            self._rows[photo['id']] = row
+
+    def prune(self, photo_ids, directory):
+        """Remove the photos not in `photo_ids` from the directory and the index
+
+        :param photo_ids: The ids of the photos still in the photoset
+        :type photo_ids: set
+        :param directory: The directory of the photo files
+        :type directory: str
+        :return: The number of removed photos
+        :rtype: int
+        """
+        removed = [
+            row for photo_id, row in self._rows.items()
+            if photo_id not in photo_ids
+        ]
+        with self._lock:
+            for row in removed:
+                _remove_file(directory + os.sep + row['file_name'])
+                self._conn.execute(
+                    'DELETE FROM photos WHERE id = ?', (row['id'],)
+                )
+                del self._rows[row['id']]
+            self._conn.commit()
+        return len(removed)
+
+    def close(self):
+        """Close the database
+        """
+        self._conn.close()
+
+
+def _link_file(src_path, dst_path):
+    """Hardlink `dst_path` to `src_path`, replace `dst_path` if it exists.
+    The file is copied instead if it can not be linked, ex: the paths are
+    on different file systems.
+
+    :param src_path: The path of the existing file
+    :type src_path: str
+    :param dst_path: The path of the link
+    :type dst_path: str
+    """
+    tmp_path = dst_path + PART_SUFFIX
+    _remove_file(tmp_path)
+    try:
+        os.link(src_path, tmp_path)
+    except (OSError, AttributeError):
+        shutil.copyfile(src_path, tmp_path)
+    os.rename(tmp_path, dst_path)
+
+
+class ContentStore(object):
+    """The photos stored once and hardlinked into the photoset directories,
+    used by `--store`. Every photo is keyed by its id, secret and size, and
+    stored in a file named by the md5 of its content computed while
+    downloading. So a photo in many photosets is downloaded once, and the
+    same content is stored once. The linked files share their content, a
+    photo edited in place is changed in every photoset.
+
+    :param path: The directory of the store
+    :type path: str
+    """
+
+    def __init__(self, path):
+        self.path = path
+        create_dir(os.path.join(path, STORE_OBJECTS))
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        import sqlite3
+        self._conn = sqlite3.connect(
+            os.path.join(path, STORE_INDEX), check_same_thread=False
+        )
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS photos ('
+            'key TEXT PRIMARY KEY, checksum TEXT, size INTEGER)'
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def get_key(photo, download_url):
+        """Get the key of the photo in a size
+
+        :param photo: The photo information include id and secret
+        :type photo: dict
+        :param download_url: Photo download url, its file name has the size
+        :type download_url: str
+        :return: ex: 123/abc/123_abc_o.jpg
+        :rtype: str
+        """
+        return '%s/%s/%s' % (
+            photo['id'], photo.get('secret', ''),
+            download_url.rsplit('/', 1)[-1]
+        )
+
+    def get_object_path(self, checksum):
+        """Get the path of the stored content
+
+        :param checksum: The md5 of the content
+        :type checksum: str
+        :rtype: str
+        """
+        return os.path.join(self.path, STORE_OBJECTS, checksum[:2], checksum)
+
+    def lock(self, key):
+        """Get the lock of the key, held while the photo is being fetched
+        so it is not downloaded twice at the same time. The lock is dropped
+        when no thread holds or waits for it::
+
+            with content_store.lock(key):
+                checksum = content_store.link(key, file_path)
+
+        :param key: The key from :meth:`get_key`
+        :type key: str
+        :rtype: context manager
+        """
+        return _KeyLock(self._lock, self._key_locks, key)
+
+    def link(self, key, file_path):
+        """Link the stored photo of the key to `file_path`
+
+        :param key: The key from :meth:`get_key`
+        :type key: str
+        :param file_path: The path of the photo file
+        :type file_path: str
+        :return: The md5 of the photo, None if it is not stored
+        :rtype: str
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT checksum, size FROM photos WHERE key = ?', (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        object_path = self.get_object_path(row[0])
+        if not os.path.isfile(object_path) or \
+                os.path.getsize(object_path) != row[1]:
+            return None
+        _link_file(object_path, file_path)
+        return row[0]
+
+    def add(self, key, file_path, checksum):
+        """Add a downloaded photo to the store. If the same content is
+        stored already, `file_path` is replaced by a link to it.
+
+        :param key: The key from :meth:`get_key`
+        :type key: str
+        :param file_path: The path of the downloaded photo file
+        :type file_path: str
+        :param checksum: The md5 of the photo
+        :type checksum: str
+        """
+        size = os.path.getsize(file_path)
+        object_path = self.get_object_path(checksum)
+        if os.path.isfile(object_path) or \
+                not self._create_object(file_path, object_path):
+            if os.path.getsize(object_path) == size:
+                _link_file(object_path, file_path)
+            else:
+                # A broken object, replace it
+                _link_file(file_path, object_path)
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO photos (key, checksum, size) '
+                'VALUES (?, ?, ?)', (key, checksum, size)
+            )
+            self._conn.commit()
+
+    @staticmethod
+    def _create_object(file_path, object_path):
+        """Store the content of `file_path` unless the object exists. The
+        object is linked in place in one step, so photos of the same content
+        added at the same time, by other keys or other processes of `-O 4`,
+        share the object created first.
+
+        :param file_path: The path of the downloaded photo file
+        :type file_path: str
+        :param object_path: The path from :meth:`get_object_path`
+        :type object_path: str
+        :return: Whether the object is created, False if it exists
+        :rtype: bool
+        """
+        create_dir(os.path.dirname(object_path))
+        tmp_path = '%s.%s-%s' % (
+            object_path, os.getpid(), threading.current_thread().ident
+        )
+        _link_file(file_path, tmp_path)
+        try:
+            os.link(tmp_path, object_path)
+        except (OSError, AttributeError) as e:
+            if getattr(e, 'errno', None) == errno.EEXIST:
+                return False
+            # Links are not supported, the copy is moved in place instead
+            os.rename(tmp_path, object_path)
+            return True
+        finally:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+        return True
+
+    def close(self):
+        """Close the index
+        """
+        self._conn.close()
+
+
+class _KeyLock(object):
+    """Context manager holding the lock of a key of :class:`ContentStore`.
+    The locks are counted by their users, the lock of a key is removed once
+    the last user releases it, so the locks do not grow with the photos.
+
+    :param lock: The lock guarding `locks`
+    :type lock: threading.Lock
+    :param locks: The `[lock, users]` of the keys
+    :type locks: dict
+    :param key: The key
+    :type key: str
+    """
+
+    def __init__(self, lock, locks, key):
+        self._lock = lock
+        self._locks = locks
+        self._key = key
+        self._entry = None
+
+    def acquire(self, blocking=True):
+        """Acquire the lock of the key
+
+        :param blocking: Whether to wait for the lock
+        :type blocking: bool
+        :return: Whether the lock is acquired
+        :rtype: bool
+        """
+        with self._lock:
+            self._entry = self._locks.setdefault(
+                self._key, [threading.Lock(), 0]
+            )
+            self._entry[1] += 1
+        if self._entry[0].acquire(blocking):
+            return True
+        self._leave()
+        return False
+
+    def release(self):
+        """Release the lock of the key
+        """
+        self._entry[0].release()
+        self._leave()
+
+    def _leave(self):
+        """Stop using the lock, remove it if it is not used any more
+        """
+        with self._lock:
+            self._entry[1] -= 1
+            if not self._entry[1]:
+                del self._locks[self._key]
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+
+
+def _get_member_name(root, file_path):
+    """Get the name of a photo file in an archive, its path under `root`
+
+    :param root: The directory of the photoset directories
+    :type root: str
+    :param file_path: The path of the photo file
+    :type file_path: str
+    :return: ex: 123/photo.jpg
+    :rtype: str
+    """
+    return os.path.relpath(file_path, root).replace(os.sep, '/')
+
+
+class DirectorySink(object):
+    """Where the downloaded photos are written, by default every photo is
+    kept as a file in the directory of its photoset. A sink takes the
+    complete photo files from the photoset directories.
+    """
+
+    def contains(self, file_path):
+        """Check whether the photo is written already
+
+        :param file_path: The path of the photo file in its photoset directory
+        :type file_path: str
+        :rtype: bool
+        """
+        return os.path.isfile(file_path)
+
+    def add(self, file_path):
+        """Take a complete photo file, it is in place already
+
+        :param file_path: The path of the photo file in its photoset directory
+        :type file_path: str
+        """
+
+    def close(self):
+        """Write the rest of the photos
+        """
+
+
+# Created by calling the metaclass, the syntax of a metaclass differs on
+# Python 2 and 3
+_AbstractSink = abc.ABCMeta('_AbstractSink', (DirectorySink,), {})
+
+
+class ArchiveSink(_AbstractSink):
+    """Write the photos into one archive, used by `--archive`
+    The photos are downloaded into the photoset directories under
+    :attr:`root`, a temporary directory, and a single writer thread appends
+    them to the archive one at a time in the order they are completed. Each
+    file is removed once written. At most ARCHIVE_QUEUE_SIZE files wait for
+    the writer, a transfer waits when the writer falls behind, so neither
+    the memory nor the temporary directory grows with the photoset. The
+    members are named by their paths under :attr:`root`. An existing archive
+    is appended to, and its members are not downloaded again.
+    A subclass writes a format of archive with :meth:`_open`,
+    :meth:`_write` and :meth:`_finish`.
+
+    :param path: The path of the archive
+    :type path: str
+    :param fsync: Whether to fsync the archive after every member
+    :type fsync: bool
+    """
+
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        import tempfile
+        self._names = set(self._open())
+        self.root = tempfile.mkdtemp(prefix='grabflickr-')
+        self._lock = threading.Lock()
+        # Notified when no transfer is handing a file over any more
+        self._handed = threading.Condition(self._lock)
+        self._queue = Queue(ARCHIVE_QUEUE_SIZE)
+        self._error = None
+        self._dropped = 0
+        self._adding = 0
+        self._closed = False
+        self._writer = threading.Thread(target=self._write_members)
+        self._writer.daemon = True
+        self._writer.start()
+
+    @abc.abstractmethod
+    def _open(self):
+        """Open the archive for appending
+
+        :return: The names of the members in the archive
+        :rtype: list of strs
+        """
+
+    @abc.abstractmethod
+    def _write(self, file_path, name):
+        """Append a photo file to the archive and flush it
+
+        :param file_path: The path of the photo file
+        :type file_path: str
+        :param name: The member name
+        :type name: str
+        """
+
+    @abc.abstractmethod
+    def _finish(self):
+        """Complete and close the archive
+        """
+
+    def get_names(self):
+        """Get the names of the members written or waiting for the writer
+
+        :rtype: set of strs
+        """
+        with self._lock:
+            return set(self._names)
+
+    def contains(self, file_path):
+        with self._lock:
+            return _get_member_name(self.root, file_path) in self._names
+
+    def add(self, file_path):
+        """Hand a complete photo file over to the writer, wait if the writer
+        has ARCHIVE_QUEUE_SIZE files already
+
+        :param file_path: The path of the photo file under :attr:`root`
+        :type file_path: str
+        """
+        name = _get_member_name(self.root, file_path)
+        with self._lock:
+            if self._error is not None:
+                raise IOError('Failed to write %s: %s' % (
+                    self.path, self._error
+                ))
+            if self._closed:
+                raise IOError('%s is closed' % self.path)
+            if name in self._names:
+                return
+            self._names.add(name)
+            self._adding += 1
+        # It waits for the writer without the lock, the writer takes it to
+        # drop the files after a failure
+        try:
+            self._queue.put((file_path, name))
+        finally:
+            with self._lock:
+                self._adding -= 1
+                if not self._adding:
+                    self._handed.notify_all()
+
+    def _write_members(self):
+        """Write the files from the queue until it gets None. After a failed
+        write the files are dropped instead, they are not in the archive
+        and are downloaded again by the next run.
+        """
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            file_path, name = item
+            if self._error is None:
+                try:
+                    self._write(file_path, name)
+                    os.remove(file_path)
+                    continue
+                except Exception as e:
+                    logger.exception('Failed to write %s', self.path)
+                    self._error = e
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+            with self._lock:
+                self._names.discard(name)
+                self._dropped += 1
+
+    def close(self):
+        """Write the photos waiting for the writer, complete the archive and
+        remove the temporary directory
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            # The files being handed over are queued before the end
+            while self._adding:
+                self._handed.wait()
+        self._queue.put(None)
+        self._writer.join()
+        self._finish()
+        shutil.rmtree(self.root, ignore_errors=True)
+        if self._dropped:
+            logger.error(
+                '%s photos are not written to %s', self._dropped, self.path
+            )
+        logger.info('%s has %s photos', self.path, len(self._names))
+
+
+class TarSink(ArchiveSink):
+    """Write the photos into a tar archive. Every member is flushed once
+    written, so the archive is readable up to its last complete member even
+    if the run is killed, and the incomplete tail is cut when it is opened
+    again.
+    """
+
+    def _open(self):
+        import tarfile
+        names = []
+        end = 0
+        if os.path.isfile(self.path):
+            size = os.path.getsize(self.path)
+            try:
+                tar = tarfile.open(self.path, 'r')
+                try:
+                    for member in tar:
+                        member_end = member.offset_data + (
+                            -member.size % tarfile.BLOCKSIZE
+                        ) + member.size
+                        if member_end > size:
+                            break
+                        names.append(member.name)
+                        end = member_end
+                finally:
+                    tar.close()
+            except (tarfile.ReadError, EOFError):
+                # Empty or cut in a header, keep the complete members
+                pass
+            self._file = open(self.path, 'r+b')
+        else:
+            self._file = open(self.path, 'wb')
+        # Drop the end of archive blocks and any incomplete member
+        self._file.truncate(end)
+        self._file.seek(end)
+        self._tar = tarfile.open(
+            fileobj=self._file, mode='w', format=tarfile.PAX_FORMAT
+        )
+        return names
+
+    def _write(self, file_path, name):
+        info = self._tar.gettarinfo(file_path, name)
+        with open(file_path, 'rb') as f:
+            self._tar.addfile(info, f)
+        # The written members are not needed, keep the memory flat
+        self._tar.members = []
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def _finish(self):
+        self._tar.close()
+        self._file.close()
+
+
+class ZipSink(ArchiveSink):
+    """Write the photos into a zip archive without compression. The central
+    directory of a zip is written when the sink is closed, which is also
+    done when the run is interrupted, but a zip left by a killed run can not
+    be read or appended to. Use a tar archive if the run may be killed.
+    """
+
+    def _open(self):
+        import zipfile
+        if os.path.isfile(self.path) and os.path.getsize(self.path) and \
+                not zipfile.is_zipfile(self.path):
+            raise IOError(
+                '%s is not a complete zip archive, repair it with '
+                '`zip -FF` or write another archive' % self.path
+            )
+        self._zip = zipfile.ZipFile(
+            self.path, 'a' if os.path.isfile(self.path) else 'w',
+            zipfile.ZIP_STORED, allowZip64=True
+        )
+        return self._zip.namelist()
+
+    def _write(self, file_path, name):
+        self._zip.write(file_path, name)
+        self._zip.fp.flush()
+        if self.fsync:
+            os.fsync(self._zip.fp.fileno())
+
+    def _finish(self):
+        self._zip.close()
+
+
+# The archive sinks by the suffix of the archive path
+ARCHIVE_SINKS = {
+    '.tar': TarSink,
+    '.zip': ZipSink,
+}
+
+
+def open_archive(path, fsync=False):
+    """Open the sink of an archive by the suffix of its path
+
+    :param path: The path of the archive, ex: photos.tar
+    :type path: str
+    :param fsync: Whether to fsync the archive after every member
+    :type fsync: bool
+    :raise ValueError: The suffix is not in ARCHIVE_SINKS
+    :raise IOError: The archive can not be appended to
+    :rtype: ArchiveSink
+    """
+    suffix = os.path.splitext(path)[1].lower()
+    if suffix not in ARCHIVE_SINKS:
+        raise ValueError('The archive must be a %s file' % ' or '.join(
+            sorted(ARCHIVE_SINKS)
+        ))
+    return ARCHIVE_SINKS[suffix](path, fsync)
+
+
+class _WorkerSink(DirectorySink):
+    """The sink of a worker process writing into the archive of the main
+    process, the complete files are sent to the main process to be written
+
+    :param root: The :attr:`ArchiveSink.root` of the archive
+    :type root: str
+    :param names: The names of the members in the archive
+    :type names: iterable of strs
+    :param send: Called with the path of a complete photo file
+    :type send: function
+    """
+
+    def __init__(self, root, names, send):
+        self.root = root
+        self._names = frozenset(names)
+        self._send = send
+
+    def contains(self, file_path):
+        return _get_member_name(self.root, file_path) in self._names
+
+    def add(self, file_path):
+        self._send(file_path)
+
+
+def _get_plan_entry(photo, download_url, file_path, size):
+    """Get the entry of a photo in the plan of `gf plan`
+
+    :param photo: The photo information include id, secret and title
+    :type photo: dict
+    :param download_url: Photo download url
+    :type download_url: str
+    :param file_path: The path the photo is downloaded to
+    :type file_path: str
+    :param size: The length of the image, None if the server does not tell it
+    :type size: int
+    :rtype: dict
+    """
+    return {
+        'id': photo['id'],
+        'secret': photo.get('secret', ''),
+        'title': photo['title'],
+        'photoset': _get_photoset(photo).id,
+        'url': download_url,
+        'size': size,
+        'path': file_path,
+    }
+
+
+class PlanWriter(object):
+    """The plan of `gf plan`, a JSON line for every resolved photo with its
+    `id`, `secret`, `title`, `photoset`, download `url`, expected `size` and
+    target `path`. The lines are written to a `.part` file in the order the
+    photos are resolved, it is renamed in place when the plan is closed.
+
+    :param path: The path of the plan
+    :type path: str
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._file = open(path + PART_SUFFIX, 'w')
+        self._lock = threading.Lock()
+
+    def add(self, entry):
+        """Add a photo to the plan
+
+        :param entry: The entry from :func:`_get_plan_entry`
+        :type entry: dict
+        """
+        line = json.dumps(entry, sort_keys=True) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self.count += 1
+
+    def close(self):
+        """Close the plan and rename it in place
+        """
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.close()
+            self._file = None
+        os.rename(self.path + PART_SUFFIX, self.path)
+        logger.info('Write %s photos to the plan %s', self.count, self.path)
+
+
+class _WorkerPlan(object):
+    """The plan of a worker process, the entries are sent to the plan of the
+    main process
+
+    :param send: Called with an entry
+    :type send: function
+    """
+
+    def __init__(self, send):
+        self.add = send
+
+    def close(self):
+        pass
+
+
+def get_shard(entry, count):
+    """Get the shard of an entry of a plan split into `count` shards.
+    It depends only on the photo id, so it does not change with the order
+    of the plan, and a photo in many photosets is fetched by one shard.
+
+    :param entry: The entry of the plan include id
+    :type entry: dict
+    :param count: The number of shards
+    :type count: int
+    :return: From 0 to `count` - 1
+    :rtype: int
+    """
+    return (zlib.crc32(str(entry['id']).encode('utf-8')) & 0xffffffff) % count
+
+
+def read_plan(path, shard=(0, 1)):
+    """Read the entries of a shard of a plan written by :class:`PlanWriter`
+
+    :param path: The path of the plan
+    :type path: str
+    :param shard: `(index, count)`, the entries of the `index` th of `count`
+            shards are read, see :func:`get_shard`
+    :type shard: tuple
+    :raise ValueError: A line is not an entry of a photo
+    :return: The entries
+    :rtype: generator of dicts
+    """
+    index, count = shard
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+                if not all(entry.get(key) for key in ('id', 'url', 'path')):
+                    raise ValueError('id, url or path is missing')
+            except (ValueError, AttributeError) as e:
+                raise ValueError('Line %s of %s is not a photo: %s' % (
+                    number, path, e
+                ))
+            if get_shard(entry, count) == index:
+                yield entry
+
+
+def plan_photos(entries, directory=None):
+    """Create the photos of `gf fetch` from the entries of a plan. The
+    photos complete on disk are skipped, a file of another size than the
+    entry is removed and downloaded again.
+
+    :param entries: The entries of the plan
+    :type entries: iterable of dicts
+    :param directory: The directory the relative paths of the entries are
+            under, default is the current directory
+    :type directory: str
+    :return: The photosets, one for every directory, and the photos, each
+            refers to its photoset and has its download url and file name
+    :rtype: tuple
+    """
+    photosets = {}
+    photos = []
+    skipped = 0
+    for entry in entries:
+        file_path = entry['path']
+        if directory:
+            file_path = os.path.join(directory, file_path)
+        if os.path.exists(file_path):
+            size = os.path.getsize(file_path)
+            if entry.get('size') in (None, size):
+                skipped += 1
+                continue
+            logger.warning(
+                'Download %s again, it has %s bytes instead of %s',
+                _log_text(file_path), size, entry['size']
+            )
+            os.remove(file_path)
+        photo_dir, photo_title = os.path.split(file_path)
+        photo_dir = photo_dir or os.curdir
+        photoset = photosets.get(photo_dir)
+        if photoset is None:
+            create_dir(photo_dir)
+            photoset = Photoset(entry.get('photoset'), photo_dir)
+            photosets[photo_dir] = photoset
+        photos.append({
+            'id': entry['id'],
+            'secret': entry.get('secret', ''),
+            'title': entry.get('title') or photo_title,
+            PHOTOSET_KEY: photoset,
+            PLAN_KEY: (entry['url'], photo_title),
+        })
+    if skipped:
+        logger.info('Skip %s photos, already downloaded', skipped)
+    return list(photosets.values()), photos
+
+
+def iter_photosets_photos(photosets):
+    """Walk through the photosets one after another and yield their photos,
+    every photo refers to its photoset. They are fed to one pipeline, so
+    the workers move on to the next photoset as soon as the current one is
+    listed instead of waiting for all its photos to be downloaded.
+
+    :param photosets: The photosets to be downloaded
+    :type photosets: list of Photosets
+    :return: photos information
+    :rtype: generator of dicts
+    """
+    job = get_job()
+    for photoset in photosets:
+        for photo in iter_photos_info(photoset.id):
+            if job.cancelled:
+                return
+            photo[PHOTOSET_KEY] = photoset
+            photoset.photo_ids.add(photo['id'])
+            yield photo
+        photoset.listed = True
+
+
+def _init_counter(photos):
+    """Count the photos listed if the number of photos is known
+    A generator from :func:`iter_photos_info` sets it by itself
+    when the first page arrives.
+
+    :param photos: The photos to be downloaded
+    :type photos: list or generator of dicts
+    """
+    if isinstance(photos, (list, tuple)):
+        _count_up(len(photos))
+
+
+def _is_throttled(error):
+    """Check whether the error is the server asking to slow down
+
+    :param error: The error raised by a request
+    :type error: Exception
+    :rtype: bool
+    """
+    return _get_error_status(error) in THROTTLE_STATUS
+
+
+class ConcurrencyController(object):
+    """Adaptive limit of the in-flight transfers between `min_limit` and
+    `max_limit` (AIMD). The limit starts at `min_limit` and is doubled while
+    the throughput keeps improving, like TCP slow start. After that, at the
+    end of each window it is halved if any transfer failed or was throttled,
+    increased by one while the throughput keeps improving, and decreased by
+    one once the throughput drops, so it settles around the throughput knee.
+    In the event driven mode the condition is patched by gevent.
+
+    :param min_limit: The min number of in-flight transfers
+    :type min_limit: int
+    :param max_limit: The max number of in-flight transfers
+    :type max_limit: int
+    """
+
+    def __init__(self, min_limit, max_limit):
+        self.min_limit = max(1, min(min_limit, max_limit))
+        self.max_limit = max(1, max_limit)
+        self.limit = self.min_limit
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._last_throughput = 0.0
+        self._slow_start = True
+        self._reset_window(time.time())
+
+    def _reset_window(self, now):
+        """Start a new measurement window
+        """
+        self._window_start = now
+        self._window_bytes = 0
+        self._window_done = 0
+        self._window_errors = 0
+        self._window_latency = 0.0
+
+    def acquire(self):
+        """Wait until the number of in-flight transfers is under the limit,
+        then count one more in flight
+
+        :return: The start time of the transfer
+        :rtype: float
+        """
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+        return time.time()
+
+    def release(self, start, nbytes, error=None):
+        """Count a transfer as finished and adjust the limit
+
+        :param start: The start time returned by :meth:`acquire`
+        :type start: float
+        :param nbytes: The number of bytes transferred
+        :type nbytes: int
+        :param error: The error raised by the transfer if any
+        :type error: Exception
+        """
+        with self._condition:
+            self._in_flight -= 1
+            self._record(time.time(), start, nbytes, error)
+            self._condition.notify_all()
+
+    def _record(self, now, start, nbytes, error):
+        """Record a finished transfer and adjust the limit at the end of
+        a window
+        """
+        self._window_bytes += nbytes
+        self._window_done += 1
+        self._window_latency += now - start
+        if error is not None:
+            self._window_errors += 1
+        elapsed = now - self._window_start
+        if error is None or not _is_throttled(error):
+            if self._window_done < self.limit or elapsed < ADAPT_WINDOW:
+                return
+        throughput = self._window_bytes / elapsed if elapsed > 0 else 0.0
+        limit = self.limit
+        if self._window_errors:
+            limit = limit // 2
+            self._slow_start = False
+        elif throughput > self._last_throughput * (1 + ADAPT_GAIN):
+            limit = limit * 2 if self._slow_start else limit + 1
+        else:
+            self._slow_start = False
+            if throughput < self._last_throughput * (1 - ADAPT_GAIN):
+                limit -= 1
+        limit = max(self.min_limit, min(self.max_limit, limit))
+        logger.debug(
+            'Transfer concurrency %s -> %s (%d bytes/s, %.2fs latency, '
+            '%s errors)', self.limit, limit, throughput,
+            self._window_latency / self._window_done, self._window_errors
+        )
+        self.limit = limit
+        self._last_throughput = throughput
+        self._reset_window(now)
+
+
+def _get_queue_size():
+    """Get the max number of photos waiting in each stage of the pipeline
+
+    :return: The queue size of the current job, default is twice the max
+            number of transfer workers
+    :rtype: int
+    """
+    job = get_job()
+    return job.queue_size or job.transfer_workers * 2
+
+
+class Pipeline(object):
+    """Download photos in two stages with separate worker pools
+    The resolve workers skip unchanged photos and resolve the urls, which
+    are small API calls. They feed a bounded queue consumed by the transfer
+    workers, which download the images. So transfers do not wait on API
+    latency, and each stage has its own concurrency limit.
+    In the event driven mode threads and queues are patched by gevent,
+    so the workers are greenlets.
+
+    :param resolve_num: The number of resolve workers
+    :type resolve_num: int
+    :param controller: The controller of the in-flight transfers, there are
+            as many transfer workers as its max limit
+    :type controller: ConcurrencyController
+    :param size: The max number of photos waiting in each queue
+    :type size: int
+    :param get: The function used to send the GET request of the images
+    :type get: function
+    :param on_done: Called with the photo, the number of bytes transferred
+            and the error if any when a photo is done, instead of logging
+            the progress
+    :type on_done: function
+    """
+
+    def __init__(self, resolve_num, controller, size, get=None, on_done=None):
+        self._resolve_num = resolve_num
+        self._controller = controller
+        self._resolve_queue = Queue(size)
+        self._resolve_stops = 0
+        self._transfer_stops = 0
+        self._transfer_queue = Queue(size)
+        self._get = get
+        self._on_done = on_done
+
+    def stats(self):
+        """Get the number of photos waiting in each stage
+
+        :return: `resolve_queue` and `transfer_queue` depths
+        :rtype: dict
+        """
+        # The stop signals put after the last photo are not counted
+        return {
+            'resolve_queue': max(
+                0, self._resolve_queue.qsize() - self._resolve_stops
+            ),
+            'transfer_queue': max(
+                0, self._transfer_queue.qsize() - self._transfer_stops
+            ),
+        }
+
+    def run(self, photos):
+        """Download the photos and wait for all workers to finish
+
+        :param photos: The photos to be downloaded
+        :type photos: iterable of dicts
+        """
+        resolvers = [
+            self._start(self._resolve_worker)
+            for _ in range(self._resolve_num)
+        ]
+        transferrers = [
+            self._start(self._transfer_worker)
+            for _ in range(self._controller.max_limit)
+        ]
+        try:
+            for photo in photos:
+                self._resolve_queue.put(photo)
+        finally:
+            for _ in resolvers:
+                self._resolve_stops += 1
+                self._resolve_queue.put(None)
+            for worker in resolvers:
+                worker.join()
+            for _ in transferrers:
+                self._transfer_stops += 1
+                self._transfer_queue.put(None)
+            for worker in transferrers:
+                worker.join()
+
+    def _start(self, target):
+        """Start a worker thread running `target` as a part of the
+        current job
+        """
+        worker = threading.Thread(target=get_job().bind(target))
+        worker.daemon = True
+        worker.start()
+        return worker
+
+    def _done(self, photo, nbytes=0, error=None):
+        """Count a photo as done and log the progress
+        """
+        if self._on_done is not None:
+            self._on_done(photo, nbytes, error)
+            return
+        stats = self.stats()
+        logger.info(
+            'The number of pictures remaining: %s '
+            '(waiting for url: %s, waiting for transfer: %s)',
+            _count_down(), stats['resolve_queue'], stats['transfer_queue']
+        )
+
+    def _resolve_worker(self):
+        """Resolve the photos from the resolve queue until it gets None
+        """
+        while True:
+            photo = self._resolve_queue.get()
+            if photo is None:
+                return
+            error = None
+            try:
+                resolved = resolve_photo(photo)
+            except Exception as e:
+                record_failure(photo, e)
+                resolved = None
+                error = e
+            if resolved is None:
+                self._done(photo, 0, error)
+            else:
+                self._transfer_queue.put((photo, resolved))
+
+    def _transfer_worker(self):
+        """Download the photos from the transfer queue until it gets None
+        """
+        while True:
+            item = self._transfer_queue.get()
+            if item is None:
+                return
+            photo, (download_url, photo_title) = item
+            start = self._controller.acquire()
+            nbytes = 0
+            error = None
+            try:
+                nbytes = transfer_photo(
+                    photo, download_url, photo_title, self._get
+                )
+            except Exception as e:
+                record_failure(photo, e)
+                error = e
+            self._controller.release(start, nbytes, error)
+            self._done(photo, nbytes, error)
+
+
+def single_download_photos(photos):
+    """Use single process to download photos
+
+    :param photos: The photos to be downloaded
+    :type photos: iterable of dicts
+    """
+    _init_counter(photos)
+    for photo in photos:
+        download_photo(photo)
+
+
+def event_download_photos(photos):
+    """Use asynchronous I/O to download photos
+
+    :param photos: The photos to be downloaded
+    :type photos: iterable of dicts
+    """
+    if grequests is None:
+        logger.error('You need install gevent module. Aborting...')
+        sys.exit(1)
+    _init_counter(photos)
+    job = get_job()
+    pipeline = Pipeline(
+        job.resolve_workers,
+        ConcurrencyController(job.min_transfer_workers, job.transfer_workers),
+        _get_queue_size(),
+        _grequests_get
+    )
+    pipeline.run(photos)
+
+
+def multithread_download_photos(photos):
+    """Use multiple threads to download photos
+
+    :param photos: The photos to be downloaded
+    :type photos: iterable of dicts
+    """
+    _init_counter(photos)
+    job = get_job()
+    pipeline = Pipeline(
+        job.resolve_workers,
+        ConcurrencyController(job.min_transfer_workers, job.transfer_workers),
+        _get_queue_size()
+    )
+    pipeline.run(photos)
+
+
+def _get_process_size_policy(policy, process_num):
+    """Get the arguments of :class:`SizePolicy` for a worker process
+
+    :param policy: The size policy of the job
+    :type policy: SizePolicy
+    :param process_num: The number of worker processes
+    :type process_num: int
+    :rtype: tuple
+    """
+    budget = None
+    if policy.budget is not None:
+        # Like the API rate limit, the worker processes split the budget
+        budget = policy.budget.remaining // process_num
+    return policy.size_mode, policy.max_pixels, policy.max_bytes, budget
+
+
+def _get_process_config(job, process_num):
+    """Collect the settings a worker process needs, they are passed
+    explicitly because a spawned process inherits nothing, and a forked
+    process must not use the connections of its parent
+
+    :param job: The job to be run by the processes
+    :type job: Job
+    :param process_num: The number of worker processes
+    :type process_num: int
+    :return: The picklable settings
+    :rtype: dict
+    """
+    downloader = job.downloader
+    api_cache = downloader.api_cache
+    content_store = downloader.content_store
+    return {
+        'api_url': downloader.api_url,
+        'api_key': downloader.api_key,
+        'api_secret': downloader.api_secret,
+        # The worker processes share the API rate limit
+        'api_rate': downloader.api_limiter.rate / process_num,
+        'api_burst': max(1, downloader.api_limiter.burst // process_num),
+        'retries': downloader.retries,
+        'api_cache': (
+            (api_cache.path, api_cache.max_size)
+            if api_cache is not None else None
+        ),
+        'store': content_store.path if content_store is not None else None,
+        'size_policy': _get_process_size_policy(
+            job.size_policy, process_num
+        ),
+        'chunk_size': job.chunk_size,
+        'fsync': job.fsync,
+        'segments': job.segments,
+        'segment_threshold': job.segment_threshold,
+        'resolve_workers': job.resolve_workers,
+        'min_transfer_workers': job.min_transfer_workers,
+        'transfer_workers': job.transfer_workers,
+        'queue_size': job.queue_size,
+        'trace': job.tracer is not None,
+        'dry_run': job.dry_run,
+        # The main process writes the archive, see _WorkerSink
+        'archive': (
+            (job.sink.root, sorted(job.sink.get_names()))
+            if isinstance(job.sink, ArchiveSink) else None
+        ),
+        # and the plan, see _WorkerPlan, and runs the post-processing
+        'plan': job.plan is not None,
+        'post': job.post is not None,
+        'photosets': [
+            (photoset.id, photoset.directory, photoset.manifest is not None)
+            for photoset in job.photosets
+        ],
+    }
+
+
+def _init_process(config):
+    """Create the job of a worker process from the settings collected by
+    :func:`_get_process_config`
+
+    :param config: The settings
+    :type config: dict
+    :return: The job, each photoset with its own manifest connection
+    :rtype: Job
+    """
+    if not logger.handlers:
+        init_logger()
+    downloader = Downloader(
+        config['api_key'], config['api_secret'], config['api_url'],
+        config['resolve_workers'] +
+        config['transfer_workers'] * max(1, config['segments']),
+        config['api_rate'], config['api_burst'], config['retries'],
+        ApiCache(*config['api_cache'])
+        if config['api_cache'] is not None else None,
+        ContentStore(config['store'])
+        if config['store'] is not None else None
+    )
+    photosets = []
+    for photoset_id, photoset_dir, sync in config['photosets']:
+        photoset_manifest = None
+        if sync:
+            photoset_manifest = Manifest(
+                os.path.join(photoset_dir, MANIFEST_NAME)
+            )
+        photosets.append(Photoset(photoset_id, photoset_dir, photoset_manifest))
+    size_mode, max_pixels, max_bytes, budget = config['size_policy']
+    return Job(
+        downloader, photosets,
+        size_policy=SizePolicy(
+            size_mode, max_pixels, max_bytes,
+            ByteBudget(budget) if budget is not None else None
+        ),
+        chunk_size=config['chunk_size'],
+        fsync=config['fsync'],
+        segments=config['segments'],
+        segment_threshold=config['segment_threshold'],
+        resolve_workers=config['resolve_workers'],
+        min_transfer_workers=config['min_transfer_workers'],
+        transfer_workers=config['transfer_workers'],
+        queue_size=config['queue_size'],
+        trace=config['trace'],
+        dry_run=config['dry_run']
+    )
+
+
+def _process_main(worker_id, config, tasks, results, done_photos, done_bytes,
+                  budget=None):
+    """The main procedure of a worker process
+    It downloads the photos of the tasks with the multithread pipeline until
+    it gets None, and sends back a result for each task.
+
+    :param worker_id: The id of the worker process
+    :type worker_id: int
+    :param config: The settings from :func:`_get_process_config`
+    :type config: dict
+    :param tasks: The queue of `(task id, photoset index, photo)` tasks
+    :type tasks: multiprocessing.Queue
+    :param results: The queue of `(worker id, task id, error)` results,
+            `(worker id, None, {'file_path': path})` for every photo file
+            to be written to the archive, `(worker id, None, {'entry':
+            entry})` for every photo added to the plan, `(worker id, None,
+            {'post': task})` for every photo to be post-processed, and a
+            `(worker id, None, report)` result at the end with the `metrics`
+            snapshot and the `trace` events
+    :type results: multiprocessing.Queue
+    :param done_photos: The number of photos done by all processes
+    :type done_photos: multiprocessing.Value
+    :param done_bytes: The number of bytes downloaded by all processes
+    :type done_bytes: multiprocessing.Value
+    :param budget: `(share, spent)` of the budget of the process, in place
+            of the share of the settings, see :class:`_WorkerBudget`
+    :type budget: tuple
+    """
+    job = _init_process(config)
+    photosets = job.photosets
+    if budget is not None:
+        job.size_policy.budget = _WorkerBudget(*budget)
+    if config['archive'] is not None:
+        root, names = config['archive']
+        job.sink = _WorkerSink(root, names, lambda file_path: results.put(
+            (worker_id, None, {'file_path': file_path})
+        ))
+    if config['plan']:
+        job.plan = _WorkerPlan(lambda entry: results.put(
+            (worker_id, None, {'entry': entry})
+        ))
+    if config['post']:
+        from grabflickr import post
+        job.post = post._WorkerPostProcessor(lambda task: results.put(
+            (worker_id, None, {'post': task})
+        ))
+
+    def iter_tasks():
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            task_id, photoset_index, photo = task
+            photo[PHOTOSET_KEY] = photosets[photoset_index]
+            photo[TASK_KEY] = task_id
+            yield photo
+
+    def on_done(photo, nbytes, error):
+        with done_photos.get_lock():
+            done_photos.value += 1
+        with done_bytes.get_lock():
+            done_bytes.value += nbytes
+        # Exceptions may not be picklable, send the message only
+        results.put((
+            worker_id, photo[TASK_KEY], None if error is None else str(error)
+        ))
+
+    with job.activate():
+        pipeline = Pipeline(
+            job.resolve_workers,
+            ConcurrencyController(
+                job.min_transfer_workers, job.transfer_workers
+            ),
+            _get_queue_size(),
+            on_done=on_done
+        )
+        try:
+            pipeline.run(iter_tasks())
+        finally:
+            job.close()
+            job.downloader.close()
+            results.put((worker_id, None, {
+                'metrics': job.metrics.snapshot(),
+                'trace': (
+                    job.tracer.events() if job.tracer is not None else None
+                ),
+            }))
+
+
+class ProcessPool(object):
+    """Download photos with many worker processes, each runs its own
+    multithread pipeline, so the work of hashing and writing the files is
+    not limited to one CPU.
+    The photos are listed in this process and sent to the worker with the
+    fewest photos in hand. Every worker sends back a result for each photo,
+    the photos a worker holds without result are sent to another worker if
+    it dies, and a new worker takes its place.
+
+    :param job: The job to be run
+    :type job: Job
+    :param process_num: The number of worker processes
+    :type process_num: int
+    """
+
+    def __init__(self, job, process_num):
+        self._job = job
+        self._config = _get_process_config(job, process_num)
+        self._photoset_indexes = dict(
+            (id(photoset), index)
+            for index, photoset in enumerate(job.photosets)
+        )
+        self._process_num = process_num
+        # Enough photos in hand to keep both stages of the pipeline busy
+        self._limit = _get_queue_size() + job.resolve_workers + \
+            job.transfer_workers
+        import multiprocessing
+        self._results = multiprocessing.Queue()
+        self._done_photos = multiprocessing.Value('l', 0)
+        self._done_bytes = multiprocessing.Value('d', 0.0)
+        self._next_worker_id = 0
+        self._workers = {}
+        self._assigned = {}
+        self._budgets = {}
+        # The workers whose report at their end is received
+        self._reported = set()
+
+    def stats(self):
+        """Get the progress of all worker processes
+
+        :return: `processes`, `photos` done and `bytes` downloaded
+        :rtype: dict
+        """
+        return {
+            'processes': len(self._workers),
+            'photos': self._done_photos.value,
+            'bytes': int(self._done_bytes.value),
+        }
+
+    def run(self, photos):
+        """Download the photos and wait for all worker processes to finish
+
+        :param photos: The photos to be downloaded
+        :type photos: iterable of dicts
+        """
+        for _ in range(self._process_num):
+            self._spawn()
+        photos = iter(photos)
+        listing = True
+        task_id = 0
+        try:
+            while listing or any(self._assigned.values()):
+                while listing and self._has_room():
+                    photo = next(photos, None)
+                    if photo is None:
+                        listing = False
+                        break
+                    self._assign(self._create_task(task_id, photo))
+                    task_id += 1
+                self._receive()
+                self._check_workers()
+        finally:
+            for process, tasks in self._workers.values():
+                tasks.put(None)
+            # A worker does not exit until its report at the end, which may
+            # be larger than the pipe with the trace, is read, so the reports
+            # are received before the workers are joined
+            while any(
+                worker_id not in self._reported and process.is_alive()
+                for worker_id, (process, tasks) in self._workers.items()
+            ):
+                self._receive()
+            for process, tasks in self._workers.values():
+                process.join()
+            # The results sent by the workers which have died
+            self._receive()
+
+    def _spawn(self, share=None):
+        """Start a worker process
+
+        :param share: The bytes of the budget the worker may reserve,
+                default is the share of the settings
+        :type share: int
+        """
+        worker_id = self._next_worker_id
+        self._next_worker_id += 1
+        import multiprocessing
+        if share is None:
+            share = self._config['size_policy'][3]
+        budget = None
+        if share is not None:
+            budget = (share, multiprocessing.Value('d', 0.0))
+        tasks = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=_process_main,
+            args=(
+                worker_id, self._config, tasks, self._results,
+                self._done_photos, self._done_bytes, budget
+            )
+        )
+        process.daemon = True
+        process.start()
+        self._workers[worker_id] = (process, tasks)
+        self._assigned[worker_id] = {}
+        self._budgets[worker_id] = budget
+
+    def _create_task(self, task_id, photo):
+        """Create a picklable task of the photo
+
+        :return: `(task id, photoset index, photo, attempts)`
+        :rtype: tuple
+        """
+        photo = dict(photo)
+        photoset = photo.pop(PHOTOSET_KEY, None)
+        return (task_id, self._photoset_indexes.get(id(photoset), 0), photo, 0)
+
+    def _has_room(self):
+        """Check whether any worker can take one more photo
+        """
+        return any(
+            len(assigned) < self._limit for assigned in self._assigned.values()
+        )
+
+    def _assign(self, task):
+        """Send the task to the worker with the fewest photos in hand
+        """
+        worker_id = min(
+            self._assigned, key=lambda key: len(self._assigned[key])
+        )
+        self._assigned[worker_id][task[0]] = task
+        self._workers[worker_id][1].put(task[:3])
+
+    def _receive(self):
+        """Wait for the results from the workers and log the progress
+        """
+        try:
+            result = self._results.get(timeout=PROCESS_POLL)
+        except Empty:
+            return
+        while result is not None:
+            worker_id, task_id, error = result
+            if task_id is None:
+                self._merge(error)
+                if 'metrics' in error:
+                    self._reported.add(worker_id)
+                task = None
+            else:
+                task = self._assigned.get(worker_id, {}).pop(task_id, None)
+            # The task is sent to another worker if its worker has died
+            if task is not None:
+                if error is not None:
+                    # It is logged by the worker already
+                    self._job.metrics.count('failed')
+                    self._job.add_failure(task[2], error)
+                self._job.metrics.set('bytes', int(self._done_bytes.value))
+                stats = self.stats()
+                logger.info(
+                    'The number of pictures remaining: %s '
+                    '(%s processes, %s bytes downloaded)',
+                    _count_down(), stats['processes'], stats['bytes']
+                )
+            try:
+                result = self._results.get_nowait()
+            except Empty:
+                result = None
+
+    def _merge(self, report):
+        """Merge a report sent by a worker: a photo file to be written to the
+        archive, an entry of the plan, a photo to be post-processed, or the
+        metrics and the trace at its end
+
+        :param report: `file_path`, `entry`, `post` task, or `metrics`
+                snapshot and `trace` events
+        :type report: dict
+        """
+        if 'file_path' in report:
+            self._job.sink.add(report['file_path'])
+            return
+        if 'entry' in report:
+            self._job.plan.add(report['entry'])
+            return
+        if 'post' in report:
+            self._job.post.submit(report['post'])
+            return
+        # The bytes and the failures are already counted here
+        self._job.metrics.merge(
+            report['metrics'], exclude=('bytes', 'failed')
+        )
+        if self._job.tracer is not None and report['trace']:
+            self._job.tracer.extend(report['trace'])
+
+    def _check_workers(self):
+        """Replace the workers which have died and send their photos without
+        result to the other workers
+        """
+        for worker_id, (process, tasks) in list(self._workers.items()):
+            if process.is_alive():
+                continue
+            # The results sent before it died are still counted
+            self._receive()
+            del self._workers[worker_id]
+            orphans = self._assigned.pop(worker_id)
+            budget = self._budgets.pop(worker_id)
+            logger.error(
+                'Worker process %s exited with code %s, '
+                'resend its %s photos', worker_id, process.exitcode,
+                len(orphans)
+            )
+            # The new worker takes what is left of the budget share
+            self._spawn(
+                max(0, budget[0] - int(budget[1].value))
+                if budget is not None else None
+            )
+            for task_id in sorted(orphans):
+                task_id, photoset_index, photo, attempts = orphans[task_id]
+                if attempts + 1 >= TASK_ATTEMPTS:
+                    record_failure(photo, 'Worker process died %s times' % (
+                        attempts + 1
+                    ))
+                    _count_down()
+                    continue
+                self._assign((task_id, photoset_index, photo, attempts + 1))
+
+
+def multiprocess_download_photos(photos, process_num):
+    """Use multiple processes to download photos
+
+    :param photos: The photos of the photosets of the current job
+    :type photos: iterable of dicts
+    :param process_num: The number of worker processes
+    :type process_num: int
+    """
+    _init_counter(photos)
+    ProcessPool(get_job(), process_num).run(photos)
+
+
+class Downloader(object):
+    """The state shared by the jobs of a process: the API key, the session
+    with its connection pools, the API rate limit, the retries, the API
+    cache and the content store. Many jobs can run on one downloader at the
+    same time, each in its own thread::
+
+        downloader = Downloader(api_key, api_secret, pool_size=64)
+        jobs = [
+            Job(downloader, create_photosets([photoset_id]))
+            for photoset_id in photoset_ids
+        ]
+        for job in jobs:
+            job.start()
+        failed = sum(job.wait() for job in jobs)
+        downloader.close()
+
+    :param api_key: The API key
+    :type api_key: str
+    :param api_secret: The API secret
+    :type api_secret: str
+    :param api_url: The url of the flickr API, default is `API_URL`
+    :type api_url: str
+    :param pool_size: The max number of connections kept per host,
+            should be the number of workers of all jobs
+    :type pool_size: int
+    :param api_rate: The max number of API calls per second
+    :type api_rate: float
+    :param api_burst: The max number of API calls in a burst
+    :type api_burst: int
+    :param retries: The number of retries of a failed request
+    :type retries: int
+    :param api_cache: The cache of the API responses
+    :type api_cache: ApiCache
+    :param content_store: The store the photos are linked from
+    :type content_store: ContentStore
+    """
+
+    def __init__(self, api_key, api_secret, api_url=None, pool_size=1,
+                 api_rate=API_RATE, api_burst=API_BURST, retries=5,
+                 api_cache=None, content_store=None):
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.api_url = api_url or API_URL
+        self.session = create_session(pool_size)
+        self.api_limiter = TokenBucket(api_rate, api_burst)
+        self.retries = retries
+        self.api_cache = api_cache
+        self.content_store = content_store
+        self.signed_args = {}
+
+    def get_session_stats(self):
+        """Collect the connection reuse statistics of the session
+
+        :return: One dict per host with `host`, `connections` (the number of
+                connections opened) and `requests` (the number of requests
+                sent)
+        :rtype: list of dicts
+        """
+        stats = []
+        adapters = set(self.session.adapters.values())
+        for adapter in adapters:
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                stats.append({
+                    'host': pool.host,
+                    'connections': pool.num_connections,
+                    'requests': pool.num_requests,
+                })
+        return stats
+
+    def log_session_stats(self):
+        """Log the connection reuse statistics of the session
+        """
+        for stat in self.get_session_stats():
+            logger.info(
+                'Connection pool %s: %s requests over %s connections',
+                stat['host'], stat['requests'], stat['connections']
+            )
+
+    def close(self):
+        """Close the session, the API cache and the content store
+        """
+        self.session.close()
+        if self.api_cache is not None:
+            self.api_cache.close()
+        if self.content_store is not None:
+            self.content_store.close()
+
+
+class Job(object):
+    """The download of some photosets with its own settings, metrics, trace
+    and failures, run on a :class:`Downloader`. The functions of this module
+    use the job run by the current thread, see :func:`get_job`.
+
+    :param downloader: The downloader the job runs on
+    :type downloader: Downloader
+    :param photosets: The photosets to be downloaded, their manifests are
+            closed when the job ends
+    :type photosets: list of Photosets
+    :param engine: The download mode, ex: MULTITHREAD
+    :type engine: int
+    :param processes: The number of worker processes of MULTIPROCESS,
+            None for the number of CPUs
+    :type processes: int
+    :param size_policy: How the size of each photo is selected,
+            default is the original size
+    :type size_policy: SizePolicy
+    :param chunk_size: The number of bytes read and written at a time
+    :type chunk_size: int
+    :param fsync: Whether to fsync the files before renaming them
+    :type fsync: bool
+    :param segments: The number of concurrent Range requests of a large
+            photo, 1 to download every photo in one stream
+    :type segments: int
+    :param segment_threshold: The size in bytes above which a photo is
+            downloaded in segments
+    :type segment_threshold: int
+    :param resolve_workers: The number of workers resolving the photo urls
+    :type resolve_workers: int
+    :param min_transfer_workers: The min number of images downloaded at
+            a time
+    :type min_transfer_workers: int
+    :param transfer_workers: The max number of images downloaded at a time
+    :type transfer_workers: int
+    :param queue_size: The max number of photos waiting for each stage,
+            0 for twice the max number of transfer workers
+    :type queue_size: int
+    :param trace: Whether to record a trace
+    :type trace: bool
+    :param dry_run: Only list the photos and resolve their urls
+    :type dry_run: bool
+    :param prune: Remove the photos deleted from the photosets with
+            a manifest when the job ends
+    :type prune: bool
+    :param sink: Where the photos are written, default is the photoset
+            directories. It is closed when the job ends
+    :type sink: DirectorySink
+    :param photos: The photos of `gf fetch` to be downloaded instead of the
+            photos listed from the photosets, see :func:`plan_photos`
+    :type photos: list of dicts
+    :param plan: Add the resolved photos to the plan instead of downloading
+            them. It is closed when the job ends
+    :type plan: PlanWriter
+    :param post: Run the post-processing hooks on every photo file. It is
+            closed when the job ends
+    :type post: grabflickr.post.PostProcessor
+    """
+
+    def __init__(self, downloader, photosets, engine=MULTITHREAD,
+                 processes=1, size_policy=None, chunk_size=64 * 1024,
+                 fsync=False, segments=SEGMENTS,
+                 segment_threshold=SEGMENT_THRESHOLD * 1024 * 1024,
+                 resolve_workers=4, min_transfer_workers=2,
+                 transfer_workers=32, queue_size=0, trace=False,
+                 dry_run=False, prune=False, sink=None, photos=None,
+                 plan=None, post=None):
+        self.downloader = downloader
+        self.photosets = photosets
+        self.engine = engine
+        self.processes = processes
+        self.size_policy = size_policy or SizePolicy()
+        self.chunk_size = chunk_size
+        self.fsync = fsync
+        self.segments = segments
+        self.segment_threshold = max(1, segment_threshold)
+        self.resolve_workers = resolve_workers
+        self.min_transfer_workers = min_transfer_workers
+        self.transfer_workers = transfer_workers
+        self.queue_size = queue_size
+        self.dry_run = dry_run
+        self.prune = prune
+        self.sink = sink if sink is not None else DirectorySink()
+        self.photos = photos
+        self.plan = plan
+        self.post = post
+        self.metrics = Metrics()
+        self.tracer = Tracer() if trace else None
+        self.failures = []
+        self.failed = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._cancelled = threading.Event()
+
+    def activate(self):
+        """Make this job the job of the current thread in a `with` block::
+
+            with job.activate():
+                photos = get_photos_info(photoset_id)
+
+        :rtype: context manager
+        """
+        return _ActiveJob(self)
+
+    def bind(self, func):
+        """Wrap the function to run as a part of this job in any thread
+
+        :param func: The function
+        :type func: function
+        :rtype: function
+        """
+        def run(*args, **kwargs):
+            with self.activate():
+                return func(*args, **kwargs)
+        return run
+
+    @property
+    def cancelled(self):
+        """Whether :meth:`cancel` has been called
+
+        :rtype: bool
+        """
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        """Stop listing the photos and skip the photos not transferred yet,
+        the photos being transferred are completed
+        """
+        self._cancelled.set()
+
+    def add_failure(self, photo, error):
+        """Add a photo failed to download to :attr:`failures`
+
+        :param photo: The photo information include id and title
+        :type photo: dict
+        :param error: The error
+        :type error: Exception or str
+        """
+        with self._lock:
+            self.failures.append((photo, error))
+
+    def run(self):
+        """Download the photos of the photosets with the engine and wait
+        for the end
+
+        :return: The number of photos failed to download
+        :rtype: int
+        """
+        with self.activate():
+            photos = self.photos
+            if photos is None:
+                photos = iter_photosets_photos(self.photosets)
+            try:
+                if self.engine == SINGLE_PROCESS:
+                    single_download_photos(photos)
+                elif self.engine == GEVENT:
+                    event_download_photos(photos)
+                elif self.engine == MULTITHREAD:
+                    multithread_download_photos(photos)
+                elif self.engine == ASYNCIO:
+                    from grabflickr import aio
+                    aio.download_photosets(self.photosets, self.photos)
+                elif self.engine == MULTIPROCESS:
+                    processes = self.processes
+                    if processes is None:
+                        import multiprocessing
+                        processes = multiprocessing.cpu_count()
+                    multiprocess_download_photos(photos, max(1, processes))
+                else:
+                    logger.error('Unknown Error')
+            finally:
+                self.close()
+            self.failed = report_failures()
+        return self.failed
+
+    def start(self):
+        """Run the job in a new thread
+        """
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wait(self, timeout=None):
+        """Wait for the job started by :meth:`start`
+
+        :param timeout: The max seconds to wait, None to wait for the end
+        :type timeout: float
+        :return: The number of photos failed to download, None if the job
+                has not ended
+        :rtype: int
+        """
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return self.failed
+
+    def close(self):
+        """Prune the photosets if `prune`, close their manifests, the sink,
+        the plan and the post-processing
+        """
+        for photoset in self.photosets:
+            if photoset.manifest is None:
+                continue
+            if self.prune and photoset.listed and not self.dry_run:
+                removed = photoset.manifest.prune(
+                    photoset.photo_ids, photoset.directory
+                )
+                logger.info('Prune %s photos of %s', removed, photoset.id)
+            photoset.manifest.close()
+            photoset.manifest = None
+        self.sink.close()
+        if self.plan is not None:
+            self.plan.close()
+        if self.post is not None:
+            self.post.close()
+
+    def dump_metrics(self, path):
+        """Write the metrics and the connection statistics to a JSON file
+
+        :param path: The path of the JSON file
+        :type path: str
+        """
+        stats = self.metrics.snapshot()
+        stats['connections'] = self.downloader.get_session_stats()
+        with open(path, 'w') as f:
+            json.dump(stats, f, indent=2, sort_keys=True)
+        logger.info('Write the statistics to %s', path)
+
+
+class _ActiveJob(object):
+    """Context manager making the job the job of the current thread,
+    the previous job is restored at the end
+    """
+
+    def __init__(self, job):
+        self._job = job
+        self._previous = None
+
+    def __enter__(self):
+        self._previous = getattr(_local, 'job', None)
+        _local.job = self._job
+        return self._job
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _local.job = self._previous
+        return False
+
+
+def get_job():
+    """Get the job run by the current thread. The code run outside any job
+    uses the default job, which has no API key until it is set on its
+    downloader.
+
+    :return: The job
+    :rtype: Job
+    """
+    global default_job
+    job = getattr(_local, 'job', None)
+    if job is None:
+        if default_job is None:
+            default_job = Job(Downloader('', ''), [])
+        job = default_job
+    return job
+
+
+def get_downloader():
+    """Get the downloader of the job run by the current thread
+
+    :return: The downloader
+    :rtype: Downloader
+    """
+    return get_job().downloader
+
+
+def create_photosets(photoset_ids, directory=None, sync=False,
+                      create_dirs=True):
+    """Create the photosets to be downloaded and their directories
+
+    :param photoset_ids: The photoset ids of flickr
+    :type photoset_ids: list of strs
+    :param directory: The directory of a single photoset, or the directory
+            of the directories named by the ids of many photosets. Default
+            is the current directory, named by the id of a single photoset
+    :type directory: str
+    :param sync: Whether to open the manifest of every directory
+    :type sync: bool
+    :param create_dirs: Whether to create the directories, they are not
+            needed by `gf plan`
+    :type create_dirs: bool
+    :return: The photosets
+    :rtype: list of Photosets
+    """
+    photosets = []
+    for photoset_id in photoset_ids:
+        if len(photoset_ids) == 1:
+            photoset_dir = directory if directory else photoset_id
+        else:
+            photoset_dir = os.path.join(directory or os.curdir, photoset_id)
+        if create_dirs:
+            create_dir(photoset_dir)
+        photoset_manifest = None
+        if sync:
+            photoset_manifest = Manifest(
+                os.path.join(photoset_dir, MANIFEST_NAME)
+            )
+        photosets.append(Photoset(photoset_id, photoset_dir, photoset_manifest))
+    return photosets
+
+
+def init_logger():
+    """Initialize the logger and set its format
+    """
+    formatter = logging.Formatter('%(levelname)s: %(message)s')
+    console = logging.StreamHandler(stream=sys.stdout)
+    console.setLevel(logging.INFO)
+    console.setFormatter(formatter)
+    logger.addHandler(console)
+
+
+def _get_megabytes(value):
+    """Convert megabytes given in the CLI to bytes
+
+    :param value: The number of megabytes, None for no limit
+    :type value: float
+    :rtype: int
+    """
+    if value is None:
+        return None
+    return int(value * 1024 * 1024)
+
+
+def _parse_shard(text):
+    """Parse the `i/N` shard given in the CLI
+
+    :param text: ex: 0/4 for the first of 4 shards
+    :type text: str
+    :return: `(index, count)`
+    :rtype: tuple
+    """
+    try:
+        index, count = [int(value) for value in text.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('%r is not <index>/<count>' % text)
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(
+            'The index of %r must be from 0 to the count - 1' % text
+        )
+    return index, count
+
+
+def _parse_post_hooks(text):
+    """Parse the comma separated hooks of --post given in the CLI
+
+    :param text: ex: thumbnail,checksum
+    :type text: str
+    :return: The hook names
+    :rtype: list of strs
+    """
+    hooks = []
+    for hook in text.split(','):
+        if hook not in POST_HOOKS:
+            raise argparse.ArgumentTypeError('%r is not one of %s' % (
+                hook, ', '.join(POST_HOOKS)
+            ))
+        if hook not in hooks:
+            hooks.append(hook)
+    return hooks
+
+
+def _parse_cli_args(command=None):
+    """Parse the arguments from CLI using ArgumentParser
+
+    :param command: `plan` or `fetch` given after `gf`, None to download
+    :type command: str
+    :return: The arguments parsed by ArgumentParser
+    :rtype: Namespace
+    """
+    parser = argparse.ArgumentParser(
+        prog='gf %s' % command if command else None
+    )
+    parser.add_argument(
+        '-g',
+        nargs='+',
+        default=[],
+        help='The photoset ids to be downloaded',
+        metavar='<photoset_id>'
+    )
+    parser.add_argument(
+        '--ids-file',
+        help=(
+            'A file of photoset ids to be downloaded, one id per line'
+        ),
+        metavar='<path>'
+    )
+    parser.add_argument(
+        '--user',
+        help=(
+            'Download all photosets of the user'
+        ),
+        metavar='<user_id>'
+    )
+    parser.add_argument(
+        '-s',
+        default=1,
+        help=(
+            'Image size. %s is smallest, 1 is original size. '
+            'Default: 1' % len(SIZE_SUFFIXES)
+        ),
+        type=int,
+        choices=range(0, 10),
+        metavar='<num>'
+    )
+    parser.add_argument(
+        '--max-pixels',
+        default=None,
+        help=(
+            'Download the largest size not wider or taller than this, '
+            'within the size given by -s'
+        ),
+        type=int,
+        metavar='<px>'
+    )
+    parser.add_argument(
+        '--max-photo-size',
+        default=None,
+        help=(
+            'Download the largest size not larger than this in MB, '
+            'the size of each image is requested with a HEAD request'
+        ),
+        type=float,
+        metavar='<MB>'
+    )
+    parser.add_argument(
+        '--budget',
+        default=None,
+        help=(
+            'The max MB of images downloaded by the run. Smaller sizes are '
+            'chosen when a photo does not fit what is left, photos that '
+            'do not fit at all are skipped'
+        ),
+        type=float,
+        metavar='<MB>'
+    )
+    parser.add_argument(
+        '-d',
+        default=None,
+        help=(
+            'The path to store the downloaded images. '
+            'Automatically create it if not exist. '
+            'Default use the photoset id as folder name under current path. '
+            'With many photosets, each photoset is stored in a folder named '
+            'by its id under this path'
+        ),
+        metavar='<path>'
+    )
+    parser.add_argument(
+        '-O',
+        default=1,
+        help=(
+            '0 for single process, '
+            '1 for multithread. '
+            '2 for event driven. '
+            '3 for asyncio. '
+            '4 for multiprocess. '
+            'Default: 1'
+        ),
+        type=int,
+        choices=range(0, 5),
+        metavar='<num>'
+    )
+    parser.add_argument(
+        '--processes',
+        default=None,
+        help=(
+            'The number of worker processes of the multiprocess mode, '
+            'each downloads with its own workers. '
+            'Default: the number of CPUs'
+        ),
+        type=int,
+        metavar='<num>'
+    )
+    parser.add_argument(
+        '--resolve-workers',
+        default=4,
+        help=(
+            'The number of workers resolving the photo urls. '
+            'Default: 4'
+        ),
+        type=int,
+        metavar='<num>'
+    )
+    parser.add_argument(
+        '--min-transfer-workers',
+        default=2,
+        help=(
+            'The min number of images downloaded at the same time. '
+            'The number is adjusted between the min and the max '
+            'to reach the best throughput. '
+            'Default: 2'
+        ),
+        type=int,
+        metavar='<num>'
+    )
+    parser.add_argument(
+        '--transfer-workers',
+        default=32,
+        help=(
+            'The max number of images downloaded at the same time. '
+            'Default: 32'
+        ),
+        type=int,
+        metavar='<num>'
+    )
+    parser.add_argument(
+        '--queue-size',
+        default=0,
+        help=(
+            'The max number of photos waiting for each stage. '
+            'Default: twice the number of transfer workers'
+        ),
+        type=int,
+        metavar='<num>'
+    )
+    parser.add_argument(
+        '--api-rate',
+        default=API_RATE,
+        help=(
+            'The max number of API calls per second, with bursts of %s calls. '
+            'Default: %s' % (API_BURST, API_RATE)
+        ),
+        type=float,
+        metavar='<num>'
+    )
+    parser.add_argument(
+        '--retries',
+        default=5,
+        help=(
+            'The number of retries of a request failed by rate limits, '
+            'server or connection errors. '
+            'Default: 5'
+        ),
+        type=int,
+        metavar='<num>'
+    )
+    parser.add_argument(
+        '--chunk-size',
+        default=64 * 1024,
+        help=(
+            'The number of bytes read and written at a time. '
+            'Default: 65536'
+        ),
+        type=int,
+        metavar='<bytes>'
+    )
+    parser.add_argument(
+        '--segments',
+        default=SEGMENTS,
+        help=(
+            'The number of concurrent Range requests downloading a photo '
+            'larger than --segment-threshold, 1 to download every photo '
+            'in one stream. Default: %s' % SEGMENTS
+        ),
+        type=int,
+        metavar='<num>'
+    )
+    parser.add_argument(
+        '--segment-threshold',
+        default=SEGMENT_THRESHOLD,
+        help=(
+            'The size in MB above which a photo is downloaded in segments. '
+            'Default: %s' % SEGMENT_THRESHOLD
+        ),
+        type=float,
+        metavar='<MB>'
+    )
+    parser.add_argument(
+        '--fsync',
+        help=(
+            'Flush every image to disk before it is renamed in place'
+        ),
+        action='store_true'
+    )
+    parser.add_argument(
+        '--sync',
+        help=(
+            'Only download the photos which are new or changed since '
+            'the last sync, using an index stored in the directory'
+        ),
+        action='store_true'
+    )
+    parser.add_argument(
+        '--prune',
+        help=(
+            'With --sync, remove the photos which are no longer in the photoset'
+        ),
+        action='store_true'
+    )
+    parser.add_argument(
+        '--archive',
+        help=(
+            'Write the photos into a .tar or .zip archive instead of '
+            'directories, an existing archive is appended to. A tar archive '
+            'stays readable if the run is killed'
+        ),
+        metavar='<path>'
+    )
+    parser.add_argument(
+        '--post',
+        default=[],
+        help=(
+            'Comma separated hooks run on every photo file in a pool of '
+            'processes as soon as it is complete: thumbnail, exif (a JSON '
+            'sidecar) and checksum (an md5 file). thumbnail and exif need '
+            'Pillow'
+        ),
+        type=_parse_post_hooks,
+        metavar='<hook,...>'
+    )
+    parser.add_argument(
+        '--post-processes',
+        default=None,
+        help=(
+            'The number of processes running the hooks of --post. '
+            'Default: the number of CPUs'
+        ),
+        type=int,
+        metavar='<num>'
+    )
+    parser.add_argument(
+        '--post-queue-size',
+        default=0,
+        help=(
+            'The max number of photos waiting for the hooks of --post, the '
+            'downloads wait when it is full. '
+            'Default: twice the number of post processes'
+        ),
+        type=int,
+        metavar='<num>'
+    )
+    parser.add_argument(
+        '--thumbnail-size',
+        default=THUMBNAIL_SIZE,
+        help=(
+            'The max width and height of the thumbnails in px. '
+            'Default: %s' % THUMBNAIL_SIZE
+        ),
+        type=int,
+        metavar='<px>'
+    )
+    parser.add_argument(
+        '--progress-interval',
+        default=PROGRESS_INTERVAL,
+        help=(
+            'The seconds between two progress lines, 0 to disable. '
+            'Default: %s' % PROGRESS_INTERVAL
+        ),
+        type=float,
+        metavar='<sec>'
+    )
+    parser.add_argument(
+        '--stats-json',
+        help=(
+            'Write the counters, the throughput and the latency of each '
+            'stage to a JSON file at the end'
+        ),
+        metavar='<path>'
+    )
+    parser.add_argument(
+        '--api-cache',
+        help=(
+            'Cache the API responses in a file, so reruns and retries '
+            'do not call the API again'
+        ),
+        metavar='<path>'
+    )
+    parser.add_argument(
+        '--api-cache-size',
+        default=API_CACHE_SIZE,
+        help=(
+            'The max size in MB of the API cache, the least recently used '
+            'responses are removed first. '
+            'Default: %s' % API_CACHE_SIZE
+        ),
+        type=int,
+        metavar='<MB>'
+    )
+    parser.add_argument(
+        '--store',
+        help=(
+            'Store every photo once in this directory and hardlink it into '
+            'the photoset directories, so a photo in many photosets is '
+            'downloaded and stored once'
+        ),
+        metavar='<path>'
+    )
+    parser.add_argument(
+        '--dry-run',
+        help=(
+            'List the photos and resolve their urls, but download nothing'
+        ),
+        action='store_true'
+    )
+    parser.add_argument(
+        '--trace',
+        help=(
+            'Record the API calls, transfers and disk writes of every worker '
+            'to a JSON file, which can be opened in chrome://tracing '
+            'or Perfetto'
+        ),
+        metavar='<path>'
+    )
+    parser.add_argument(
+        '-u',
+        help=(
+            'Set your API key'
+        ),
+        action='store_true'
+    )
+    if command == 'plan':
+        parser.add_argument(
+            '--manifest',
+            required=True,
+            help=(
+                'Write the resolved photos to this JSON lines file, with '
+                'their urls, sizes and paths, to be downloaded by `gf fetch`'
+            ),
+            metavar='<path>'
+        )
+    elif command == 'fetch':
+        parser.add_argument(
+            '--manifest',
+            required=True,
+            help=(
+                'Download the photos of this file written by `gf plan`, '
+                'the photos complete on disk are skipped. Relative paths '
+                'are under -d if given'
+            ),
+            metavar='<path>'
+        )
+        parser.add_argument(
+            '--shard',
+            default=(0, 1),
+            help=(
+                'Download only the i th of N shards of the photos, from 0 to '
+                'N - 1. A photo is in the same shard in every run. '
+                'Default: 0/1'
+            ),
+            type=_parse_shard,
+            metavar='<i/N>'
+        )
+    args = parser.parse_args(sys.argv[2:] if command else sys.argv[1:])
+    if command and (args.archive or args.sync):
+        parser.error('--archive and --sync can not be used with %s' % command)
+    if args.post and (args.archive or command == 'plan'):
+        parser.error('--post can not be used with --archive or plan')
+    if command == 'fetch' and (args.g or args.ids_file or args.user):
+        parser.error(
+            'fetch downloads the photos of --manifest, '
+            '-g, --ids-file and --user can not be used'
+        )
+    if args.archive and (args.d or args.sync):
+        parser.error('--archive can not be used with -d or --sync')
+    logger.debug(args)
+    return args
+
+
+def _gevent_patch():
+    """Patch the modules with gevent
+
+    :return: Default is GEVENT. If it not supports gevent then return MULTITHREAD
+    :rtype: int
+    """
+    global gevent, grequests, _local
+    try:
+        import gevent
+        import grequests
+    except ImportError:
+        logger.warn('gevent not exist, fallback to multiprocess...')
+        return MULTITHREAD
+    else:
+        from gevent import monkey
+        monkey.patch_all()  # Must patch before get_photos_info
+        # Every greenlet runs its own job like a thread
+        _local = threading.local()
+        return GEVENT
+
+
+def _asyncio_check():
+    """Check the modules needed by the asyncio mode, which needs Python 3
+    and aiohttp. Nothing is patched.
+
+    :return: Default is ASYNCIO. If it not supports asyncio then return MULTITHREAD
+    :rtype: int
+    """
+    try:
+        from grabflickr import aio
+    except (ImportError, SyntaxError):
+        logger.warn('asyncio or aiohttp not exist, fallback to multithread...')
+        return MULTITHREAD
+    else:
+        return ASYNCIO
+
+
+def main():
+    """The main procedure
+    """
+    if sys.argv[1:2] == ['serve']:
+        from grabflickr import serve
+        return serve.main(sys.argv[2:])
+
+    command = None
+    if sys.argv[1:2] in (['plan'], ['fetch']):
+        command = sys.argv[1]
+    init_logger()
+    args = _parse_cli_args(command)
+
+    if args.u:
+        enter_api_key()
+        return
+
+    if args.O == GEVENT and args.post:
+        # The process pool of --post does not work with patched modules
+        logger.warn(
+            '--post does not work with gevent, fallback to multithread...'
+        )
+        args.O = MULTITHREAD
+    if args.O == GEVENT:
+        args.O = _gevent_patch()
+    elif args.O == ASYNCIO:
+        args.O = _asyncio_check()
+
+    api_key, api_secret = read_config()
+    downloader = Downloader(
+        api_key, api_secret,
+        # A connection for every segment of every transfer, and one more
+        # for the photoset listing prefetch
+        pool_size=args.resolve_workers +
+        args.transfer_workers * max(1, args.segments) + 1,
+        api_rate=args.api_rate,
+        retries=args.retries,
+        api_cache=ApiCache(args.api_cache, args.api_cache_size * 1024 * 1024)
+        if args.api_cache else None,
+        content_store=ContentStore(args.store) if args.store else None
+    )
+    job = Job(
+        downloader, [],
+        engine=args.O,
+        processes=args.processes,
+        size_policy=SizePolicy(
+            args.s, args.max_pixels, _get_megabytes(args.max_photo_size),
+            ByteBudget(_get_megabytes(args.budget))
+            if args.budget is not None else None
+        ),
+        chunk_size=args.chunk_size,
+        fsync=args.fsync,
+        segments=args.segments,
+        segment_threshold=_get_megabytes(args.segment_threshold),
+        resolve_workers=args.resolve_workers,
+        min_transfer_workers=args.min_transfer_workers,
+        transfer_workers=args.transfer_workers,
+        queue_size=args.queue_size,
+        trace=bool(args.trace),
+        dry_run=args.dry_run,
+        prune=args.prune
+    )
+
+    if command == 'fetch':
+        try:
+            job.photosets, job.photos = plan_photos(
+                read_plan(args.manifest, args.shard), args.d
+            )
+        except (ValueError, IOError) as e:
+            logger.error('%s', e)
+            downloader.close()
+            return 1
+    else:
+        photoset_ids = list(args.g)
+        if args.ids_file:
+            photoset_ids.extend(read_photoset_ids(args.ids_file))
+        if args.user:
+            with job.activate():
+                photoset_ids.extend(iter_user_photosets(args.user))
+        if not photoset_ids:
+            logger.error('No photoset to download')
+            downloader.close()
+            return 1
+        directory = args.d
+        try:
+            if args.archive:
+                job.sink = open_archive(args.archive, args.fsync)
+                directory = job.sink.root
+            if command == 'plan':
+                job.plan = PlanWriter(args.manifest)
+        except (ValueError, IOError) as e:
+            logger.error('%s', e)
+            downloader.close()
+            return 1
+        job.photosets = create_photosets(
+            photoset_ids, directory, args.sync, create_dirs=command is None
+        )
+
+    if args.post:
+        from grabflickr import post
+        hooks = post.check_hooks(args.post)
+        if hooks:
+            # Before the workers start, every process of the pool is forked
+            # from this thread
+            job.post = post.PostProcessor(
+                hooks, args.post_processes, args.post_queue_size,
+                args.thumbnail_size
+            )
+
+    reporter = None
+    if args.progress_interval > 0:
+        reporter = ProgressReporter(args.progress_interval, job.metrics)
+        reporter.start()
+    try:
+        try:
+            failed = job.run()
+        finally:
+            if reporter is not None:
+                reporter.stop()
+        # The connection statistics are read from the pools of the session,
+        # which are emptied when it is closed
+        downloader.log_session_stats()
+        if args.stats_json:
+            job.dump_metrics(args.stats_json)
+        if job.tracer is not None:
+            job.tracer.dump(args.trace)
+    finally:
+        downloader.close()
+    if failed:
+        return 1
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+"""The post-processing stage (`--post`). The hooks run on every photo file in
+a pool of processes as soon as the file is complete, while the other photos
+are still downloading, so the files are read back from the page cache
+instead of by a separate pass over the disk::
+
+    thumbnail  <directory>/.thumbnails/<file name>, at most --thumbnail-size
+               px wide and high, needs Pillow
+    exif       <file name>.json with the photo id, title, url and the EXIF
+               tags of the image, needs Pillow
+    checksum   <file name>.md5 in the format of md5sum, the md5 computed
+               while downloading is used if any
+
+A hook does nothing if its file exists, so a rerun only completes the files
+which are missing.
+"""
+
+from __future__ import absolute_import
+
+import errno
+import hashlib
+import json
+import os
+import pickle
+import sys
+import threading
+import time
+
+from grabflickr import grabflickr as gf
+
+
+THUMBNAIL_DIR = '.thumbnails'
+EXIF_SUFFIX = '.json'
+CHECKSUM_SUFFIX = '.md5'
+# The hooks which open the image with Pillow
+IMAGE_HOOKS = ('thumbnail', 'exif')
+CHUNK_SIZE = 64 * 1024
+
+
+def _write_file(path, write):
+    """Write a file through a `.part` file renamed in place, so a killed run
+    does not leave a half file which looks done
+
+    :param path: The path of the file
+    :type path: str
+    :param write: Called with the path of the `.part` file
+    :type write: function
+    """
+    part_path = path + gf.PART_SUFFIX
+    write(part_path)
+    os.rename(part_path, path)
+
+
+def make_thumbnail(task, image, options):
+    """Write the thumbnail of the photo, in the same format
+
+    :param task: The photo from :func:`create_task`
+    :type task: dict
+    :param image: The opened image
+    :type image: PIL.Image.Image
+    :param options: `thumbnail_size` in px
+    :type options: dict
+    """
+    directory, file_name = os.path.split(task['file_path'])
+    thumbnail_dir = os.path.join(directory, THUMBNAIL_DIR)
+    thumbnail_path = os.path.join(thumbnail_dir, file_name)
+    if os.path.exists(thumbnail_path):
+        return
+    try:
+        os.makedirs(thumbnail_dir)
+    except OSError as e:
+        # Created by another process
+        if e.errno != errno.EEXIST:
+            raise
+    image_format = image.format or 'JPEG'
+    thumbnail = image.copy()
+    thumbnail.thumbnail((options['thumbnail_size'], options['thumbnail_size']))
+    if image_format == 'JPEG' and thumbnail.mode not in ('RGB', 'L'):
+        thumbnail = thumbnail.convert('RGB')
+    _write_file(
+        thumbnail_path,
+        lambda part_path: thumbnail.save(part_path, image_format)
+    )
+
+
+def _get_json_value(value):
+    """Convert an EXIF value which is not a JSON type
+    """
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace').rstrip('\x00')
+    if isinstance(value, tuple):
+        return [_get_json_value(item) for item in value]
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def write_exif(task, image, options):
+    """Write the sidecar of the photo with its flickr information and the
+    EXIF tags of the image named by Pillow
+
+    :param task: The photo from :func:`create_task`
+    :type task: dict
+    :param image: The opened image
+    :type image: PIL.Image.Image
+    :param options: Not used
+    :type options: dict
+    """
+    sidecar_path = task['file_path'] + EXIF_SUFFIX
+    if os.path.exists(sidecar_path):
+        return
+    from PIL import ExifTags
+    exif = dict(
+        (ExifTags.TAGS.get(tag, str(tag)), value)
+        for tag, value in image.getexif().items()
+    )
+    width, height = image.size
+    sidecar = {
+        'id': task['id'],
+        'title': task['title'],
+        'url': task['url'],
+        'width': width,
+        'height': height,
+        'exif': exif,
+    }
+
+    def write(part_path):
+        with open(part_path, 'w') as f:
+            json.dump(
+                sidecar, f, indent=2, sort_keys=True, default=_get_json_value
+            )
+            f.write('\n')
+    _write_file(sidecar_path, write)
+
+
+def write_checksum(task, image, options):
+    """Write the md5 of the photo, `md5sum -c` can check it
+
+    :param task: The photo from :func:`create_task`
+    :type task: dict
+    :param image: Not used
+    :type image: None
+    :param options: Not used
+    :type options: dict
+    """
+    checksum_path = task['file_path'] + CHECKSUM_SUFFIX
+    if os.path.exists(checksum_path):
+        return
+    checksum = task['checksum']
+    if checksum is None:
+        hasher = hashlib.md5()
+        with open(task['file_path'], 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                hasher.update(chunk)
+        checksum = hasher.hexdigest()
+
+    def write(part_path):
+        with open(part_path, 'w') as f:
+            f.write('%s  %s\n' % (
+                checksum, os.path.basename(task['file_path'])
+            ))
+    _write_file(checksum_path, write)
+
+
+HOOKS = {
+    'thumbnail': make_thumbnail,
+    'exif': write_exif,
+    'checksum': write_checksum,
+}
+
+
+def run_hooks(hooks, task, options):
+    """Run the hooks on a photo, in a process of the pool. The image is
+    opened once for all the hooks which need it, a failed hook does not stop
+    the others.
+
+    :param hooks: The hook names
+    :type hooks: tuple of strs
+    :param task: The photo from :func:`create_task`
+    :type task: dict
+    :param options: The options of the hooks
+    :type options: dict
+    :return: `(task, seconds, error)`, the error messages of the failed
+            hooks, None if every hook succeeds
+    :rtype: tuple
+    """
+    start = time.time()
+    errors = []
+    image = None
+    try:
+        for hook in hooks:
+            try:
+                if hook in IMAGE_HOOKS and image is None:
+                    from PIL import Image
+                    image = Image.open(task['file_path'])
+                HOOKS[hook](task, image, options)
+            except Exception as e:
+                # Exceptions may not be picklable, send the message only
+                errors.append('%s: %s' % (hook, e))
+    except Exception as e:
+        # Every photo must have a result, or its slot in the pool is lost
+        errors.append(str(e))
+    finally:
+        if image is not None:
+            image.close()
+    return task, time.time() - start, '; '.join(errors) or None
+
+
+def check_hooks(hooks):
+    """Drop the hooks which need Pillow if it is not installed
+
+    :param hooks: The hook names
+    :type hooks: list of strs
+    :return: The hooks which can run
+    :rtype: list of strs
+    """
+    image_hooks = [hook for hook in hooks if hook in IMAGE_HOOKS]
+    if image_hooks:
+        try:
+            import PIL
+        except ImportError:
+            gf.logger.warn(
+                'Pillow not exist, skip the %s hooks...',
+                ', '.join(image_hooks)
+            )
+            return [hook for hook in hooks if hook not in IMAGE_HOOKS]
+    return list(hooks)
+
+
+def create_task(photo, download_url, file_path, checksum=None):
+    """Create the picklable task of a photo file
+
+    :param photo: The photo information include id and title
+    :type photo: dict
+    :param download_url: Photo download url
+    :type download_url: str
+    :param file_path: The path of the photo file
+    :type file_path: str
+    :param checksum: The md5 computed while downloading if any
+    :type checksum: str
+    :rtype: dict
+    """
+    return {
+        'id': photo['id'],
+        'title': photo['title'],
+        'url': download_url,
+        'file_path': file_path,
+        'checksum': checksum,
+    }
+
+
+class PostProcessor(object):
+    """Run the hooks on the photo files in a pool of processes. At most
+    `queue_size` photos wait for or are in the pool, :meth:`submit` blocks
+    until one of them is done, so slow hooks slow the transfers down instead
+    of piling the photos up in memory.
+    The pool is created at once, before the workers of the engines start.
+
+    :param hooks: The names of the hooks in `HOOKS`
+    :type hooks: list of strs
+    :param processes: The number of processes, None for the number of CPUs
+    :type processes: int
+    :param queue_size: The max number of photos in the pool, 0 for twice the
+            number of processes
+    :type queue_size: int
+    :param thumbnail_size: The max width and height of the thumbnails
+    :type thumbnail_size: int
+    """
+
+    def __init__(self, hooks, processes=None, queue_size=0,
+                 thumbnail_size=gf.THUMBNAIL_SIZE):
+        import multiprocessing
+        self.hooks = tuple(hooks)
+        self.processes = processes or multiprocessing.cpu_count()
+        self.queue_size = queue_size or self.processes * 2
+        self.options = {'thumbnail_size': thumbnail_size}
+        self.done = 0
+        self.failed = 0
+        self._slots = threading.BoundedSemaphore(self.queue_size)
+        self._lock = threading.Lock()
+        self._pool = multiprocessing.Pool(self.processes)
+
+    def submit(self, task, metrics=None):
+        """Run the hooks on a photo, wait while the pool is full
+
+        :param task: The photo from :func:`create_task`
+        :type task: dict
+        :param metrics: The metrics the time of the hooks is recorded to as
+                the `post` stage, default is the metrics of the current job
+        :type metrics: grabflickr.grabflickr.Metrics
+        """
+        if metrics is None:
+            metrics = gf.get_metrics()
+        self._slots.acquire()
+
+        def done(result):
+            self._done(metrics, *result)
+
+        def failed(error):
+            # run_hooks is not run, ex: the task cannot be pickled
+            self._done(metrics, task, 0.0, error)
+        kwargs = {'callback': done}
+        if sys.version_info[0] > 2:
+            kwargs['error_callback'] = failed
+        else:
+            # Python 2 has no error_callback, a task which cannot be pickled
+            # would never be done, so it is checked here
+            try:
+                pickle.dumps(task, pickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                failed(e)
+                return
+        try:
+            self._pool.apply_async(
+                run_hooks, (self.hooks, task, self.options), **kwargs
+            )
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _done(self, metrics, task, seconds, error):
+        """Count a photo as done and free its slot, in the result thread of
+        the pool
+        """
+        try:
+            metrics.observe('post', seconds, error is not None)
+            with self._lock:
+                self.done += 1
+                if error is not None:
+                    self.failed += 1
+            if error is not None:
+                gf.logger.error(
+                    'Failed to post-process %s: %s',
+                    gf._log_text(task['file_path']), error
+                )
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Wait for the photos in the pool and stop its processes
+        """
+        self._pool.close()
+        self._pool.join()
+        gf.logger.info(
+            'Post-process %s photos with %s, %s failed',
+            self.done, ', '.join(self.hooks), self.failed
+        )
+
+
+class _WorkerPostProcessor(object):
+    """The post-processor of a worker process of `-O 4`, the tasks are sent
+    to the pool of the main process, a worker process can not have one
+
+    :param send: Called with a task
+    :type send: function
+    """
+
+    def __init__(self, send):
+        self._send = send
+
+    def submit(self, task, metrics=None):
+        self._send(task)
+
+    def close(self):
+        pass
@@ -0,0 +1,776 @@
+# -*- coding: utf-8 -*-
+"""The daemon mode (`gf serve`). It keeps one
+:class:`grabflickr.grabflickr.Downloader`, so the API key, the session with
+its warm connections and the API cache are reused by every job, and runs the
+photoset jobs posted to a local HTTP API over TCP or a Unix socket. The
+worker threads and processes are started by each job::
+
+    POST   /jobs       Queue a job, ex: {"photosets": ["123"], "priority": 1}
+    GET    /jobs       The status of all jobs
+    GET    /jobs/<id>  The status of a job
+    PATCH  /jobs/<id>  Change the priority of a queued job
+    DELETE /jobs/<id>  Cancel a job
+
+The jobs are kept in a SQLite database. A job interrupted by a restart is
+queued again, so no job is lost. The `directory` and `archive` of a job are
+names in the working directory of the daemon, a job cannot write anywhere
+else.
+"""
+
+from __future__ import absolute_import
+
+import argparse
+import json
+import os
+import re
+import signal
+import sqlite3
+import sys
+import threading
+import time
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+except ImportError:  # Python 3
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn, UnixStreamServer
+
+from grabflickr import grabflickr as gf
+
+
+QUEUE_PATH = os.path.expanduser('~/.grabflickr-queue.db')
+PORT = 8787
+# A job is queued, then running, then done, failed or cancelled
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+JOB_PATH = re.compile(r'^/jobs/(\d+)$')
+# The options of a posted job and how they are converted, the other
+# options are the arguments of grabflickr.grabflickr.Job
+JOB_OPTIONS = {
+    'photosets': list,
+    'directory': str,
+    'archive': str,
+    'sync': bool,
+    'prune': bool,
+    'priority': int,
+    'engine': int,
+    'processes': int,
+    'size': int,
+    'max_pixels': int,
+    'max_photo_size': float,
+    'budget': float,
+    'chunk_size': int,
+    'fsync': bool,
+    'segments': int,
+    'segment_threshold': float,
+    'resolve_workers': int,
+    'min_transfer_workers': int,
+    'transfer_workers': int,
+    'queue_size': int,
+    'dry_run': bool,
+}
+# The event driven mode patches the whole process, it is not run by jobs
+ENGINES = (gf.SINGLE_PROCESS, gf.MULTITHREAD, gf.ASYNCIO, gf.MULTIPROCESS)
+# The seconds between two checks of the queue when no job is posted
+SCHEDULE_POLL = 1.0
+
+
+class JobError(Exception):
+    """A posted job or a request which cannot be accepted
+    """
+
+
+def _is_name(value):
+    """Check a path of a posted job is a name in the working directory,
+    without a path separator or `..`
+
+    :param value: The path
+    :type value: str
+    :rtype: bool
+    """
+    return '..' not in value and not any(
+        sep in value for sep in (os.sep, os.altsep) if sep
+    )
+
+
+def parse_job(spec):
+    """Check the options of a posted job and convert them
+
+    :param spec: The options of the job, `photosets` is required
+    :type spec: dict
+    :return: The converted options
+    :rtype: dict
+    """
+    if not isinstance(spec, dict):
+        raise JobError('The job must be a JSON object')
+    unknown = sorted(set(spec) - set(JOB_OPTIONS))
+    if unknown:
+        raise JobError('Unknown options: %s' % ', '.join(unknown))
+    options = {}
+    for name, value in spec.items():
+        if value is None:
+            continue
+        convert = JOB_OPTIONS[name]
+        if convert is list:
+            if not isinstance(value, list) or not value:
+                raise JobError('%s must be a list of ids' % name)
+            value = [str(item) for item in value]
+        elif convert is bool:
+            # A string like "false" would be true
+            if not isinstance(value, bool):
+                raise JobError('%s must be true or false' % name)
+        else:
+            try:
+                value = convert(value)
+            except (TypeError, ValueError):
+                raise JobError('%s must be %s' % (name, convert.__name__))
+        options[name] = value
+    if 'photosets' not in options:
+        raise JobError('photosets is required')
+    # The ids and the paths name the files written by the job
+    if not all(_is_name(value) for value in options['photosets']):
+        raise JobError('photosets must not have a path separator or ..')
+    for name in ('directory', 'archive'):
+        if name in options and not _is_name(options[name]):
+            raise JobError(
+                '%s must be a name in the working directory of the daemon' %
+                name
+            )
+    if options.get('engine', gf.MULTITHREAD) not in ENGINES:
+        raise JobError('engine must be one of %s' % (ENGINES,))
+    if 'archive' in options and ('directory' in options or
+                                 options.get('sync')):
+        raise JobError('archive can not be used with directory or sync')
+    if 'archive' in options and os.path.splitext(
+            options['archive'])[1].lower() not in gf.ARCHIVE_SINKS:
+        raise JobError('archive must be a %s file' % ' or '.join(
+            sorted(gf.ARCHIVE_SINKS)
+        ))
+    return options
+
+
+def create_job(downloader, options):
+    """Create the job of the options checked by :func:`parse_job`
+
+    :param downloader: The downloader of the daemon
+    :type downloader: grabflickr.grabflickr.Downloader
+    :param options: The options of the job
+    :type options: dict
+    :rtype: grabflickr.grabflickr.Job
+    """
+    budget = gf._get_megabytes(options.get('budget'))
+    size_policy = gf.SizePolicy(
+        options.get('size', 1), options.get('max_pixels'),
+        gf._get_megabytes(options.get('max_photo_size')),
+        gf.ByteBudget(budget) if budget is not None else None
+    )
+    kwargs = dict(
+        (name, options[name]) for name in (
+            'engine', 'processes', 'chunk_size', 'fsync', 'segments',
+            'resolve_workers', 'min_transfer_workers', 'transfer_workers',
+            'queue_size', 'dry_run', 'prune',
+        ) if name in options
+    )
+    if 'segment_threshold' in options:
+        kwargs['segment_threshold'] = gf._get_megabytes(
+            options['segment_threshold']
+        )
+    directory = options.get('directory')
+    sink = None
+    if 'archive' in options:
+        try:
+            sink = gf.open_archive(options['archive'], options.get('fsync'))
+        except (ValueError, IOError) as e:
+            raise JobError(str(e))
+        directory = sink.root
+    try:
+        photosets = gf.create_photosets(
+            options['photosets'], directory, options.get('sync', False)
+        )
+    except SystemExit:
+        # create_dir exits when the path is not a directory
+        if sink is not None:
+            sink.close()
+        raise JobError('Cannot create the directories of the photosets')
+    return gf.Job(
+        downloader, photosets, size_policy=size_policy, sink=sink, **kwargs
+    )
+
+
+class JobQueue(object):
+    """The jobs of the daemon stored in a SQLite database, the queued jobs
+    are taken by priority, then in the order they are posted
+
+    :param path: The path of the SQLite database
+    :type path: str
+    """
+
+    COLUMNS = (
+        'id', 'state', 'priority', 'options', 'created', 'started',
+        'finished', 'failed', 'counters', 'error',
+    )
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, state TEXT, '
+            'priority INTEGER, options TEXT, created REAL, started REAL, '
+            'finished REAL, failed INTEGER, counters TEXT, error TEXT)'
+        )
+        # The jobs running when the daemon stopped are run again
+        self._conn.execute(
+            'UPDATE jobs SET state = ?, started = NULL WHERE state = ?',
+            (QUEUED, RUNNING)
+        )
+        self._conn.commit()
+
+    def _to_dict(self, row):
+        """Convert a row to the status of the job
+        """
+        job = dict(zip(self.COLUMNS, row))
+        job['options'] = json.loads(job['options'])
+        if job['counters'] is not None:
+            job['counters'] = json.loads(job['counters'])
+        return job
+
+    def add(self, options):
+        """Queue a job
+
+        :param options: The options checked by :func:`parse_job`
+        :type options: dict
+        :return: The job id
+        :rtype: int
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                'INSERT INTO jobs (state, priority, options, created) '
+                'VALUES (?, ?, ?, ?)', (
+                    QUEUED, options.get('priority', 0), json.dumps(options),
+                    time.time()
+                )
+            )
+            self._conn.commit()
+            return cursor.lastrowid
+
+    def take(self):
+        """Take the next queued job and mark it running
+
+        :return: The status of the job, None if no job is queued
+        :rtype: dict
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT %s FROM jobs WHERE state = ? '
+                'ORDER BY priority DESC, id LIMIT 1' % ', '.join(self.COLUMNS),
+                (QUEUED,)
+            ).fetchone()
+            if row is None:
+                return None
+            job = self._to_dict(row)
+            job['state'] = RUNNING
+            job['started'] = time.time()
+            self._conn.execute(
+                'UPDATE jobs SET state = ?, started = ? WHERE id = ?',
+                (RUNNING, job['started'], job['id'])
+            )
+            self._conn.commit()
+        return job
+
+    def get(self, job_id):
+        """Get the status of a job
+
+        :param job_id: The job id
+        :type job_id: int
+        :return: The status, None if there is no such job
+        :rtype: dict
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT %s FROM jobs WHERE id = ?' % ', '.join(self.COLUMNS),
+                (job_id,)
+            ).fetchone()
+        return self._to_dict(row) if row is not None else None
+
+    def list(self):
+        """Get the status of all jobs, the latest first
+
+        :rtype: list of dicts
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT %s FROM jobs ORDER BY id DESC' %
+                ', '.join(self.COLUMNS)
+            ).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def update(self, job_id, expected, **values):
+        """Change a job if it is in the expected state
+
+        :param job_id: The job id
+        :type job_id: int
+        :param expected: The expected state of the job
+        :type expected: str
+        :param values: The new values of the columns
+        :type values: dict
+        :return: Whether the job is changed
+        :rtype: bool
+        """
+        names = sorted(values)
+        params = []
+        for name in names:
+            value = values[name]
+            if name == 'counters':
+                value = json.dumps(value)
+            params.append(value)
+        with self._lock:
+            cursor = self._conn.execute(
+                'UPDATE jobs SET %s WHERE id = ? AND state = ?' % ', '.join(
+                    '%s = ?' % name for name in names
+                ), params + [job_id, expected]
+            )
+            self._conn.commit()
+            return cursor.rowcount > 0
+
+    def close(self):
+        """Close the database
+        """
+        self._conn.close()
+
+
+class Daemon(object):
+    """Run the queued jobs on one downloader, at most `job_num` at a time
+
+    :param downloader: The downloader shared by the jobs
+    :type downloader: grabflickr.grabflickr.Downloader
+    :param queue: The jobs
+    :type queue: JobQueue
+    :param job_num: The max number of jobs running at a time
+    :type job_num: int
+    """
+
+    def __init__(self, downloader, queue, job_num):
+        self.downloader = downloader
+        self.queue = queue
+        self._job_num = job_num
+        self._condition = threading.Condition()
+        # The running jobs by id, None until the job is created
+        self._running = {}
+        self._threads = []
+        self._stopping = False
+        self._scheduler = None
+
+    def start(self):
+        """Start running the queued jobs in the background
+        """
+        self._scheduler = threading.Thread(target=self._schedule)
+        self._scheduler.daemon = True
+        self._scheduler.start()
+
+    def stop(self):
+        """Stop taking jobs, cancel the running jobs and wait for them.
+        They are left running in the queue, so they are run again at the
+        next start.
+        """
+        with self._condition:
+            self._stopping = True
+            for job in self._running.values():
+                if isinstance(job, gf.Job):
+                    job.cancel()
+            self._condition.notify_all()
+        if self._scheduler is not None:
+            self._scheduler.join()
+        for thread in self._threads:
+            thread.join()
+
+    def submit(self, spec):
+        """Queue a posted job
+
+        :param spec: The options of the job
+        :type spec: dict
+        :return: The status of the job
+        :rtype: dict
+        """
+        job_id = self.queue.add(parse_job(spec))
+        with self._condition:
+            self._condition.notify_all()
+        gf.logger.info('Queue job %s', job_id)
+        return self.status(job_id)
+
+    def status(self, job_id):
+        """Get the status of a job, with the live counters if it is running
+
+        :param job_id: The job id
+        :type job_id: int
+        :return: The status, None if there is no such job
+        :rtype: dict
+        """
+        status = self.queue.get(job_id)
+        with self._condition:
+            job = self._running.get(job_id)
+        if status is not None and isinstance(job, gf.Job):
+            status['counters'] = job.metrics.snapshot()['counters']
+        return status
+
+    def set_priority(self, job_id, priority):
+        """Change the priority of a queued job
+
+        :param job_id: The job id
+        :type job_id: int
+        :param priority: The new priority, the higher the earlier
+        :type priority: int
+        :return: The status of the job, None if there is no such job
+        :rtype: dict
+        """
+        if not self.queue.update(job_id, QUEUED, priority=int(priority)):
+            if self.queue.get(job_id) is None:
+                return None
+            raise JobError('Only the priority of a queued job can change')
+        return self.status(job_id)
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job
+
+        :param job_id: The job id
+        :type job_id: int
+        :return: The status of the job, None if there is no such job
+        :rtype: dict
+        """
+        with self._condition:
+            if self.queue.update(
+                    job_id, QUEUED, state=CANCELLED, finished=time.time()):
+                gf.logger.info('Cancel job %s', job_id)
+            elif job_id in self._running:
+                job = self._running[job_id]
+                if job is None:
+                    # The job is being created, _run cancels it
+                    self._running[job_id] = _CANCELLED
+                elif job is not _CANCELLED:
+                    job.cancel()
+                gf.logger.info('Cancel job %s', job_id)
+        return self.status(job_id)
+
+    def _schedule(self):
+        """Start the queued jobs while there are free slots
+        """
+        while True:
+            with self._condition:
+                while not self._stopping and \
+                        len(self._running) >= self._job_num:
+                    self._condition.wait(SCHEDULE_POLL)
+                if self._stopping:
+                    return
+                status = self.queue.take()
+                if status is None:
+                    self._condition.wait(SCHEDULE_POLL)
+                    continue
+                self._running[status['id']] = None
+            thread = threading.Thread(target=self._run, args=(status,))
+            thread.daemon = True
+            thread.start()
+            self._threads = [
+                worker for worker in self._threads if worker.is_alive()
+            ] + [thread]
+
+    def _run(self, status):
+        """Run a job taken from the queue and record how it ends
+        """
+        job_id = status['id']
+        gf.logger.info('Start job %s', job_id)
+        job = None
+        error = None
+        try:
+            job = create_job(self.downloader, status['options'])
+            with self._condition:
+                if self._running.get(job_id) is _CANCELLED:
+                    job.cancel()
+                self._running[job_id] = job
+            job.run()
+        except Exception as e:
+            gf.logger.exception('Job %s failed', job_id)
+            error = str(e)
+        with self._condition:
+            del self._running[job_id]
+            self._condition.notify_all()
+            stopping = self._stopping
+        if stopping:
+            # Left running, so it is run again at the next start
+            return
+        if job is not None and job.cancelled:
+            state = CANCELLED
+        elif error is not None or job.failed:
+            state = FAILED
+        else:
+            state = DONE
+        self.queue.update(
+            job_id, RUNNING, state=state, finished=time.time(),
+            failed=job.failed if job is not None else None,
+            counters=(
+                job.metrics.snapshot()['counters'] if job is not None
+                else None
+            ),
+            error=error
+        )
+        gf.logger.info('Job %s %s', job_id, state)
+
+
+# Marks a job cancelled before it is created
+_CANCELLED = object()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """The HTTP API of :class:`Daemon`
+    """
+
+    def log_message(self, format, *args):
+        gf.logger.debug('%s', format % args)
+
+    @property
+    def daemon(self):
+        return self.server.daemon
+
+    def _send_json(self, status, data):
+        body = json.dumps(data, sort_keys=True).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            raise JobError('Content-Length must be a number of bytes')
+        try:
+            return json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError:
+            raise JobError('The body must be JSON')
+
+    def _get_job_id(self):
+        match = JOB_PATH.match(self.path)
+        return int(match.group(1)) if match is not None else None
+
+    def _handle(self, action):
+        """Send the result of `action` as JSON, 404 if it returns None and
+        400 if it raises JobError
+        """
+        try:
+            result = action()
+        except JobError as e:
+            self._send_json(400, {'error': str(e)})
+            return
+        if result is None:
+            self._send_json(404, {'error': 'Not found'})
+        else:
+            self._send_json(200, result)
+
+    def do_GET(self):
+        if self.path == '/jobs':
+            self._handle(self.daemon.queue.list)
+            return
+        job_id = self._get_job_id()
+        self._handle(
+            lambda: self.daemon.status(job_id) if job_id is not None else None
+        )
+
+    def do_POST(self):
+        if self.path != '/jobs':
+            self._send_json(404, {'error': 'Not found'})
+            return
+        self._handle(lambda: self.daemon.submit(self._read_json()))
+
+    def do_PATCH(self):
+        job_id = self._get_job_id()
+
+        def set_priority():
+            if job_id is None:
+                return None
+            data = self._read_json()
+            if not isinstance(data, dict) or 'priority' not in data:
+                raise JobError('priority is required')
+            try:
+                priority = int(data['priority'])
+            except (TypeError, ValueError):
+                raise JobError('priority must be int')
+            return self.daemon.set_priority(job_id, priority)
+        self._handle(set_priority)
+
+    def do_DELETE(self):
+        job_id = self._get_job_id()
+        self._handle(
+            lambda: self.daemon.cancel(job_id) if job_id is not None else None
+        )
+
+
+class _TCPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _UnixServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def create_server(daemon, host='127.0.0.1', port=PORT, socket_path=None):
+    """Create the HTTP server of the daemon
+
+    :param daemon: The daemon
+    :type daemon: Daemon
+    :param host: The address to listen on
+    :type host: str
+    :param port: The TCP port to listen on
+    :type port: int
+    :param socket_path: The Unix socket to listen on instead of TCP
+    :type socket_path: str
+    :rtype: socketserver.BaseServer
+    """
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = _UnixServer(socket_path, _Handler)
+    else:
+        server = _TCPServer((host, port), _Handler)
+    server.daemon = daemon
+    return server
+
+
+def _parse_cli_args(argv):
+    """Parse the arguments of `gf serve` using ArgumentParser
+
+    :param argv: The arguments after `serve`
+    :type argv: list of strs
+    :return: The arguments parsed by ArgumentParser
+    :rtype: Namespace
+    """
+    parser = argparse.ArgumentParser(prog='gf serve')
+    parser.add_argument(
+        '--host',
+        default='127.0.0.1',
+        help='The address to listen on. Default: 127.0.0.1',
+        metavar='<host>'
+    )
+    parser.add_argument(
+        '--port',
+        default=PORT,
+        help='The port to listen on. Default: %s' % PORT,
+        type=int,
+        metavar='<port>'
+    )
+    parser.add_argument(
+        '--socket',
+        help='Listen on this Unix socket instead of a TCP port',
+        metavar='<path>'
+    )
+    parser.add_argument(
+        '--queue',
+        default=QUEUE_PATH,
+        help='The database of the jobs. Default: %s' % QUEUE_PATH,
+        metavar='<path>'
+    )
+    parser.add_argument(
+        '--jobs',
+        default=2,
+        help='The max number of jobs running at a time. Default: 2',
+        type=int,
+        metavar='<num>'
+    )
+    parser.add_argument(
+        '--pool-size',
+        default=64,
+        help=(
+            'The max number of connections kept per host for all jobs. '
+            'Default: 64'
+        ),
+        type=int,
+        metavar='<num>'
+    )
+    parser.add_argument(
+        '--api-rate',
+        default=gf.API_RATE,
+        help=(
+            'The max number of API calls per second of all jobs. '
+            'Default: %s' % gf.API_RATE
+        ),
+        type=float,
+        metavar='<num>'
+    )
+    parser.add_argument(
+        '--retries',
+        default=5,
+        help='The number of retries of a failed request. Default: 5',
+        type=int,
+        metavar='<num>'
+    )
+    parser.add_argument(
+        '--api-cache',
+        help='Cache the API responses in a file',
+        metavar='<path>'
+    )
+    parser.add_argument(
+        '--api-cache-size',
+        default=gf.API_CACHE_SIZE,
+        help='The max size in MB of the API cache. Default: %s' % (
+            gf.API_CACHE_SIZE
+        ),
+        type=int,
+        metavar='<MB>'
+    )
+    parser.add_argument(
+        '--store',
+        help='Store every photo once in this directory, see gf -h',
+        metavar='<path>'
+    )
+    args = parser.parse_args(argv)
+    gf.logger.debug(args)
+    return args
+
+
+def _stop(signum, frame):
+    sys.exit(0)
+
+
+def main(argv):
+    """The main procedure of `gf serve`
+
+    :param argv: The arguments after `serve`
+    :type argv: list of strs
+    """
+    gf.init_logger()
+    args = _parse_cli_args(argv)
+    api_key, api_secret = gf.read_config()
+    downloader = gf.Downloader(
+        api_key, api_secret,
+        pool_size=args.pool_size,
+        api_rate=args.api_rate,
+        retries=args.retries,
+        api_cache=gf.ApiCache(
+            args.api_cache, args.api_cache_size * 1024 * 1024
+        ) if args.api_cache else None,
+        content_store=gf.ContentStore(args.store) if args.store else None
+    )
+    queue = JobQueue(args.queue)
+    daemon = Daemon(downloader, queue, max(1, args.jobs))
+    server = create_server(daemon, args.host, args.port, args.socket)
+    signal.signal(signal.SIGTERM, _stop)
+    daemon.start()
+    gf.logger.info(
+        'Serve on %s', args.socket or '%s:%s' % (args.host, args.port)
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+        daemon.stop()
+        queue.close()
+        downloader.close()
@@ -22,7 +22,7 @@ with open('requirements.txt') as f:
 
 setup(
     name='grabflickr',
-    description='Download photoset of flickr, support single process, multiprocess and gevent(Asynchronous I/O)',
+    description='Download photoset of flickr, support single process, multiprocess, gevent and asyncio(Asynchronous I/O)',
     long_description=open('README.rst').read(),
     version=get_release(),
     author='carlcarl',
@@ -30,6 +30,10 @@ setup(
     url='https://github.com/carlcarl/grabflickr',
     packages=find_packages(),
     install_requires=required,
+    extras_require={
+        # The thumbnail and exif hooks of --post
+        'post': ['Pillow'],
+    },
     license='MIT',
     entry_points={
         'console_scripts': [
@@ -41,7 +45,8 @@ setup(
         'Development Status :: 4 - Beta',
         'Intended Audience :: End Users/Desktop',
         'License :: OSI Approved :: MIT License',
-        'Programming Language :: Python :: 2 :: Only',
+        'Programming Language :: Python :: 2',
+        'Programming Language :: Python :: 3',
         'Operating System :: MacOS :: MacOS X',
         'Operating System :: POSIX',
         'Operating System :: Unix',
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""The fixtures of the tests, which run grabflickr against the local
+stand-in of flickr of the benchmarks
+"""
+
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from mock_flickr import MockFlickr  # noqa: E402
+
+# The same as the `gf` entry point, run from the checked out package
+COMMAND = (
+    'import sys; from grabflickr import grabflickr; '
+    'sys.exit(grabflickr.main())'
+)
+PHOTOSET_ID = 'set'
+# A run is killed after TIMEOUT seconds, so a hang fails the test
+TIMEOUT = 60
+
+
+@pytest.fixture
+def mock():
+    """A running server with 4 photos of 64 KB in every photoset
+    """
+    server = MockFlickr(photos=4, photo_size=64 * 1024)
+    server.start()
+    yield server
+    server.stop()
+
+
+class Runner(object):
+    """Run grabflickr in a new process against the server, every run
+    downloads the photoset into the same directory
+
+    :param mock: The running server
+    :type mock: MockFlickr
+    :param work_dir: The directory of the config and the photos
+    :type work_dir: str
+    """
+
+    def __init__(self, mock, work_dir):
+        self.mock = mock
+        self.work_dir = work_dir
+        self.directory = os.path.join(work_dir, 'photos')
+        self.config_path = os.path.join(work_dir, 'grabflickr.conf')
+        with open(self.config_path, 'w') as f:
+            f.write('[flickr]\nAPI_KEY = test\nAPI_SECRET = test\n')
+
+    def get_path(self, index):
+        """Get the path of a photo file
+
+        :param index: The index of the photo in the photoset
+        :type index: int
+        :rtype: str
+        """
+        return os.path.join(
+            self.directory, '%s-%d.jpg' % (PHOTOSET_ID, index)
+        )
+
+    def __call__(self, *args):
+        """Run grabflickr with the arguments after `-g` and `-d`
+
+        :return: The exit code and the output
+        :rtype: tuple
+        """
+        env = dict(os.environ)
+        env['GRABFLICKR_API_URL'] = self.mock.api_url
+        env['GRABFLICKR_CONFIG'] = self.config_path
+        env['PYTHONPATH'] = os.pathsep.join(
+            [ROOT] + [path for path in [env.get('PYTHONPATH')] if path]
+        )
+        process = subprocess.Popen(
+            [sys.executable, '-c', COMMAND, '-g', PHOTOSET_ID,
+             '-d', self.directory, '--progress-interval', '0'] +
+            list(args),
+            env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+        timer = threading.Timer(TIMEOUT, process.kill)
+        timer.start()
+        try:
+            output = process.communicate()[0].decode('utf-8', 'replace')
+        finally:
+            timer.cancel()
+        return process.returncode, output
+
+
+@pytest.fixture
+def run(mock, tmpdir):
+    """Run grabflickr against the server, see :class:`Runner`
+    """
+    return Runner(mock, str(tmpdir))
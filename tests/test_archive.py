@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""The archive sinks of `--archive`
+"""
+
+import os
+import tarfile
+import threading
+
+import pytest
+
+from grabflickr import grabflickr as gf
+
+
+class FailingTarSink(gf.TarSink):
+    """A tar sink whose disk is full after `written` members
+    """
+
+    written = 2
+
+    def _write(self, file_path, name):
+        if not self.written:
+            raise IOError('No space left on device')
+        self.written -= 1
+        gf.TarSink._write(self, file_path, name)
+
+
+def _add_photos(sink, producer, num, errors):
+    for index in range(num):
+        file_path = os.path.join(sink.root, '%s-%d.jpg' % (producer, index))
+        with open(file_path, 'wb') as f:
+            f.write(b'photo')
+        sink.contains(file_path)
+        try:
+            sink.add(file_path)
+        except IOError as e:
+            errors.append(e)
+            os.remove(file_path)
+
+
+def test_write_failure(tmpdir, monkeypatch):
+    # The producers wait for the writer at once
+    monkeypatch.setattr(gf, 'ARCHIVE_QUEUE_SIZE', 1)
+    path = str(tmpdir.join('photos.tar'))
+    sink = FailingTarSink(path)
+    errors = []
+    producers = [
+        threading.Thread(target=_add_photos, args=(sink, producer, 10, errors))
+        for producer in range(4)
+    ]
+    for producer in producers:
+        producer.daemon = True
+        producer.start()
+    for producer in producers:
+        producer.join(30)
+        assert not producer.is_alive(), 'The producers are blocked'
+    closer = threading.Thread(target=sink.close)
+    closer.daemon = True
+    closer.start()
+    closer.join(30)
+    assert not closer.is_alive(), 'close() is blocked'
+    assert errors
+    # The dropped photos are not listed, the next run downloads them again
+    with tarfile.open(path) as tar:
+        names = tar.getnames()
+    assert len(names) == 2
+    assert sink.get_names() == set(names)
+    assert not os.path.exists(sink.root)
+    with pytest.raises(IOError):
+        sink.add(os.path.join(sink.root, 'late.jpg'))
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""The downloads of the engines against the local stand-in of flickr
+"""
+
+import json
+import os
+
+import pytest
+
+try:
+    import aiohttp  # noqa: F401
+    ENGINES = ['0', '1', '3']
+except ImportError:
+    ENGINES = ['0', '1']
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _write(path, content):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def _assert_complete(run, mock):
+    """Every photo of the photoset is downloaded in full and no partial
+    file is left
+    """
+    body = mock.get_body('o')
+    for index in range(mock.photos):
+        assert _read(run.get_path(index)) == body
+    assert sorted(os.listdir(run.directory)) == sorted(
+        os.path.basename(run.get_path(index)) for index in range(mock.photos)
+    )
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_resume_part(run, mock, engine):
+    body = mock.get_body('o')
+    _write(run.get_path(0) + '.part', body[:len(body) // 2])
+    mock.reset()
+    code, output = run('-O', engine)
+    assert code == 0, output
+    _assert_complete(run, mock)
+    # Only the missing half of the first photo is sent again
+    assert mock.reset()['bytes'] < len(body) * (mock.photos - 0.25)
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_complete_part_416(run, mock, engine):
+    body = mock.get_body('o')
+    _write(run.get_path(0) + '.part', body)
+    mock.reset()
+    code, output = run('-O', engine)
+    assert code == 0, output
+    _assert_complete(run, mock)
+    # The Range after the end is answered with 416 and no image bytes
+    assert mock.reset()['bytes'] < len(body) * (mock.photos - 0.5)
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_part_larger_than_photo_416(run, mock, engine):
+    body = mock.get_body('o')
+    _write(run.get_path(0) + '.part', body + b'stale')
+    code, output = run('-O', engine)
+    assert code == 0, output
+    _assert_complete(run, mock)
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_segments(run, mock, engine):
+    mock.reset()
+    # 16 KB, a quarter of the photos
+    code, output = run(
+        '-O', engine, '--segments', '4', '--segment-threshold', '0.015625'
+    )
+    assert code == 0, output
+    _assert_complete(run, mock)
+    # The first request of a photo and its 4 equal segments
+    assert mock.reset()['GET'] == mock.photos * 5
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_sync_noop(run, mock, engine):
+    code, output = run('-O', engine, '--sync')
+    assert code == 0, output
+    mock.reset()
+    code, output = run('-O', engine, '--sync')
+    assert code == 0, output
+    assert 'GET' not in mock.reset()
+    assert os.path.isfile(run.get_path(0))
+
+
+def test_multiprocess_trace(run, mock):
+    mock.photos = 40
+    trace_path = os.path.join(run.work_dir, 'trace.json')
+    code, output = run(
+        '-O', '4', '--processes', '2', '--trace', trace_path
+    )
+    assert code == 0, output
+    body = mock.get_body('o')
+    for index in range(mock.photos):
+        assert _read(run.get_path(index)) == body
+    with open(trace_path) as f:
+        events = json.load(f)['traceEvents']
+    # The events of both workers are merged
+    assert len(set(event['pid'] for event in events)) > 1
+
+
+def test_stats_connections(run, mock):
+    stats_path = os.path.join(run.work_dir, 'stats.json')
+    code, output = run('-O', '1', '--stats-json', stats_path)
+    assert code == 0, output
+    assert 'Connection pool' in output
+    with open(stats_path) as f:
+        connections = json.load(f)['connections']
+    assert connections
+    assert sum(stat['requests'] for stat in connections) >= mock.photos